@@ -93,6 +93,7 @@ script_dir=$(dirname "$(realpath "$0")")
 script_path="$script_dir/cam.py"
 led_switch_path="$script_dir/led_switch.py"
 self_check_path="$script_dir/self_check.py"
+preview_daemon_path="$script_dir/preview_daemon.py"
 
 if sudo ln -sfn $script_path /usr/local/bin/picam; then
     echo "Symbolic link 'picam' successfully created or updated in /usr/local/bin."
@@ -118,6 +119,14 @@ else
     echo "Failed to create symbolic link. Please check the script path and try again."
 fi
 
+if sudo ln -sfn $preview_daemon_path /usr/local/bin/preview_daemon; then
+    echo "Symbolic link 'preview_daemon' successfully created or updated in /usr/local/bin."
+    echo "New link: $(readlink -f /usr/local/bin/preview_daemon)"
+    chmod +x $preview_daemon_path
+else
+    echo "Failed to create symbolic link. Please check the script path and try again."
+fi
+
 # Initialize the list of groups the user is not part of
 missing_groups=()
 
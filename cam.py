@@ -17,8 +17,7 @@ import sys
 import signal
 
 from src.parameters import Parameters
-
-from src.record import Recorder
+from src.preview_daemon import send_to_preview_daemon
 
 import os
 import subprocess
@@ -85,15 +84,14 @@ def sigusr1_handler(signal, frame):
     """
     Handle the SIGUSR1 signal.
 
-    This function allows capturing a new frame while the recording process is paused.
+    This function requests a snapshot, taken by the recording loop between two frames or during a pause.
 
     Args:
         signal (int): Signal number.
         frame: Current stack frame (unused).
     """
-    print("Received SIGUSR1 signal. Capturing a new frame.")
+    print("Received SIGUSR1 signal. Requesting a snapshot.")
     if recorder:  # Check if the recorder is initialized
-        recorder.logger.log("Received SIGUSR1 signal. Capturing a new frame.", log_level=3)
         recorder.capture_frame_during_pause()
 
 
@@ -123,6 +121,22 @@ def main():
 
         # Load parameters
         parameters_file = sys.argv[1]
+        parameters = Parameters(parameters_file)
+
+        # A running preview daemon serves the previews with its warm camera, and must release the
+        # camera and the LEDs before any other session
+        if parameters["timeout"] == 0:
+            answer = send_to_preview_daemon(f"preview {os.path.abspath(parameters_file)}")
+            if answer is not None and answer.startswith("SUCCESS"):
+                print(f"Preview served by the preview daemon: {answer}")
+                return
+        # Waits for the daemon to stop its camera script (which can take up to its command timeout)
+        answer = send_to_preview_daemon(f"release {os.getpid()}", timeout=40)
+        if answer is not None and not answer.startswith("SUCCESS"):
+            raise RuntimeError(f"The preview daemon did not release the camera: {answer}")
+
+        # Imported after the preview daemon is asked, since a served preview does not need it
+        from src.record import Recorder
 
         global recorder
         recorder = Recorder(parameter_file=parameters_file, git_version=get_git_version())
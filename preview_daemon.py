@@ -0,0 +1,38 @@
+#!/usr/bin/python3 -u
+
+"""
+Resident preview service: keeps the camera and the LEDs initialized between sessions and serves
+previews and snapshots on the Unix socket ~/tmp/preview.sock (see src/preview_daemon.py).
+
+cam.py hands its previews to the daemon when it is running, and makes it release the hardware
+before a recording.
+
+Usage: python3 preview_daemon.py <parameters_file>
+"""
+
+import signal
+import sys
+
+from src.log import Logger
+from src.parameters import Parameters
+from src.preview_daemon import PreviewDaemon
+
+
+def main():
+    if len(sys.argv) <= 1:
+        print("Usage: python3 preview_daemon.py <parameters_file>")
+        sys.exit(1)
+
+    parameters = Parameters(sys.argv[1])
+    logger = Logger(verbosity_level=parameters.get("verbosity_level", 3))
+    daemon = PreviewDaemon(parameter_file=sys.argv[1], logger=logger)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        daemon.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import math
+import os
+import time
+
+
+class AdaptiveFrameRate:
+    """
+    Adaptive acquisition: frames are taken every ``time_interval`` seconds while nothing happens,
+    and every ``fast_interval`` seconds while worms move or around the optogenetic stimuli.
+
+    The captures are on a wall-clock grid, as the IR illumination program of the LightController
+    (which runs at the fast interval in this mode): at the multiples of ``time_interval`` at the
+    base rate, at the multiples of ``fast_interval`` at the fast rate. ``time_interval`` must be a
+    multiple of ``fast_interval``.
+
+    The fast rate is used:
+
+    - for ``hold`` seconds after activity was detected: the mean absolute difference between the
+      last two frames, decoded at 1/8 of their size in grey levels, is above ``motion_threshold``
+      (in grey levels);
+    - within ``stimulus_margin`` seconds around each optogenetic pulse of the LightController
+      (every ``pulse_interval`` seconds, offset by 0.5 s, for ``pulse_duration`` seconds).
+
+    The capture time and rate of each frame are written to ``<timestamps_dir>/<part>.csv``, used to
+    encode the part at a variable frame rate and shipped with it (see UploadManager).
+
+    :param time_interval: Base time between two frames, in seconds.
+    :param fast_interval: Time between two frames during activity, in seconds.
+    :param motion_threshold: Mean absolute difference of grey levels above which the frame shows activity.
+    :param hold: Time the fast rate is kept after the last activity, in seconds.
+    :param pulse_interval: Period of the optogenetic pulses, in seconds, or None without stimulus.
+    :param pulse_duration: Duration of the optogenetic pulses, in seconds.
+    :param stimulus_margin: Time before and after each pulse taken at the fast rate, in seconds.
+    :param timestamps_dir: Folder of the timestamp files.
+    :param enabled: If False, the frames are taken every time_interval seconds, without timestamps.
+    :param logger: Logger instance.
+    """
+
+    PULSE_OFFSET = 0.5  # Offset of the blinking programs of the LEDs (see LED.run_led_timer)
+
+    def __init__(self, time_interval, fast_interval, motion_threshold=2.0, hold=30, pulse_interval=None,
+                 pulse_duration=0, stimulus_margin=10, timestamps_dir=None, enabled=True, logger=None):
+        self.time_interval = time_interval
+        self.fast_interval = fast_interval
+        self.motion_threshold = motion_threshold
+        self.hold = hold
+        self.pulse_interval = pulse_interval
+        self.pulse_duration = pulse_duration
+        self.stimulus_margin = stimulus_margin
+        self.timestamps_dir = timestamps_dir
+        self.logger = logger
+
+        self.enabled = enabled
+        ratio = time_interval / fast_interval if fast_interval else 0
+        if enabled and (fast_interval <= 0 or ratio < 1 or abs(ratio - round(ratio)) > 1e-6):
+            self.logger.log(f"adaptive_fast_interval ({fast_interval}s) does not divide time_interval "
+                            f"({time_interval}s), adaptive frame rate disabled", log_level=1)
+            self.enabled = False
+
+        self.previous = None
+        self.last_activity = None
+        self.fast = False
+        self.last_capture_time = None
+        self.n_fast, self.n_base = 0, 0
+
+    @classmethod
+    def from_parameters(cls, parameters, tmp_folder, logger=None):
+        return cls(time_interval=parameters["time_interval"],
+                   fast_interval=parameters.get("adaptive_fast_interval", parameters["time_interval"] / 4),
+                   motion_threshold=parameters.get("adaptive_motion_threshold", 2.0),
+                   hold=parameters.get("adaptive_hold_s", 30),
+                   pulse_interval=parameters["pulse_interval"] if parameters.get("optogenetic", False) else None,
+                   pulse_duration=parameters.get("pulse_duration", 0),
+                   stimulus_margin=parameters.get("adaptive_stimulus_margin_s", 10),
+                   timestamps_dir=os.path.join(tmp_folder, "timestamps"),
+                   enabled=parameters.get("adaptive_rate", False),
+                   logger=logger)
+
+    # Triggers
+
+    def measure_motion(self, frame_path):
+        """
+        :return: Mean absolute difference with the previous frame, or None for the first one (or
+            a frame that cannot be read).
+        """
+        import cv2
+
+        frame = cv2.imread(frame_path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        if frame is None:
+            return None
+        previous, self.previous = self.previous, frame
+        if previous is None or previous.shape != frame.shape:
+            return None
+        return float(cv2.absdiff(frame, previous).mean())
+
+    def in_stimulus_window(self, t):
+        """:return: True if t is within stimulus_margin of an optogenetic pulse."""
+        if not self.pulse_interval:
+            return False
+        phase = (t - self.PULSE_OFFSET) % self.pulse_interval
+        # After the start of the last pulse, or before the start of the next one
+        return phase <= self.pulse_duration + self.stimulus_margin or \
+            phase >= self.pulse_interval - self.stimulus_margin
+
+    def update(self, frame_path, capture_time):
+        """
+        Account for a saved frame: measure the activity and choose the rate of the next frames.
+
+        :param frame_path: Path of the frame, or None if it could not be captured (an empty frame
+            would look like activity).
+        :param capture_time: Time of the capture.
+        """
+        self.last_capture_time = capture_time
+        if self.fast:
+            self.n_fast += 1
+        else:
+            self.n_base += 1
+
+        motion = self.measure_motion(frame_path) if frame_path is not None else None
+        if motion is not None and motion > self.motion_threshold:
+            self.last_activity = capture_time
+
+        active = self.last_activity is not None and capture_time - self.last_activity < self.hold
+        fast = active or self.in_stimulus_window(capture_time + self.fast_interval)
+        if fast != self.fast:
+            reason = "activity" if active else "stimulus" if fast else "no activity"
+            self.logger.log(f"Frame interval {self.get_interval()}s -> "
+                            f"{self.fast_interval if fast else self.time_interval}s ({reason}"
+                            + (f", motion {motion:.1f}" if motion is not None else "") + ")", log_level=4)
+            self.fast = fast
+
+    # Schedule
+
+    def get_interval(self):
+        return self.fast_interval if self.fast else self.time_interval
+
+    def get_next_frame_time(self, now=None):
+        """:return: Time of the next slot of the grid of the current rate, after the last frame."""
+        now = time.time() if now is None else now
+        interval = self.get_interval()
+        after = max(now, self.last_capture_time + interval / 2) if self.last_capture_time is not None else now
+        return math.ceil(after / interval) * interval
+
+    def get_max_frames(self, duration):
+        """:return: Maximum number of frames in the duration, all at the fast rate."""
+        return max(int(duration / self.fast_interval), 1)
+
+    # Timestamps
+
+    def clear_timestamps(self):
+        """Remove the timestamps of a previous recording."""
+        if os.path.isdir(self.timestamps_dir):
+            for name in os.listdir(self.timestamps_dir):
+                os.remove(os.path.join(self.timestamps_dir, name))
+
+    def write_timestamp(self, save_path, capture_time):
+        """Append the capture time of a frame to the timestamps of its part."""
+        part = os.path.basename(os.path.dirname(save_path))
+        path = os.path.join(self.timestamps_dir, f"{part}.csv")
+        os.makedirs(self.timestamps_dir, exist_ok=True)
+        new_file = not os.path.exists(path)
+        with open(path, "a") as f:
+            if new_file:
+                f.write("frame,time,interval\n")
+            f.write(f"{os.path.basename(save_path)},{capture_time:.3f},{self.get_interval()}\n")
+
+    def get_summary(self):
+        total = self.n_fast + self.n_base
+        return (f"{total} frames, {self.n_fast} at {self.fast_interval}s and {self.n_base} at "
+                f"{self.time_interval}s ({self.n_fast / max(total, 1):.0%} fast)")
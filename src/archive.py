@@ -0,0 +1,141 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import tarfile
+import time
+
+from src.checksum import run_and_hash_output
+
+
+class HashingWriter:
+    """
+    File-like object writing to a file while hashing what is written, so that the checksum of an
+    archive is known without reading it back.
+    """
+
+    def __init__(self, file, algorithm="sha256"):
+        self.file = file
+        self.hasher = hashlib.new(algorithm)
+        self.written = 0
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.written += len(data)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+def get_folder_size(folder_name):
+    """:return: Total size in bytes of the files of a folder (not recursive), 0 if it cannot be read."""
+    try:
+        return sum(entry.stat().st_size for entry in os.scandir(folder_name) if entry.is_file())
+    except OSError:
+        return 0
+
+
+def process_cpu_time():
+    """
+    :return: CPU time in seconds used so far by the current process (all its threads) and its
+        waited-for children, to measure the CPU share of a compression whether it runs in-process
+        or in a subprocess.
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def zstd_available():
+    """:return: True if zstd archives can be written, in-process or with the zstd command."""
+    try:
+        import zstandard  # noqa: F401
+        return True
+    except ImportError:
+        return shutil.which("zstd") is not None
+
+
+def write_tar_zst(folder_name, output_file, level=3, threads=0, algorithm="sha256", timeout=None):
+    """
+    Archive the content of a folder to a zstd-compressed tar, hashing the archive on the fly.
+
+    The tar stream is produced with tarfile and compressed in-process by the zstandard module,
+    with ``threads`` compression threads, without any intermediate file. If the module is not
+    installed, the archive is written by ``tar`` piped into the ``zstd`` command instead.
+
+    :param folder_name: Folder to archive, its content is stored at the root of the archive.
+    :param output_file: Path to the .tar.zst file.
+    :param level: zstd compression level (1-19, 3 is the zstd default).
+    :param threads: Number of compression threads, 0 for a single thread, -1 for one per core.
+    :param algorithm: Any algorithm supported by hashlib.
+    :param timeout: Maximum duration in seconds.
+    :return: Hexadecimal digest of the archive.
+    :rtype: str
+    :raises TimeoutError: If the archive is not written within the timeout.
+    """
+    try:
+        import zstandard
+    except ImportError:
+        zstd_args = f"zstd -{level} -T{max(threads, 0)}"
+        call_args = ['tar', '--xattrs', '-I', zstd_args, '-cf', '-', '-C', folder_name, '.']
+        try:
+            return run_and_hash_output(call_args, output_file, algorithm=algorithm, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            raise TimeoutError(f"Archiving {folder_name} timed out after {timeout} seconds")
+
+    deadline = time.time() + timeout if timeout is not None else None
+    compressor = zstandard.ZstdCompressor(level=level, threads=threads, write_checksum=True)
+
+    with open(output_file, 'wb') as out:
+        writer = HashingWriter(out, algorithm=algorithm)
+        with compressor.stream_writer(writer, closefd=False) as compressed, \
+                tarfile.open(fileobj=compressed, mode='w|', format=tarfile.PAX_FORMAT) as archive:
+            # Sorted names give the same member order as a listing of the folder by frame number
+            for name in sorted(os.listdir(folder_name)):
+                if deadline is not None and time.time() > deadline:
+                    raise TimeoutError(f"Archiving {folder_name} timed out after {timeout} seconds")
+                archive.add(os.path.join(folder_name, name), arcname=os.path.join('.', name))
+        out.flush()
+        os.fsync(out.fileno())
+
+    return writer.hexdigest()
+
+
+def open_tar(archive_file):
+    """
+    Open a .tgz or .tar.zst archive for a sequential read.
+
+    :return: An open tarfile.TarFile, to use as a context manager.
+    """
+    if not archive_file.endswith(".zst"):
+        return tarfile.open(archive_file)
+
+    try:
+        import zstandard
+    except ImportError:
+        # Decompress with the zstd command
+        process = subprocess.Popen(['zstd', '-dc', archive_file], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        archive = tarfile.open(fileobj=process.stdout, mode='r|')
+        close = archive.close
+
+        def close_and_wait():
+            close()
+            process.stdout.close()
+            process.wait()
+
+        archive.close = close_and_wait
+        return archive
+
+    reader = zstandard.ZstdDecompressor().stream_reader(open(archive_file, 'rb'), closefd=True)
+    archive = tarfile.open(fileobj=reader, mode='r|')
+    close = archive.close
+
+    def close_reader():
+        close()
+        reader.close()
+
+    archive.close = close_reader
+    return archive
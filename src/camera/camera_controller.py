@@ -5,6 +5,7 @@ import threading
 import time
 
 from src.camera.camera import Camera
+from src.cpu_placement import LatenessStats
 from src.parameters import Parameters
 
 
@@ -37,6 +38,22 @@ class CameraController:
 
         self.frame_dimensions = None
         self.parameters = Parameters(parameters_path)
+
+        # Captures given a deadline (the next slot) are cancelled when it is due. The camera script
+        # is restarted after capture_restart_after_misses consecutive misses, so that a single late
+        # frame does not make the camera unavailable for the following ones.
+        self.deadline_margin = self.parameters.get("capture_deadline_margin_s", 0.1)
+        self.min_capture_timeout = self.parameters.get("capture_min_timeout_s", 0.5)
+        self.restart_after_misses = self.parameters.get("capture_restart_after_misses", 3)
+        # The camera is checked again well within a frame interval after a restart (adaptive_fast_interval
+        # with the adaptive frame rate)
+        frame_interval = self.parameters.get("time_interval", 2)
+        if self.parameters.get("adaptive_rate", False):
+            frame_interval = self.parameters.get("adaptive_fast_interval", frame_interval / 4)
+        self.restart_poll_interval = min(4, frame_interval / 2)
+        self.consecutive_misses = 0
+        self.missed_deadlines = 0
+        self.capture_latency = LatenessStats(late_threshold=self.parameters.get("time_interval", 2))
         if self.safe_mode:
             with Camera(self.parameters, partial_init=True) as camera:
                 self.frame_dimensions = camera.get_frame_dimensions()
@@ -62,10 +79,16 @@ class CameraController:
         self.logger.log("Camera script successfully started.", log_level=3)
 
 
-    def send_command(self, command, timeout=10):
-        """Send a command to the camera script in a dedicated thread with a timeout."""
+    def send_command(self, command, timeout=10, grace=1, restart_on_timeout=True):
+        """
+        Send a command to the camera script in a dedicated thread with a timeout.
+
+        :param timeout: Time to wait for the response, in seconds.
+        :param grace: Extra time given to the thread after the timeout, in seconds.
+        :param restart_on_timeout: Restart the camera script if the command timed out.
+        """
         response = {"success": False, "error": None}  # Shared dictionary for response
-        self.command_thread = threading.Thread(target=self._send_command_thread, args=(command, response))
+        self.command_thread = threading.Thread(target=self._send_command_thread, args=(command, response, timeout))
         self.command_thread.start()
 
         # Wait for the thread to complete or timeout
@@ -75,13 +98,14 @@ class CameraController:
             # print(f"Timeout reached. Command '{command}' did not complete in {timeout} seconds.")
             # Optionally, terminate the process or handle the timeout case
             response["error"] = TimeoutError(f"Command '{command}' timed out.")
-            self.command_thread.join(1)  # Ensure the thread finishes execution
+            if grace > 0:
+                self.command_thread.join(grace)  # Ensure the thread finishes execution
             self.logger.log(f"Command thread terminated due to timeout.", log_level=5)
             # print(f"Thread terminated.")
 
         # Return the response from the thread
         if response["error"]:
-            if isinstance(response["error"], TimeoutError):
+            if isinstance(response["error"], TimeoutError) and restart_on_timeout:
                 # print(f"TimeoutError: {response['error']}. Restarting camera script.")
                 self.logger.log(f"TimeoutError: {response['error']}."
                                 f" Restarting camera script.", log_level=1)
@@ -92,23 +116,26 @@ class CameraController:
 
     def _send_command_thread(self, command, response, timeout=4):
         """Send a command to the camera script and wait for a response."""
-        if not self.process:
+        # The camera script it was sent to: after a restart, a thread left waiting for a hung script
+        # must not read the answers of the new one
+        process = self.process
+        if not process:
             raise RuntimeError("Camera script is not running.")
 
         # print(f"[Main Script] Sending command to camera script: {command}")
         try:
             # Write the command
-            self.process.stdout.flush()
-            self.process.stdin.write(command + "\n")
-            self.process.stdin.flush()
+            process.stdout.flush()
+            process.stdin.write(command + "\n")
+            process.stdin.flush()
 
             # Wait for response
             start_time = time.time()
             while True:
                 # print(f'Elapsed time : {time.time() - start_time}')
-                if self.process.stdout.readable():
+                if process.stdout.readable():
 
-                    line = self.process.stdout.readline().strip()
+                    line = process.stdout.readline().strip()
                     if line:
                         # print(f"[Main Script] Camera script response: {line}")
                         # print(f"[Main Script] Camera script response: {line}")
@@ -135,8 +162,15 @@ class CameraController:
             response["error"] = e
             raise
 
-    def capture_frame(self, save_path):
-        """Capture a frame and ensure the action is completed."""
+    def capture_frame(self, save_path, deadline=None):
+        """
+        Capture a frame and ensure the action is completed.
+
+        :param save_path: Path of the frame.
+        :param deadline: Time (as given by time.time) when the next capture is due. The capture is
+            cancelled shortly before it, and counted as a miss. Without deadline, the capture is
+            given 5 seconds.
+        """
         try:
             if not self.camera_available:
                 # print("[Main Script] Camera not available. Capturing empty frame.")
@@ -146,15 +180,64 @@ class CameraController:
             if self.command_thread and self.command_thread.is_alive():
                 # print("[Main Script] The previous command is still running. Getting empty frame")
                 self.capture_empty_frame(save_path)
+                # The camera script still has not answered a cancelled capture: it is hung, and
+                # counted as a miss so that it is restarted
+                self.record_miss("The previous request is still running")
                 raise RuntimeError("The previous request is still running.")
 
-            ok = self.send_command(f"capture {save_path}", timeout=5)
+            if deadline is None:
+                timeout, grace = 5, 1
+            else:
+                timeout, grace = max(deadline - self.deadline_margin - time.time(), self.min_capture_timeout), 0
+
+            start_time = time.time()
+            try:
+                ok = self.send_command(f"capture {save_path}", timeout=timeout, grace=grace, restart_on_timeout=False)
+            except TimeoutError:
+                self.capture_latency.record(time.time() - start_time)
+                self.record_miss(f"Capture missed its deadline after {time.time() - start_time:.2f}s")
+                raise
+            self.capture_latency.record(time.time() - start_time)
+            self.consecutive_misses = 0
             # print(f"[Main Script] Frame successfully saved to {save_path}")
             return ok
         except Exception:
             # print(f"[Main Script] Error capturing frame: {e}")
             raise
 
+    def capture_snapshot(self, save_path, deadline=None):
+        """
+        Capture a frame out of the schedule of the recording (see SnapshotService). Unlike
+        capture_frame, a late snapshot is not counted as a miss and does not restart the camera
+        script: it is only cancelled, shortly before the deadline.
+
+        :param save_path: Path of the frame.
+        :param deadline: Time (as given by time.time) when the next frame of the recording is due.
+        """
+        if not self.camera_available:
+            raise RuntimeError("Camera not available.")
+        if self.command_thread and self.command_thread.is_alive():
+            raise RuntimeError("The previous request is still running.")
+
+        if deadline is None:
+            timeout, grace = 5, 1
+        else:
+            timeout, grace = deadline - self.deadline_margin - time.time(), 0
+            if timeout <= 0:
+                raise TimeoutError("No time left for the snapshot before the next frame.")
+        return self.send_command(f"capture {save_path}", timeout=timeout, grace=grace, restart_on_timeout=False)
+
+    def record_miss(self, reason):
+        """Count a missed capture, and restart the camera script after restart_after_misses in a row."""
+        self.missed_deadlines += 1
+        self.consecutive_misses += 1
+        self.logger.log(f"{reason} ({self.consecutive_misses} in a row, {self.missed_deadlines} in total)",
+                        log_level=1)
+        if self.consecutive_misses >= self.restart_after_misses:
+            self.logger.log("Restarting camera script.", log_level=1)
+            self.consecutive_misses = 0
+            self.restart()
+
     def capture_empty_frame(self, save_path):
         """Capture an empty frame using the camera script or fallback to a static method if needed."""
 
@@ -165,7 +248,10 @@ class CameraController:
             except Exception as e:
                 self.logger.log(f"Error capturing empty frame with static method: {e}", log_level=1)
 
-        if self.camera_available:
+        # A cancelled capture may still be waiting for the answer of the camera script
+        busy = self.command_thread is not None and self.command_thread.is_alive()
+
+        if self.camera_available and not busy:
             try:
                 self.send_command(f"empty {save_path}")
             except Exception as e:
@@ -175,6 +261,10 @@ class CameraController:
         elif self.safe_mode:
             try_static_method()
 
+    def get_capture_summary(self):
+        """:return: Latency statistics of the captures, to tune the deadline margin."""
+        return f"{self.capture_latency.summary()}, {self.missed_deadlines} missed deadline(s)"
+
 
     def stop(self):
         """Stop the camera script."""
@@ -216,7 +306,7 @@ class CameraController:
     def _wait_for_camera_thread(self):
         """Wait for the camera script to complete."""
         while not self.check_camera():
-            time.sleep(4)
+            time.sleep(self.restart_poll_interval)
         self.logger.log("Camera script is back !.", log_level=3)
         self.start()
 
@@ -0,0 +1,91 @@
+import hashlib
+import os
+import subprocess
+import threading
+
+
+def file_checksum(path, algorithm="sha256", chunk_size=4 * 1024 * 1024, drop_cache=False):
+    """
+    Compute the checksum of a file.
+
+    :param path: Path to the file.
+    :param algorithm: Any algorithm supported by hashlib.
+    :param chunk_size: Size of the chunks read in bytes.
+    :param drop_cache: Drop the cached pages of the file first, so that a file on a network
+        mount is read back from the server and not from the local page cache.
+    :return: Hexadecimal digest.
+    :rtype: str
+    """
+    hasher = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        if drop_cache:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def run_and_hash_output(call_args, output_file, algorithm="sha256", timeout=None, chunk_size=1024 * 1024):
+    """
+    Run a command writing its output on stdout, and save this output to a file while hashing
+    it, so that the checksum is known without reading the file back.
+
+    :param call_args: Command to run, e.g. ``['tar', '-czf', '-', ...]``.
+    :param output_file: File where the output of the command is saved.
+    :param algorithm: Any algorithm supported by hashlib.
+    :param timeout: Maximum duration of the command in seconds.
+    :return: Hexadecimal digest of the output.
+    :rtype: str
+    :raises subprocess.TimeoutExpired: If the command exceeds the timeout.
+    :raises subprocess.CalledProcessError: If the command fails.
+    """
+    hasher = hashlib.new(algorithm)
+
+    with open(output_file, 'wb') as out, \
+            subprocess.Popen(call_args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as process:
+        # Kill the command if it exceeds the timeout, even if it stopped writing
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            process.kill()
+
+        timer = threading.Timer(timeout, kill) if timeout is not None else None
+        if timer is not None:
+            timer.start()
+
+        try:
+            while True:
+                chunk = process.stdout.read(chunk_size)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                out.write(chunk)
+            returncode = process.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(call_args, timeout)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, call_args)
+
+    return hasher.hexdigest()
+
+
+def append_to_manifest(manifest_path, checksum, filename):
+    """
+    Append a line to a manifest in the ``sha256sum`` format, so that it can be checked on
+    the server with ``sha256sum -c``.
+
+    :param manifest_path: Path to the manifest.
+    :param checksum: Hexadecimal digest of the file.
+    :param filename: Name of the file at destination.
+    """
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path, 'a') as manifest:
+        manifest.write(f"{checksum}  {filename}\n")
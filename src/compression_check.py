@@ -0,0 +1,154 @@
+import json
+import os
+import subprocess
+import time
+
+from src.archive import open_tar
+
+
+class CompressionVerifier:
+    """
+    Tiered verification of a compressed part, cheaper than decoding the whole video.
+
+    Levels:
+
+    - ``header``: the container and the video stream headers can be read by ffprobe.
+    - ``sample`` (default): ``header`` + the number of video packets matches the number of
+      frames of the part + a few keyframes spread over the video are decoded.
+    - ``full``: ``sample`` + the full video is decoded (previous behaviour, costly on a Pi).
+
+    :param level: Verification level, one of LEVELS.
+    :type level: str
+    :param n_samples: Number of keyframes decoded at the ``sample`` level.
+    :type n_samples: int
+    :param logger: Logger instance.
+    """
+
+    LEVELS = ("header", "sample", "full")
+
+    def __init__(self, level="sample", n_samples=3, logger=None):
+        if level not in self.LEVELS:
+            logger.log(f"Unknown verification level '{level}', using 'sample'", log_level=2)
+            level = "sample"
+        self.level = level
+        self.n_samples = n_samples
+        self.logger = logger
+
+    def verify(self, compressed_file, expected_frames=None):
+        """
+        Verify a compressed part and report the time spent.
+
+        :param compressed_file: Path to the .mkv, .tgz or .tar.zst file.
+        :param expected_frames: Number of frames of the part, or None to skip the frame count check.
+        :return: True if the file passed the checks of the configured level.
+        :rtype: bool
+        """
+        start_time = time.time()
+
+        if compressed_file is None or not os.path.exists(compressed_file):
+            self.logger.log(f"Compression failed: {compressed_file} not created.", log_level=1)
+            return False
+
+        if os.path.getsize(compressed_file) == 0:
+            self.logger.log(f"Compression failed: {compressed_file} is empty.", log_level=1)
+            return False
+
+        if compressed_file.endswith((".tgz", ".tar.zst")):
+            ok = self.verify_archive(compressed_file, expected_frames)
+        else:
+            ok = self.verify_video(compressed_file, expected_frames)
+
+        self.logger.log(f"Verification ({self.level}) of {compressed_file}: {'OK' if ok else 'FAILED'} "
+                        f"in {time.time() - start_time:.2f}s", log_level=3)
+        return ok
+
+    def verify_video(self, video_file, expected_frames):
+        info = self.probe(video_file)
+        if info is None:
+            return False
+
+        if self.level == "header":
+            return True
+
+        n_packets = info["n_packets"]
+        if expected_frames is not None and n_packets != expected_frames:
+            self.logger.log(f"Compression failed: {video_file} has {n_packets} frames, "
+                            f"{expected_frames} expected.", log_level=1)
+            return False
+
+        if not self.decode_samples(video_file, info["duration"]):
+            return False
+
+        if self.level == "full":
+            return self.decode_all(video_file)
+
+        return True
+
+    def probe(self, video_file):
+        """
+        Read the container and video stream headers, and count the video packets without decoding them.
+
+        :return: Dictionary with codec, dimensions, duration and packet count, or None if invalid.
+        """
+        probe_cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-count_packets',
+                     '-show_entries', 'stream=codec_name,width,height,nb_read_packets:format=duration',
+                     '-of', 'json', video_file]
+        result = subprocess.run(probe_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            self.logger.log(f"Compression failed: {video_file} headers are invalid: "
+                            f"{result.stderr.decode().strip()}", log_level=1)
+            return None
+
+        try:
+            data = json.loads(result.stdout)
+            stream = data["streams"][0]
+            return {"codec": stream["codec_name"],
+                    "width": stream["width"],
+                    "height": stream["height"],
+                    "n_packets": int(stream["nb_read_packets"]),
+                    "duration": float(data["format"].get("duration", 0))}
+        except (ValueError, KeyError, IndexError) as e:
+            self.logger.log(f"Compression failed: {video_file} has no readable video stream ({e})", log_level=1)
+            return None
+
+    def decode_samples(self, video_file, duration):
+        """Decode one frame at a few timestamps spread over the video (seeks land on keyframes)."""
+        if self.n_samples <= 1 or duration <= 0:
+            timestamps = [0]
+        else:
+            timestamps = [duration * i / self.n_samples for i in range(self.n_samples)]
+
+        for timestamp in timestamps:
+            decode_cmd = ['ffmpeg', '-v', 'error', '-ss', f'{timestamp:.3f}', '-i', video_file,
+                          '-frames:v', '1', '-f', 'null', '-']
+            result = subprocess.run(decode_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if result.returncode != 0 or result.stderr:
+                self.logger.log(f"Compression failed: {video_file} cannot be decoded at {timestamp:.1f}s",
+                                log_level=1)
+                return False
+        return True
+
+    def decode_all(self, video_file):
+        check_cmd = ['ffmpeg', '-v', 'error', '-i', video_file, '-f', 'null', '-']
+        result = subprocess.run(check_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            self.logger.log(f"Compression failed: {video_file} is not a valid video.", log_level=1)
+            return False
+        return True
+
+    def verify_archive(self, archive_file, expected_frames):
+        try:
+            with open_tar(archive_file) as archive:
+                if self.level == "header":
+                    return archive.next() is not None
+                n_frames = sum(1 for member in archive if member.name.endswith(".jpg"))
+        except Exception as e:
+            # tarfile.TarError, OSError, or zstandard.ZstdError for a corrupted .tar.zst
+            self.logger.log(f"Compression failed: {archive_file} is not a valid archive ({e})", log_level=1)
+            return False
+
+        if expected_frames is not None and n_frames != expected_frames:
+            self.logger.log(f"Compression failed: {archive_file} has {n_frames} frames, "
+                            f"{expected_frames} expected.", log_level=1)
+            return False
+        return True
@@ -0,0 +1,223 @@
+import threading
+import time
+
+from multiprocessing import Process, Queue
+from queue import Empty
+
+
+class CompressionJob:
+    """
+    Book-keeping for one part handed to the CompressionWorker.
+
+    :param job_id: Sequential identifier of the job.
+    :type job_id: int
+    :param folder_name: Path of the part folder to compress.
+    :type folder_name: str
+    :param format: Output format ("mkv", "ffv1", "tzst" or "tgz").
+    :type format: str
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, job_id, folder_name, format):
+        self.job_id = job_id
+        self.folder_name = folder_name
+        self.format = format
+        self.state = CompressionJob.QUEUED
+        self.submit_time = time.time()
+        self.start_time = None
+        self.end_time = None
+
+    def is_finished(self):
+        return self.state in (CompressionJob.DONE, CompressionJob.FAILED)
+
+    def __repr__(self):
+        return f"CompressionJob({self.job_id}, {self.folder_name}, {self.state})"
+
+
+class CompressionWorker:
+    """
+    Long-lived compression service.
+
+    A fixed number of worker processes is started once and fed from a queue of parts, so
+    that at most ``max_concurrent`` compressions run at the same time while the camera is
+    capturing. The job states are reported back to the parent process by a collector
+    thread, which allows the Recorder to know when the queue is full (backpressure) and to
+    wait for every job before shutting down.
+
+    :param task: Callable run in the worker processes as ``task(folder_name, format)``.
+        It must return True on success.
+    :param max_concurrent: Number of worker processes, i.e. concurrent compressions.
+    :type max_concurrent: int
+    :param max_pending: Maximum number of parts waiting in the queue before new
+        submissions are refused.
+    :type max_pending: int
+    :param logger: Logger instance.
+    """
+
+    def __init__(self, task, max_concurrent=1, max_pending=4, logger=None):
+        self.task = task
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_pending = max(1, max_pending)
+        self.logger = logger
+
+        self.jobs = {}
+        self.next_job_id = 0
+        self.jobs_lock = threading.Condition()
+
+        self.job_queue = None
+        self.result_queue = None
+        self.workers = []
+        self.collector_thread = None
+        self.running = False
+
+    def start(self):
+        """
+        Start the worker processes and the collector thread. Called lazily on the first
+        submission so that the workers inherit the fully initialized uploader.
+        """
+        if self.running:
+            return
+
+        self.job_queue = Queue()
+        self.result_queue = Queue()
+
+        for _ in range(self.max_concurrent):
+            worker = Process(target=self._worker_loop, args=(self.job_queue, self.result_queue), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+        self.collector_thread = threading.Thread(target=self._collect_results, daemon=True)
+        self.running = True
+        self.collector_thread.start()
+
+        self.logger.log(f"Compression worker started with {self.max_concurrent} process(es)", log_level=5)
+
+    def _worker_loop(self, job_queue, result_queue):
+        while True:
+            item = job_queue.get()
+            if item is None:
+                break
+
+            job_id, folder_name, format = item
+            result_queue.put((job_id, CompressionJob.RUNNING, time.time()))
+            try:
+                ok = self.task(folder_name, format)
+            except Exception as e:
+                self.logger.log(f"Compression job {job_id} for {folder_name} raised: {e}", log_level=1)
+                ok = False
+
+            state = CompressionJob.DONE if ok else CompressionJob.FAILED
+            result_queue.put((job_id, state, time.time()))
+
+    def _collect_results(self):
+        while self.running or self.count_unfinished() > 0:
+            try:
+                job_id, state, timestamp = self.result_queue.get(timeout=1)
+            except Empty:
+                if not any(worker.is_alive() for worker in self.workers):
+                    self._fail_unfinished_jobs("all compression workers died")
+                    return
+                continue
+
+            with self.jobs_lock:
+                job = self.jobs[job_id]
+                job.state = state
+                if state == CompressionJob.RUNNING:
+                    job.start_time = timestamp
+                else:
+                    job.end_time = timestamp
+                self.jobs_lock.notify_all()
+
+            if job.is_finished():
+                self.logger.log(f"Compression job {job_id} ({job.folder_name}) {state} "
+                                f"in {job.end_time - job.start_time:.1f}s", log_level=3)
+
+    def _fail_unfinished_jobs(self, reason):
+        with self.jobs_lock:
+            for job in self.jobs.values():
+                if not job.is_finished():
+                    job.state = CompressionJob.FAILED
+                    self.logger.log(f"Compression job {job.job_id} ({job.folder_name}) failed: {reason}",
+                                    log_level=1)
+            self.jobs_lock.notify_all()
+
+    def count_jobs(self, state):
+        with self.jobs_lock:
+            return sum(1 for job in self.jobs.values() if job.state == state)
+
+    def count_unfinished(self):
+        with self.jobs_lock:
+            return sum(1 for job in self.jobs.values() if not job.is_finished())
+
+    def is_backlogged(self):
+        """
+        :return: True if the number of queued parts reached ``max_pending``.
+        :rtype: bool
+        """
+        return self.count_jobs(CompressionJob.QUEUED) >= self.max_pending
+
+    def submit(self, folder_name, format, block=False):
+        """
+        Queue a part for compression.
+
+        :param folder_name: Path of the part folder.
+        :param format: Output format.
+        :param block: If True, wait for a free slot in the queue instead of refusing the part.
+        :return: The CompressionJob, or None if the queue is full and block is False.
+        """
+        self.start()
+
+        with self.jobs_lock:
+            while self.count_jobs(CompressionJob.QUEUED) >= self.max_pending:
+                if not block:
+                    self.logger.log(f"Compression queue full, {folder_name} not queued", log_level=2)
+                    return None
+                self.jobs_lock.wait(timeout=1)
+
+            job = CompressionJob(self.next_job_id, folder_name, format)
+            self.jobs[job.job_id] = job
+            self.next_job_id += 1
+
+        self.job_queue.put((job.job_id, folder_name, format))
+        self.logger.log(f"Queued compression job {job.job_id} for {folder_name} "
+                        f"({self.count_unfinished()} unfinished)", log_level=5)
+        return job
+
+    def drain(self, timeout=None):
+        """
+        Wait until every submitted job is finished.
+
+        :param timeout: Maximum time to wait in seconds, or None to wait forever.
+        :return: True if all jobs are finished.
+        :rtype: bool
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.jobs_lock:
+            while any(not job.is_finished() for job in self.jobs.values()):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.jobs_lock.wait(timeout=1 if remaining is None else min(1, remaining))
+        return True
+
+    def stop(self):
+        """Drain the queue, then terminate the worker processes."""
+        if not self.running:
+            return
+
+        self.drain()
+        self.running = False
+
+        for _ in self.workers:
+            self.job_queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+
+        self.workers = []
+        self.logger.log("Compression worker stopped", log_level=5)
@@ -0,0 +1,134 @@
+import os
+from collections import deque
+
+import psutil
+
+from src.utils import get_most_available_core, set_affinity
+
+
+class CPUPlacement:
+    """
+    CPU placement policy separating the capture from the background work.
+
+    - Capture: the camera process (all its threads) and the Recorder loop run on the reserved
+      ``capture_cores``, with the highest best-effort I/O priority.
+    - Workers: compression (ffmpeg, tar), analysis and uploads are confined to the other cores,
+      and ffmpeg gets one thread per worker core.
+
+    When disabled, nothing is pinned and the worker thread count keeps its default.
+
+    :param enabled: Apply the policy.
+    :param capture_cores: Cores reserved for the capture. Defaults to the most available core at startup.
+    :param worker_cores: Cores of the background work. Defaults to all the other cores.
+    :param logger: Logger instance.
+    """
+
+    def __init__(self, enabled=False, capture_cores=None, worker_cores=None, logger=None):
+        self.enabled = enabled
+        self.logger = logger
+
+        all_cores = sorted(os.sched_getaffinity(0))
+        if not enabled:
+            self.capture_cores, self.worker_cores = all_cores, all_cores
+            return
+
+        if not capture_cores:
+            capture_cores = [get_most_available_core()]
+        self.capture_cores = sorted(core for core in capture_cores if core in all_cores)
+        if worker_cores:
+            self.worker_cores = sorted(core for core in worker_cores if core in all_cores)
+        else:
+            self.worker_cores = [core for core in all_cores if core not in self.capture_cores]
+
+        if not self.capture_cores or not self.worker_cores:
+            self.logger.log(f"Cannot split cores {all_cores} between capture ({capture_cores}) and workers, "
+                            f"CPU placement disabled", log_level=2)
+            self.enabled = False
+            self.capture_cores, self.worker_cores = all_cores, all_cores
+            return
+
+        self.logger.log(f"CPU placement: capture on cores {self.capture_cores}, "
+                        f"compression and uploads on cores {self.worker_cores}", log_level=3)
+
+    @classmethod
+    def from_parameters(cls, parameters, logger=None):
+        return cls(enabled=parameters.get("cpu_placement", False),
+                   capture_cores=parameters.get("cpu_capture_cores"),
+                   worker_cores=parameters.get("cpu_worker_cores"),
+                   logger=logger)
+
+    def apply_capture(self, pid=None, all_threads=True):
+        """
+        Pin a capture process to the reserved cores and raise its I/O priority.
+
+        :param pid: Process to pin, defaults to the current one.
+        :param all_threads: Pin every thread of the process (the affinity of a process only sets the
+            one of its main thread, the threads it already started keep theirs). If False, only the
+            calling thread is pinned, e.g. the Recorder loop without its helper threads.
+        """
+        if not self.enabled:
+            return
+        try:
+            if all_threads:
+                process = psutil.Process(pid)
+                for thread in process.threads():
+                    set_affinity(thread.id, self.capture_cores, self.logger)
+            else:
+                set_affinity(0, self.capture_cores, self.logger)
+            psutil.Process(pid).ionice(psutil.IOPRIO_CLASS_BE, value=0)
+        except (psutil.Error, OSError) as e:
+            self.logger.log(f"Cannot apply capture placement to process {pid}: {e}", log_level=2)
+
+    def apply_worker(self, pid=None):
+        """
+        Confine a background process (compression, analysis, upload) to the worker cores. The
+        processes it starts inherit the affinity.
+        """
+        if not self.enabled:
+            return
+        try:
+            set_affinity(pid if pid is not None else 0, self.worker_cores, self.logger)
+        except OSError as e:
+            self.logger.log(f"Cannot apply worker placement to process {pid}: {e}", log_level=2)
+
+    def get_worker_threads(self, default=4):
+        """Number of encoder threads: one per worker core when the policy is enabled."""
+        return len(self.worker_cores) if self.enabled else default
+
+
+class LatenessStats:
+    """
+    Statistics of the capture lateness (delay of each frame with respect to its schedule), to
+    compare recordings with and without CPU placement.
+
+    :param window: Number of recent delays kept for the percentiles.
+    """
+
+    def __init__(self, window=10000, late_threshold=0.005):
+        self.late_threshold = late_threshold
+        self.count = 0
+        self.late = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=window)
+
+    def record(self, delay):
+        delay = max(delay, 0.0)
+        self.count += 1
+        self.total += delay
+        self.max = max(self.max, delay)
+        if delay > self.late_threshold:
+            self.late += 1
+        self.recent.append(delay)
+
+    def percentile(self, q):
+        if not self.recent:
+            return 0.0
+        delays = sorted(self.recent)
+        return delays[min(len(delays) - 1, int(q / 100 * len(delays)))]
+
+    def summary(self):
+        mean = self.total / self.count if self.count else 0.0
+        return (f"{self.count} frames, {self.late} late, mean {mean * 1000:.1f} ms, "
+                f"p95 {self.percentile(95) * 1000:.1f} ms, p99 {self.percentile(99) * 1000:.1f} ms, "
+                f"max {self.max * 1000:.1f} ms")
@@ -0,0 +1,157 @@
+import math
+
+from multiprocessing import Array
+
+
+class EncoderTuner:
+    """
+    Adapts the x264 preset and thread count to the measured encode throughput, so that encoding a
+    part takes less than ``target_fraction`` of the time needed to capture it. Otherwise the
+    compression backlog grows without bound.
+
+    After each part, the encode time is compared to the capture duration of the part:
+
+    - above the target, the next preset is faster, then threads are added once the fastest preset is reached;
+    - under half of the target, extra threads are removed first, then the preset goes back toward
+      the configured one (which is never exceeded, it sets the quality).
+
+    The tuner also fits ``encode_time = overhead + n_frames * cost_per_frame`` on the recent parts
+    encoded with the current settings, to suggest a part size amortizing the fixed overhead.
+
+    The state lives in shared memory, so the decisions are common to all the compression workers.
+
+    :param frame_interval: Time between two frames in seconds.
+    :param target_fraction: Maximum encode time, as a fraction of the capture duration of a part.
+    :param preset: Configured preset, the slowest one used.
+    :param threads: Configured number of threads.
+    :param max_threads: Maximum number of threads.
+    :param adaptive: If False, the configured settings are always used (the throughput is still logged).
+    :param logger: Logger instance.
+    """
+
+    PRESETS = ("ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow")
+
+    # Indices in the shared state
+    PRESET, THREADS, N_SAMPLES = range(3)
+    WINDOW = 8  # Number of parts used for the fit
+    SAMPLES = 3  # Start of the ring buffer of (n_frames, encode_time) samples
+
+    def __init__(self, frame_interval, target_fraction=0.5, preset="veryfast", threads=4, max_threads=4,
+                 adaptive=True, logger=None):
+        self.frame_interval = frame_interval
+        self.target_fraction = target_fraction
+        self.adaptive = adaptive
+        self.logger = logger
+
+        self.base_preset = self.PRESETS.index(preset) if preset in self.PRESETS else self.PRESETS.index("veryfast")
+        self.base_threads = max(1, threads)
+        self.max_threads = max(self.base_threads, max_threads)
+
+        self.state = Array('d', [self.base_preset, self.base_threads, 0] + [0.0] * (2 * self.WINDOW))
+
+    def set_threads(self, threads, max_threads):
+        """Set the configured and maximum thread counts, e.g. from the CPU placement policy."""
+        self.base_threads = max(1, threads)
+        self.max_threads = max(self.base_threads, max_threads)
+        with self.state.get_lock():
+            self.state[self.THREADS] = self.base_threads
+
+    def get_settings(self):
+        """:return: (preset, threads) to use for the next part."""
+        with self.state.get_lock():
+            return self.PRESETS[int(self.state[self.PRESET])], int(self.state[self.THREADS])
+
+    def record(self, n_frames, encode_time):
+        """
+        Record the encode time of a part and adapt the settings for the next ones.
+        """
+        if n_frames <= 0:
+            return
+
+        part_duration = n_frames * self.frame_interval
+        ratio = encode_time / part_duration if part_duration > 0 else float('inf')
+        preset, threads = self.get_settings()
+        self.logger.log(f"Encoded {n_frames} frames in {encode_time:.1f}s ({n_frames / max(encode_time, 1e-3):.1f} fps, "
+                        f"{ratio:.0%} of the part duration) with preset {preset}, {threads} thread(s)", log_level=3)
+
+        with self.state.get_lock():
+            index = int(self.state[self.N_SAMPLES]) % self.WINDOW
+            self.state[self.SAMPLES + 2 * index] = n_frames
+            self.state[self.SAMPLES + 2 * index + 1] = encode_time
+            self.state[self.N_SAMPLES] += 1
+
+            if not self.adaptive:
+                return
+
+            preset_index, threads = int(self.state[self.PRESET]), int(self.state[self.THREADS])
+            if ratio > self.target_fraction:
+                if preset_index > 0:
+                    preset_index -= 1
+                elif threads < self.max_threads:
+                    threads += 1
+            elif ratio < self.target_fraction / 2:
+                if threads > self.base_threads:
+                    threads -= 1
+                elif preset_index < self.base_preset:
+                    preset_index += 1
+
+            if (preset_index, threads) == (int(self.state[self.PRESET]), int(self.state[self.THREADS])):
+                if ratio > self.target_fraction:
+                    self.logger.log(f"Encoding takes {ratio:.0%} of the part duration with the fastest settings, "
+                                    f"compression will lag behind capture", log_level=2)
+                return
+
+            self.state[self.PRESET] = preset_index
+            self.state[self.THREADS] = threads
+            # The samples measured with the previous settings do not describe the new ones
+            self.state[self.N_SAMPLES] = 0
+
+        self.logger.log(f"Encoder settings changed to preset {self.PRESETS[preset_index]}, {threads} thread(s) "
+                        f"(encode time {ratio:.0%} of the part duration, target {self.target_fraction:.0%})",
+                        log_level=3)
+
+    def fit(self):
+        """
+        :return: (overhead in seconds, cost per frame in seconds) fitted on the recent parts, or None.
+        """
+        with self.state.get_lock():
+            n_samples = min(int(self.state[self.N_SAMPLES]), self.WINDOW)
+            samples = [(self.state[self.SAMPLES + 2 * i], self.state[self.SAMPLES + 2 * i + 1])
+                       for i in range(n_samples)]
+        if not samples:
+            return None
+
+        mean_n = sum(n for n, _ in samples) / len(samples)
+        mean_t = sum(t for _, t in samples) / len(samples)
+        variance = sum((n - mean_n) ** 2 for n, _ in samples)
+        if variance == 0:
+            # All the parts have the same size: the overhead cannot be separated from the cost per frame
+            return 0.0, mean_t / mean_n
+
+        cost = sum((n - mean_n) * (t - mean_t) for n, t in samples) / variance
+        overhead = mean_t - cost * mean_n
+        if cost <= 0 or overhead < 0:
+            return 0.0, mean_t / mean_n
+        return overhead, cost
+
+    def get_part_size(self, n_frames, max_frames):
+        """
+        Suggest a part size between n_frames (the configured size) and max_frames, large enough for
+        the fixed overhead of each encode to keep it under the target fraction of the part duration.
+        """
+        model = self.fit()
+        if model is None:
+            return n_frames
+
+        overhead, cost = model
+        margin = self.target_fraction - cost / self.frame_interval
+        if margin <= 0:
+            # The cost per frame alone exceeds the target, larger parts only amortize the overhead
+            suggested = max_frames
+        else:
+            suggested = math.ceil(1.2 * overhead / (self.frame_interval * margin))
+
+        suggested = max(n_frames, min(max_frames, suggested))
+        self.logger.log(f"Encode model: {overhead:.1f}s + {cost * 1000:.1f}ms/frame, "
+                        f"part size {suggested} frames", log_level=4)
+        return suggested
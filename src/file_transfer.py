@@ -0,0 +1,313 @@
+import errno
+import os
+import time
+
+from multiprocessing import Array
+
+
+class TransferStats:
+    """
+    Summary of one file transfer.
+
+    :param source: Path of the copied file.
+    :param destination: Final path at destination.
+    :param size: Size of the file in bytes.
+    :param transferred: Bytes actually written during this transfer (less than size when resumed).
+    :param resumed_from: Offset the transfer was resumed from.
+    :param duration: Time spent copying, in seconds.
+    """
+
+    def __init__(self, source, destination, size, transferred, resumed_from, duration):
+        self.source = source
+        self.destination = destination
+        self.size = size
+        self.transferred = transferred
+        self.resumed_from = resumed_from
+        self.duration = duration
+
+    def throughput(self):
+        """:return: Throughput in MB/s."""
+        if self.duration <= 0:
+            return 0.0
+        return self.transferred / self.duration / (1024 * 1024)
+
+    def __repr__(self):
+        return (f"{self.source} -> {self.destination}: {self.transferred} bytes "
+                f"(resumed from {self.resumed_from}) in {self.duration:.2f}s, {self.throughput():.1f} MB/s")
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the upload bandwidth of the host, with an adaptive cap.
+
+    The state of the bucket lives in shared memory, so that the limit applies to all the upload
+    processes forked after its creation (compression workers, asynchronous uploads).
+
+    The cap starts at ``max_rate``. When ``pressure()`` reports that the capture is running late,
+    the cap is halved (down to ``min_rate``); otherwise it grows back by ``max_rate / 10``
+    (or by ``min_rate`` when unlimited) at each update, until ``max_rate`` is reached again.
+
+    :param max_rate: Maximum rate in bytes/s, or None for unlimited.
+    :param min_rate: Rate under which the cap is never lowered, in bytes/s.
+    :param pressure: Callable returning True while uploads should be throttled, or None.
+    :param update_period: Minimum time between two updates of the cap, in seconds.
+    """
+
+    UNLIMITED = -1.0
+
+    # Indices in the shared state
+    TOKENS, LAST_REFILL, RATE, LAST_UPDATE, MEASURED_RATE = range(5)
+
+    def __init__(self, max_rate=None, min_rate=512 * 1024, pressure=None, update_period=2.0, logger=None):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.pressure = pressure
+        self.update_period = update_period
+        self.logger = logger
+
+        rate = max_rate if max_rate is not None else self.UNLIMITED
+        self.state = Array('d', [0.0, time.time(), rate, 0.0, 0.0])
+
+    def get_rate(self):
+        """:return: Current cap in bytes/s, or None if unlimited."""
+        rate = self.state[self.RATE]
+        return None if rate == self.UNLIMITED else rate
+
+    def get_chunk_size(self, chunk_size):
+        """Limit the chunk size so that a chunk never bursts more than a quarter of a second of budget."""
+        rate = self.get_rate()
+        if rate is None:
+            return chunk_size
+        return max(64 * 1024, min(chunk_size, int(rate / 4)))
+
+    def update_rate(self, now):
+        """Adapt the cap to the pressure. Must be called with the lock of the shared state."""
+        if self.pressure is None or now - self.state[self.LAST_UPDATE] < self.update_period:
+            return
+        self.state[self.LAST_UPDATE] = now
+
+        rate = self.state[self.RATE]
+        measured_rate = self.state[self.MEASURED_RATE]
+
+        if self.pressure():
+            current = rate if rate != self.UNLIMITED else measured_rate
+            if current <= 0:
+                return
+            new_rate = max(self.min_rate, current / 2)
+        elif rate != self.UNLIMITED:
+            step = self.max_rate / 10 if self.max_rate is not None else self.min_rate
+            new_rate = rate + step
+            if self.max_rate is not None and new_rate >= self.max_rate:
+                new_rate = self.max_rate
+            elif self.max_rate is None and new_rate >= measured_rate:
+                new_rate = self.UNLIMITED
+        else:
+            return
+
+        if new_rate != rate:
+            self.state[self.RATE] = new_rate
+            if self.logger is not None:
+                self.logger.log(f"Upload bandwidth cap set to "
+                                f"{'unlimited' if new_rate == self.UNLIMITED else f'{new_rate / 1024 / 1024:.2f} MB/s'}",
+                                log_level=4)
+
+    def consume(self, n_bytes):
+        """
+        Reserve n_bytes in the bucket and wait until they can be sent.
+        """
+        with self.state.get_lock():
+            now = time.time()
+            self.update_rate(now)
+
+            rate = self.state[self.RATE]
+            if rate == self.UNLIMITED:
+                self.state[self.LAST_REFILL] = now
+                return
+
+            # Refill the bucket, keeping at most one second of budget
+            tokens = min(rate, self.state[self.TOKENS] + (now - self.state[self.LAST_REFILL]) * rate)
+            self.state[self.LAST_REFILL] = now
+            self.state[self.TOKENS] = tokens - n_bytes
+            wait = -self.state[self.TOKENS] / rate
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def record_throughput(self, n_bytes, duration):
+        if duration > 0:
+            self.state[self.MEASURED_RATE] = n_bytes / duration
+
+
+class ChunkedCopier:
+    """
+    In-process file copy engine for the mounted remote directory.
+
+    The file is copied in large chunks with ``copy_file_range`` (kernel-side copy), falling
+    back to ``sendfile`` and then to plain read/write when the filesystems do not support it.
+    Data is written to ``<destination>.partial`` and renamed atomically once complete, so a
+    dropped connection never leaves a truncated file under the final name. A later call
+    resumes from the end of the partial file, after checking that its last chunk matches the
+    source.
+
+    :param chunk_size: Size of the chunks in bytes.
+    :type chunk_size: int
+    :param logger: Logger instance.
+    :param rate_limiter: Optional RateLimiter capping the bandwidth.
+    :param yield_to: Optional callable; while it returns True, the copy pauses between two chunks
+        (at most ``max_yield`` seconds per chunk) to give way to more urgent transfers.
+    :param max_yield: Maximum pause per chunk in seconds, so that the copy is never starved.
+    """
+
+    PARTIAL_SUFFIX = ".partial"
+
+    def __init__(self, chunk_size=8 * 1024 * 1024, logger=None, rate_limiter=None, yield_to=None, max_yield=10):
+        self.chunk_size = chunk_size
+        self.logger = logger
+        self.rate_limiter = rate_limiter
+        self.yield_to = yield_to
+        self.max_yield = max_yield
+        self.copy_method = "copy_file_range" if hasattr(os, "copy_file_range") else "sendfile"
+
+    def copy(self, source, destination):
+        """
+        Copy source to destination, resuming a previous partial copy if any.
+
+        :param source: Local file to copy.
+        :param destination: Final path of the file (e.g. in the mounted NAS).
+        :return: TransferStats of the copy.
+        :raises OSError: If the copy fails. The partial file is kept to be resumed.
+        """
+        partial_path = destination + self.PARTIAL_SUFFIX
+        size = os.path.getsize(source)
+
+        start_time = time.time()
+        with open(source, 'rb') as src:
+            offset = self.get_resume_offset(src, partial_path, size)
+            if offset > 0:
+                self.logger.log(f"Resuming upload of {source} from byte {offset}/{size}", log_level=3)
+
+            with open(partial_path, 'r+b' if offset > 0 else 'wb') as dst:
+                dst.truncate(offset)
+                self.copy_range(src, dst, offset, size)
+                dst.flush()
+                os.fsync(dst.fileno())
+
+        if os.path.getsize(partial_path) != size:
+            raise OSError(errno.EIO, f"Size mismatch after copy of {source}", partial_path)
+
+        os.replace(partial_path, destination)
+
+        stats = TransferStats(source, destination, size, size - offset, offset, time.time() - start_time)
+        self.logger.log(f"Upload done: {stats}", log_level=4)
+        return stats
+
+    def append(self, source, destination, offset, size):
+        """
+        Append the bytes [offset, size) of source to destination, e.g. the new lines of a log file
+        to its remote copy. Unlike copy, the destination is written in place.
+
+        :param offset: Current size of the destination, 0 to create it.
+        :param size: End of the range to append (the source may keep growing meanwhile).
+        :return: TransferStats of the append.
+        :raises OSError: If the destination is not offset bytes long, or if the copy fails.
+        """
+        start_time = time.time()
+        with open(source, 'rb') as src, open(destination, 'r+b' if offset > 0 else 'wb') as dst:
+            destination_size = os.fstat(dst.fileno()).st_size
+            if destination_size != offset:
+                raise OSError(errno.EIO, f"Expected {offset} bytes at destination, found {destination_size}",
+                              destination)
+            self.copy_range(src, dst, offset, size)
+            dst.flush()
+            os.fsync(dst.fileno())
+
+        return TransferStats(source, destination, size, size - offset, offset, time.time() - start_time)
+
+    def get_resume_offset(self, src, partial_path, size):
+        """
+        Find the offset to resume from: the end of the existing partial file, provided its
+        last chunk is identical to the source. Otherwise, restart from the beginning of that chunk.
+        """
+        try:
+            partial_size = os.path.getsize(partial_path)
+        except OSError:
+            return 0
+
+        if partial_size > size:
+            return 0
+
+        check_start = max(0, partial_size - self.chunk_size)
+        if partial_size == check_start:
+            return partial_size
+
+        try:
+            with open(partial_path, 'rb') as partial:
+                partial.seek(check_start)
+                remote_tail = partial.read(partial_size - check_start)
+        except OSError:
+            return 0
+
+        src.seek(check_start)
+        local_tail = src.read(partial_size - check_start)
+        src.seek(0)
+
+        if remote_tail == local_tail:
+            return partial_size
+
+        self.logger.log(f"Partial file {partial_path} does not match the source after byte {check_start}",
+                        log_level=2)
+        return check_start
+
+    def copy_range(self, src, dst, offset, size):
+        src_fd, dst_fd = src.fileno(), dst.fileno()
+
+        while offset < size:
+            chunk_size = self.chunk_size
+            if self.rate_limiter is not None:
+                chunk_size = self.rate_limiter.get_chunk_size(chunk_size)
+            count = min(chunk_size, size - offset)
+
+            self.give_way()
+
+            if self.rate_limiter is not None:
+                self.rate_limiter.consume(count)
+
+            chunk_start = time.time()
+            written = self.copy_chunk(src, dst, src_fd, dst_fd, offset, count)
+            if written == 0:
+                raise OSError(errno.EIO, f"Unexpected end of file at byte {offset}", src.name)
+            offset += written
+
+            if self.rate_limiter is not None:
+                self.rate_limiter.record_throughput(written, time.time() - chunk_start)
+
+    def give_way(self):
+        if self.yield_to is None:
+            return
+        deadline = time.time() + self.max_yield
+        while self.yield_to() and time.time() < deadline:
+            time.sleep(0.05)
+
+    def copy_chunk(self, src, dst, src_fd, dst_fd, offset, count):
+        if self.copy_method == "copy_file_range":
+            try:
+                return os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+                    raise
+                self.logger.log(f"copy_file_range not supported ({e}), using sendfile", log_level=5)
+                self.copy_method = "sendfile"
+
+        if self.copy_method == "sendfile":
+            try:
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                return os.sendfile(dst_fd, src_fd, offset, count)
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                self.logger.log(f"sendfile not supported ({e}), using read/write", log_level=5)
+                self.copy_method = "readwrite"
+
+        src.seek(offset)
+        dst.seek(offset)
+        return dst.write(src.read(count))
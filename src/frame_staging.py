@@ -0,0 +1,424 @@
+import os
+import shutil
+import threading
+import time
+
+from collections import deque
+
+from src.cpu_placement import LatenessStats
+
+
+def remove_part_folder(folder_name):
+    """
+    Remove a part folder, and the staged frames it links to if the part was encoded from RAM.
+    """
+    if os.path.islink(folder_name):
+        shutil.rmtree(os.path.realpath(folder_name), ignore_errors=True)
+        os.remove(folder_name)
+    else:
+        shutil.rmtree(folder_name, ignore_errors=True)
+
+
+def materialize_part(folder_name):
+    """
+    Replace a part folder linking to staged frames by a copy of these frames on the persistent
+    storage, e.g. to keep the frames of a part whose compression failed.
+    """
+    if not os.path.islink(folder_name):
+        return
+    staged_folder = os.path.realpath(folder_name)
+    tmp_folder = f"{folder_name}.materializing"
+    shutil.copytree(staged_folder, tmp_folder, dirs_exist_ok=True)
+    os.remove(folder_name)
+    os.rename(tmp_folder, folder_name)
+    shutil.rmtree(staged_folder, ignore_errors=True)
+
+
+class StagedPart:
+    """Frames of a part waiting in the staging area."""
+
+    def __init__(self, name):
+        self.name = name
+        self.frames = deque()  # (filename, size, time of capture)
+        self.sealed = False
+        self.linked = False  # Encoded straight from the staging area
+        self.linked_bytes = 0
+
+
+class FrameStaging:
+    """
+    Staging area of the frames in RAM (tmpfs), flushed to the persistent storage in batches.
+
+    Writing every frame straight to the SD card exposes the capture to the stalls of its write
+    cache. With staging, the camera saves the frames to ``staging_dir/partXX/`` and a flusher
+    thread, on the worker cores at the lowest priority, copies them to the part folder of the
+    recording folder in batches: when ``batch_frames`` frames are waiting, when the oldest waited
+    ``flush_interval`` seconds, or when the part is sealed for compression. The copies are synced
+    once per batch, then the staged frames are deleted. A sealed part is handed to the
+    compression once all its frames are flushed (see ``is_flushed``).
+
+    With ``direct_encode``, the frames of the current part stay in RAM. When the part is sealed,
+    its part folder becomes a link to the staged frames, which are encoded without ever being
+    written to the SD card.
+
+    The staged bytes never exceed ``ram_budget_mb``: beyond it, the frames are captured straight
+    to the part folder. In direct mode, the frames of a part that did not fit are flushed when it
+    is sealed, and the part is encoded from the SD card.
+
+    When disabled, the frames are captured to the part folder and every method is a no-op.
+
+    :param staging_dir: Folder in a tmpfs, e.g. ``/dev/shm/wormstation_staging``. None disables staging.
+    :param recording_folder: Local recording folder, where the part folders are.
+    :param ram_budget_mb: Maximum size of the staged frames.
+    :param batch_frames: Number of frames flushed together.
+    :param flush_interval: Maximum time a frame waits in RAM before being flushed, in seconds (not in direct mode).
+    :param direct_encode: Encode the parts from RAM when they fit in the budget.
+    :param cpu_placement: CPUPlacement policy applied to the flusher thread.
+    :param logger: Logger instance.
+    """
+
+    def __init__(self, staging_dir=None, recording_folder=None, ram_budget_mb=512, batch_frames=16,
+                 flush_interval=30, direct_encode=False, cpu_placement=None, logger=None):
+        self.enabled = staging_dir is not None
+        self.staging_dir = staging_dir
+        self.recording_folder = recording_folder
+        self.ram_budget = ram_budget_mb * 1024 * 1024
+        self.batch_frames = batch_frames
+        self.flush_interval = flush_interval
+        self.direct_encode = direct_encode
+        self.cpu_placement = cpu_placement
+        self.logger = logger
+
+        self.parts = {}
+        self.staged_bytes = 0
+        self.last_frame_size = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.flushed = threading.Condition(self.lock)
+        self.stop_event = threading.Event()
+        self.flusher = None
+
+        # Flush statistics
+        self.latency = LatenessStats(late_threshold=flush_interval)
+        self.n_batches = 0
+        self.n_bypassed = 0
+        self.flushed_bytes = 0
+        self.flush_time = 0.0
+        self.peak_bytes = 0
+
+    @classmethod
+    def from_parameters(cls, recording_folder, parameters, cpu_placement=None, logger=None):
+        return cls(staging_dir=parameters.get("staging_dir"),
+                   recording_folder=recording_folder,
+                   ram_budget_mb=parameters.get("staging_ram_mb", 512),
+                   batch_frames=parameters.get("staging_batch_frames", 16),
+                   flush_interval=parameters.get("staging_flush_interval_s", 30),
+                   direct_encode=parameters.get("staging_direct_encode", False),
+                   cpu_placement=cpu_placement,
+                   logger=logger)
+
+    def get_part_folder(self, part):
+        return os.path.join(self.recording_folder, part)
+
+    def salvage(self):
+        """
+        Move the frames left in the staging area by a previous session to its part folders, so that
+        they are recovered with the rest of the parts (see RecoveryService). Called before the
+        recovery scan.
+        """
+        if not self.enabled:
+            return
+        for name in os.listdir(self.recording_folder):
+            part_folder = self.get_part_folder(name)
+            if os.path.islink(part_folder) and not os.path.exists(part_folder):
+                # The staging area did not survive a reboot
+                self.logger.log(f"Frames of {name} were lost with the staging area", log_level=1)
+                os.remove(part_folder)
+        if not os.path.isdir(self.staging_dir):
+            return
+
+        n_frames = 0
+        for part in sorted(os.listdir(self.staging_dir)):
+            staged_folder = os.path.join(self.staging_dir, part)
+            part_folder = self.get_part_folder(part)
+            if os.path.islink(part_folder):
+                materialize_part(part_folder)
+                continue
+            os.makedirs(part_folder, exist_ok=True)
+            for filename in os.listdir(staged_folder):
+                shutil.copyfile(os.path.join(staged_folder, filename), os.path.join(part_folder, filename))
+                n_frames += 1
+            shutil.rmtree(staged_folder, ignore_errors=True)
+        if n_frames:
+            self.logger.log(f"Moved {n_frames} frame(s) left in {self.staging_dir} to the recording folder",
+                            log_level=2)
+
+    def start(self):
+        if not self.enabled:
+            return
+        os.makedirs(self.staging_dir, exist_ok=True)
+        self.stop_event.clear()
+        self.flusher = threading.Thread(target=self.run_flusher, daemon=True)
+        self.flusher.start()
+        self.logger.log(f"Staging frames in {self.staging_dir} (budget {self.ram_budget / 1e6:.0f} MB, "
+                        f"{'direct encode' if self.direct_encode else f'batches of {self.batch_frames} frames'})",
+                        log_level=3)
+
+    def get_ram_usage(self):
+        """:return: Bytes of the staged frames, including the parts encoded from RAM."""
+        return self.staged_bytes + sum(part.linked_bytes for part in self.parts.values())
+
+    def get_capture_path(self, save_path):
+        """
+        :param save_path: Final path of the frame, in its part folder.
+        :return: Path where the camera saves the frame: in the staging area, or the final path if
+            staging is disabled or the RAM budget is reached.
+        """
+        if not self.enabled or save_path is None:
+            return save_path
+        # Only the frames of part folders are staged: a recording without parts is never sealed
+        if os.path.dirname(save_path) == os.path.abspath(self.recording_folder):
+            return save_path
+
+        part = os.path.basename(os.path.dirname(save_path))
+        with self.lock:
+            fits = self.get_ram_usage() + 2 * self.last_frame_size <= self.ram_budget
+        try:
+            stats = os.statvfs(self.staging_dir)
+            fits = fits and stats.f_bavail * stats.f_frsize > 2 * self.last_frame_size
+        except OSError:
+            fits = False
+
+        if not fits:
+            self.n_bypassed += 1
+            if self.n_bypassed == 1 or self.n_bypassed % 100 == 0:
+                self.logger.log(f"Staging RAM budget reached, {self.n_bypassed} frame(s) saved directly "
+                                f"to the persistent storage", log_level=2)
+            return save_path
+
+        staged_folder = os.path.join(self.staging_dir, part)
+        os.makedirs(staged_folder, exist_ok=True)
+        return os.path.join(staged_folder, os.path.basename(save_path))
+
+    def frame_saved(self, capture_path, save_path):
+        """
+        Register a frame saved by the camera to the staging area.
+        """
+        if not self.enabled or capture_path is None or capture_path == save_path:
+            return
+        try:
+            size = os.path.getsize(capture_path)
+        except OSError:
+            return
+
+        part = os.path.basename(os.path.dirname(save_path))
+        with self.lock:
+            staged_part = self.parts.setdefault(part, StagedPart(part))
+            staged_part.frames.append((os.path.basename(capture_path), size, time.time()))
+            self.staged_bytes += size
+            self.last_frame_size = size
+            self.peak_bytes = max(self.peak_bytes, self.get_ram_usage())
+            if not self.direct_encode and len(staged_part.frames) >= self.batch_frames:
+                self.wakeup.set()
+
+    def seal_part(self, part):
+        """
+        Mark a part as complete: its frames are flushed (or linked) right away.
+        """
+        if not self.enabled:
+            return
+        part = os.path.basename(os.path.normpath(part))
+        with self.lock:
+            self.parts.setdefault(part, StagedPart(part)).sealed = True
+        self.wakeup.set()
+
+    def is_flushed(self, part):
+        """:return: True if the part can be compressed: every frame is in its part folder (or linked)."""
+        if not self.enabled:
+            return True
+        part = os.path.basename(os.path.normpath(part))
+        with self.lock:
+            staged_part = self.parts.get(part)
+            return staged_part is None or staged_part.linked or not staged_part.frames
+
+    def wait_flushed(self, timeout=None):
+        """Wait until every sealed part can be compressed."""
+        if not self.enabled:
+            return True
+        self.wakeup.set()
+        with self.flushed:
+            return self.flushed.wait_for(lambda: all(part.linked or not part.frames
+                                                     for part in self.parts.values() if part.sealed), timeout)
+
+    def run_flusher(self):
+        # Same policy as the other background work: worker cores, lowest CPU priority
+        thread_id = threading.get_native_id()
+        if self.cpu_placement is not None:
+            self.cpu_placement.apply_worker(thread_id)
+        try:
+            os.setpriority(os.PRIO_PROCESS, thread_id, 19)
+        except OSError:
+            pass
+
+        while not self.stop_event.is_set():
+            self.wakeup.wait(min(self.flush_interval, 5))
+            self.wakeup.clear()
+            try:
+                self.flush(force=False)
+            except OSError as e:
+                self.logger.log(f"Flush of the staged frames failed: {e}", log_level=1)
+                self.stop_event.wait(5)
+
+    def flush(self, force=False):
+        """
+        Flush the frames that are due, or all of them if force is set.
+        """
+        now = time.time()
+        with self.lock:
+            parts = list(self.parts.values())
+
+        for part in parts:
+            self.release_linked(part)
+
+            with self.lock:
+                if part.linked or not part.frames:
+                    continue
+                n_staged = len(part.frames)
+                oldest = part.frames[0][2]
+
+            if part.sealed and self.direct_encode and not force and self.link(part):
+                continue
+
+            due = force or part.sealed or (not self.direct_encode and
+                                           (n_staged >= self.batch_frames or now - oldest >= self.flush_interval))
+            if not due:
+                continue
+
+            while True:
+                with self.lock:
+                    batch = list(part.frames)[:self.batch_frames]
+                if not batch:
+                    break
+                self.flush_batch(part, batch)
+
+            if part.sealed:
+                with self.lock:
+                    self.parts.pop(part.name, None)
+                try:
+                    os.rmdir(os.path.join(self.staging_dir, part.name))
+                except OSError:
+                    pass
+
+        with self.flushed:
+            self.flushed.notify_all()
+
+    def flush_batch(self, part, batch):
+        """Copy a batch of frames to the part folder, sync them once, then free the RAM."""
+        start_time = time.time()
+        staged_folder = os.path.join(self.staging_dir, part.name)
+        part_folder = self.get_part_folder(part.name)
+        os.makedirs(part_folder, exist_ok=True)
+
+        copies = []
+        for filename, size, _ in batch:
+            destination = os.path.join(part_folder, filename)
+            shutil.copyfile(os.path.join(staged_folder, filename), destination)
+            copies.append(destination)
+        for destination in copies:
+            fd = os.open(destination, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        now = time.time()
+        n_bytes = 0
+        for filename, size, capture_time in batch:
+            os.remove(os.path.join(staged_folder, filename))
+            self.latency.record(now - capture_time)
+            n_bytes += size
+        self.repoint_last_frame(staged_folder, part_folder, [filename for filename, _, _ in batch])
+
+        with self.lock:
+            for _ in batch:
+                part.frames.popleft()
+            self.staged_bytes -= n_bytes
+            self.n_batches += 1
+            self.flushed_bytes += n_bytes
+            self.flush_time += now - start_time
+
+        self.logger.log(f"Flushed {len(batch)} frame(s) of {part.name} ({n_bytes / 1e6:.1f} MB) in "
+                        f"{now - start_time:.2f}s", log_level=5)
+
+    def link(self, part):
+        """
+        Replace the part folder by a link to the staged frames, if none of them was written to it.
+
+        :return: True if the part is linked.
+        """
+        part_folder = self.get_part_folder(part.name)
+        try:
+            if os.path.isdir(part_folder) and os.listdir(part_folder):
+                return False
+            if os.path.isdir(part_folder):
+                os.rmdir(part_folder)
+            os.symlink(os.path.join(self.staging_dir, part.name), part_folder)
+        except OSError as e:
+            self.logger.log(f"Cannot link {part_folder} to the staged frames, flushing them: {e}", log_level=2)
+            return False
+
+        with self.lock:
+            part.linked = True
+            part.linked_bytes = sum(size for _, size, _ in part.frames)
+            self.staged_bytes -= part.linked_bytes
+            part.frames.clear()
+        self.logger.log(f"{part.name} encoded from RAM ({part.linked_bytes / 1e6:.0f} MB)", log_level=4)
+        return True
+
+    def release_linked(self, part):
+        """Forget a part encoded from RAM once the compression removed its staged frames."""
+        if part.linked and not os.path.exists(os.path.join(self.staging_dir, part.name)):
+            with self.lock:
+                self.parts.pop(part.name, None)
+
+    @staticmethod
+    def repoint_last_frame(staged_folder, part_folder, filenames):
+        """Point the link to the last frame, created by the camera, to the flushed copy."""
+        # Same link as Camera.create_symlink_to_last_frame
+        link = f"/home/{os.getlogin()}/tmp/last_frame.jpg"
+        try:
+            target = os.readlink(link)
+        except OSError:
+            return
+        if os.path.dirname(target) == staged_folder and os.path.basename(target) in filenames:
+            tmp_link = f"{link}.tmp"
+            os.symlink(os.path.join(part_folder, os.path.basename(target)), tmp_link)
+            os.replace(tmp_link, link)
+
+    def get_summary(self):
+        rate = self.flushed_bytes / 1e6 / self.flush_time if self.flush_time > 0 else 0.0
+        return (f"{self.n_batches} batch(es), {self.flushed_bytes / 1e6:.0f} MB at {rate:.1f} MB/s, "
+                f"peak {self.peak_bytes / 1e6:.0f} MB in RAM, {self.n_bypassed} frame(s) over budget, "
+                f"flush latency: {self.latency.summary()}")
+
+    def stop(self):
+        """
+        Stop the flusher and save every staged frame, including the parts encoded from RAM, to the
+        persistent storage.
+        """
+        if not self.enabled or self.stop_event.is_set():
+            return
+        self.stop_event.set()
+        self.wakeup.set()
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flusher = None
+
+        try:
+            self.flush(force=True)
+            for part in list(self.parts.values()):
+                if part.linked and os.path.exists(os.path.join(self.staging_dir, part.name)):
+                    materialize_part(self.get_part_folder(part.name))
+        except OSError as e:
+            self.logger.log(f"Cannot save the staged frames: {e}", log_level=1)
+        self.logger.log(f"Frame staging: {self.get_summary()}", log_level=3)
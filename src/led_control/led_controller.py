@@ -1,3 +1,4 @@
+import math
 import time
 import threading
 from pyftdi.spi import SpiController
@@ -17,6 +18,8 @@ from src.led_control.usb_handler import USBHandler
 class LightController:
     """Class to control the LEDs using the FT232H chip."""
 
+    IR_PULSE_MARGIN = 0.1  # Minimum time between the end of an IR pulse and the next one, in seconds
+    IR_LEAD = 0.25  # The IR pulses start 0.25 s before the frames (see LED.run_led_timer)
 
     def __init__(self, parameters=None, logger=None, empty=False, keep_final_state=False, enable_legacy_gpio_mode=False):
         """
@@ -34,6 +37,8 @@ class LightController:
         self.spi_controller = None
         self.leds_lock = threading.Lock()
         self.legacy_gpio_mode = False
+        self.ir_period = None  # IR illumination program, set by start
+        self.ir_pulse = 0
 
         # Start asynchronous initialization in a separate thread
         init_thread = threading.Thread(target=self.initialize, args=(empty,keep_final_state,enable_legacy_gpio_mode,))
@@ -95,10 +100,26 @@ class LightController:
             self.logger.log("LightController initialization complete.", log_level=5)
             self.initialized.set()  # Signal that initialization is complete
 
-    def start(self):
+    def start(self, ir_period=None):
+        """
+        Start the illumination and optogenetic programs of the LEDs.
+
+        :param ir_period: Period of the IR pulses, time_interval by default. The adaptive frame
+            rate lights every slot of its fast rate (see AdaptiveFrameRate).
+        """
 
-        self["IR"].run_led_timer(duration=self.parameters["illumination_pulse"] / 1000,
-                                        period=self.parameters["time_interval"],
+        ir_period = ir_period or self.parameters["time_interval"]
+        ir_pulse = self.parameters["illumination_pulse"] / 1000
+        # The timer waits for the next activation after the pulse: a pulse as long as the period
+        # would miss every other one
+        if ir_pulse > ir_period - self.IR_PULSE_MARGIN:
+            ir_pulse = max(ir_period - self.IR_PULSE_MARGIN, ir_period / 2)
+            self.logger.log(f"illumination_pulse too long for IR pulses every {ir_period}s, "
+                            f"shortened to {ir_pulse * 1000:.0f}ms", log_level=2)
+
+        self.ir_period, self.ir_pulse = ir_period, ir_pulse
+        self["IR"].run_led_timer(duration=ir_pulse,
+                                        period=ir_period,
                                         timeout=self.parameters["timeout"])
 
 
@@ -126,6 +147,16 @@ class LightController:
 
 
 
+    def get_ir_dark_window(self, t):
+        """
+        :return: Start and end of the time without pulse of the IR illumination program, at or
+            after t (from t on if the program is not running).
+        """
+        if not self.ir_period:
+            return t, float('inf')
+        pulse_start = math.floor((t + self.IR_LEAD) / self.ir_period) * self.ir_period - self.IR_LEAD
+        return max(t, pulse_start + self.ir_pulse), pulse_start + self.ir_period
+
     def wait_until_ready(self):
         """Block until initialization is complete."""
         self.initialized.wait()
@@ -99,6 +99,16 @@ class Logger:
 
 
 class FakeLogger:
-    def log(self, message, log_level=1):
-        print(f"[LOG - Level {log_level}]: {message}")
+    """
+    Logger printing to the standard output, for the scripts and tools run by hand.
+
+    :param max_level: Highest log level printed, or None to print all the messages.
+    """
+
+    def __init__(self, max_level=None):
+        self.max_level = max_level
+
+    def log(self, message, log_level=1, **kwargs):
+        if self.max_level is None or log_level <= self.max_level:
+            print(f"[LOG - Level {log_level}]: {message}")
 
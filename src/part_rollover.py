@@ -0,0 +1,86 @@
+import time
+
+
+class PartRollover:
+    """
+    Policy deciding when the current part is closed and handed to the compression.
+
+    A part is closed after its last frame when any of the configured limits would be exceeded by
+    the next frame:
+
+    - ``max_frames``: number of frames (the ``compress`` parameter);
+    - ``max_seconds``: wall time since the first frame of the part, so that the latency from
+      capture to the remote storage does not depend on the frame rate;
+    - ``max_mb``: bytes of the frames, so that the parts have a similar size whatever the scene;
+    - ``split_on_pause``: in time-lapse mode, the last frame before a pause closes the part, which
+      is then uploaded during the pause instead of after it.
+
+    Parts are used as soon as one limit is set.
+
+    :param max_frames: Maximum number of frames of a part, 0 for no limit.
+    :param max_seconds: Maximum duration of a part in seconds, None for no limit.
+    :param max_mb: Maximum size of the frames of a part in MB, None for no limit.
+    :param split_on_pause: Close the part before each pause.
+    :param time_interval: Time between two frames, in seconds.
+    :param logger: Logger instance.
+    """
+
+    def __init__(self, max_frames=0, max_seconds=None, max_mb=None, split_on_pause=False, time_interval=1,
+                 logger=None):
+        self.max_frames = max_frames
+        self.max_seconds = max_seconds
+        self.max_bytes = max_mb * 1024 * 1024 if max_mb else None
+        self.split_on_pause = split_on_pause
+        self.time_interval = time_interval
+        self.logger = logger
+
+        self.n_frames = 0
+        self.n_bytes = 0
+        self.start_time = None
+
+    @classmethod
+    def from_parameters(cls, parameters, logger=None):
+        return cls(max_frames=parameters["compress"],
+                   max_seconds=parameters.get("part_max_s"),
+                   max_mb=parameters.get("part_max_mb"),
+                   split_on_pause=parameters.get("part_split_on_pause", False),
+                   time_interval=parameters["time_interval"],
+                   logger=logger)
+
+    def is_enabled(self):
+        return self.max_frames > 0 or bool(self.max_seconds) or bool(self.max_bytes) or self.split_on_pause
+
+    def start_part(self):
+        self.n_frames = 0
+        self.n_bytes = 0
+        self.start_time = None
+
+    def add_frame(self, n_bytes):
+        """Account for a frame saved to the current part."""
+        if self.start_time is None:
+            self.start_time = time.time()
+        self.n_frames += 1
+        self.n_bytes += n_bytes
+
+    def get_reason(self, frames_in_part, before_pause=False):
+        """
+        :param frames_in_part: Number of frames of the current part, including the last one.
+        :param before_pause: True if the next frame is after a pause.
+        :return: Name of the limit closing the part after the current frame ("frames", "time",
+            "bytes" or "pause"), or None to go on with the part.
+        """
+        if self.max_frames > 0 and frames_in_part >= self.max_frames:
+            return "frames"
+        if self.split_on_pause and before_pause:
+            return "pause"
+        if self.max_seconds and self.start_time is not None and \
+                time.time() + self.time_interval - self.start_time > self.max_seconds:
+            return "time"
+        if self.max_bytes and self.n_frames and \
+                self.n_bytes + self.n_bytes / self.n_frames > self.max_bytes:
+            return "bytes"
+        return None
+
+    def get_summary(self):
+        duration = time.time() - self.start_time if self.start_time is not None else 0.0
+        return f"{self.n_frames} frames, {self.n_bytes / 1e6:.0f} MB, {duration:.0f}s"
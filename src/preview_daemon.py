@@ -0,0 +1,257 @@
+import os
+import socket
+import threading
+import time
+
+from collections import deque
+
+import psutil
+
+from src.parameters import Parameters
+from src.snapshot import SnapshotService
+
+
+def get_preview_socket_path():
+    return f"/home/{os.getlogin()}/tmp/preview.sock"
+
+
+def send_to_preview_daemon(command, socket_path=None, timeout=10):
+    """
+    Send a command to the preview daemon.
+
+    :param command: "preview [parameter_file]", "snapshot", "release <pid>", "status" or "exit".
+    :param socket_path: Socket of the daemon (default: ~/tmp/preview.sock).
+    :param timeout: Time to wait for the answer, in seconds.
+    :return: Answer of the daemon ("SUCCESS ..." or "ERROR ..."), or None if no daemon is running.
+    """
+    socket_path = socket_path or get_preview_socket_path()
+    if not os.path.exists(socket_path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(timeout)
+            client.connect(socket_path)
+            client.sendall(f"{command}\n".encode())
+            return client.makefile().readline().strip() or "ERROR no answer"
+    except (ConnectionRefusedError, FileNotFoundError):
+        # Socket left by a daemon which is not running anymore
+        return None
+    except socket.timeout:
+        return "ERROR timed out"
+    except OSError as e:
+        return f"ERROR {e}"
+
+
+class DaemonCommand:
+    """Command executed by the main loop of the daemon, which owns the hardware."""
+
+    def __init__(self, name, argument=None):
+        self.name = name
+        self.argument = argument
+        self.result = None
+        self.done = threading.Event()
+
+
+class PreviewDaemon:
+    """
+    Resident service keeping the camera script and the light controller initialized between
+    sessions, so that previews and snapshots are served without starting an interpreter, the
+    camera and the FT232H.
+
+    Requests are lines sent to a Unix socket (see ``send_to_preview_daemon``):
+
+    - ``preview [parameter_file]``: capture to ``~/tmp/preview.jpg`` (``last_frame.jpg`` is updated
+      by the camera). With a parameter file differing from the loaded one (except for the
+      timeout), the camera script is restarted with it first;
+    - ``snapshot``: capture to the snapshot folder, as the snapshots of a recording;
+    - ``release <pid>``: stop the camera script and close the light controller, before the
+      recording of process pid starts. They are initialized again once all the processes which
+      asked for them have exited;
+    - ``status``, ``exit``.
+
+    The frames are lit by the IR LED for the exposure only (see SnapshotService). The answers are
+    ``SUCCESS ...`` (with the path of the frame and the request-to-file latency) or ``ERROR ...``.
+
+    :param parameter_file: Path to the JSON parameter file of the camera and the LEDs.
+    :param logger: Logger instance.
+    :param socket_path: Socket of the daemon (default: ~/tmp/preview.sock).
+    :param capture_timeout: Maximum duration of a capture, in seconds.
+    """
+
+    def __init__(self, parameter_file, logger, socket_path=None, capture_timeout=5):
+        self.parameter_file = parameter_file
+        self.parameters = Parameters(parameter_file)
+        self.logger = logger
+        self.socket_path = socket_path or get_preview_socket_path()
+        self.tmp_folder = os.path.dirname(self.socket_path)
+        self.preview_path = os.path.join(self.tmp_folder, "preview.jpg")
+        self.capture_timeout = capture_timeout
+
+        self.camera = None
+        self.lights = None
+        self.snapshots = None
+        self.holders = set()  # Processes the hardware is released to
+
+        self.commands = deque()
+        self.wakeup = threading.Event()
+        self.stop_event = threading.Event()
+        self.server = None
+
+    # Hardware, only used by the main loop
+
+    def is_warm(self):
+        return self.snapshots is not None
+
+    def acquire(self):
+        # Imported here: the clients of the daemon (cam.py) do not need the camera libraries
+        from src.camera.camera_controller import CameraController
+        from src.led_control.led_controller import LightController
+
+        start_time = time.time()
+        self.camera = CameraController(parameters_path=self.parameter_file, logger=self.logger, safe_mode=False)
+        self.camera.start()
+        self.lights = LightController(parameters=self.parameters, logger=self.logger, enable_legacy_gpio_mode=True)
+        self.lights.wait_until_ready()
+        self.snapshots = SnapshotService.from_parameters(tmp_folder=self.tmp_folder,
+                                                         camera=self.camera,
+                                                         lights=self.lights,
+                                                         parameters=self.parameters,
+                                                         logger=self.logger)
+        self.logger.log(f"Camera and lights ready in {time.time() - start_time:.1f}s", log_level=3)
+
+    def release(self):
+        if not self.is_warm():
+            return
+        start_time = time.time()
+        self.snapshots.stop()
+        self.camera.stop()
+        self.lights.close()
+        self.camera, self.lights, self.snapshots = None, None, None
+        self.logger.log(f"Camera and lights released in {time.time() - start_time:.2f}s", log_level=3)
+
+    def execute(self, command):
+        if command.name == "release":
+            # Another session may start while a recording holds the hardware (it then fails on the
+            # camera), the hardware is only taken back once all of them have exited
+            self.holders.add(command.argument)
+            self.release()
+            command.result = f"SUCCESS released for pid {command.argument}"
+        elif command.name == "reload":
+            self.logger.log(f"Parameters changed, restarting the camera with {command.argument}", log_level=3)
+            self.release()
+            self.parameter_file = command.argument
+            self.parameters = Parameters(command.argument)
+            self.acquire()
+            command.result = "SUCCESS reloaded"
+        command.done.set()
+
+    def run(self):
+        """Main loop: execute the commands, serve the captures and take the hardware back after a recording."""
+        self.acquire()
+        self.start_server()
+        try:
+            while not self.stop_event.is_set():
+                self.wakeup.wait(1)
+                self.wakeup.clear()
+
+                while self.commands:
+                    self.execute(self.commands.popleft())
+
+                if self.holders:
+                    self.holders = {pid for pid in self.holders if psutil.pid_exists(pid)}
+                    if not self.holders:
+                        self.logger.log("Recordings ended, taking the camera back", log_level=3)
+                        self.acquire()
+
+                if self.is_warm():
+                    try:
+                        self.snapshots.serve(deadline=time.time() + self.capture_timeout, ir_gating=True)
+                    except Exception as e:
+                        # The daemon outlives a failed capture, the camera script is restarted on timeouts
+                        self.logger.log(f"Capture failed: {e}", log_level=1)
+        finally:
+            self.stop_server()
+            self.release()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wakeup.set()
+
+    # Socket, one thread per client
+
+    def start_server(self):
+        os.makedirs(self.tmp_folder, exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        self.server.listen()
+        threading.Thread(target=self.accept_requests, daemon=True).start()
+        self.logger.log(f"Preview daemon listening on {self.socket_path}", log_level=3)
+
+    def stop_server(self):
+        if self.server is not None:
+            server, self.server = self.server, None
+            server.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def accept_requests(self):
+        while self.server is not None:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle_client, args=(connection,), daemon=True).start()
+
+    def get_holders(self):
+        return "pid " + ", ".join(str(pid) for pid in sorted(self.holders.copy()))
+
+    def run_command(self, name, argument=None, timeout=30):
+        command = DaemonCommand(name, argument)
+        self.commands.append(command)
+        self.wakeup.set()
+        if not command.done.wait(timeout):
+            return f"ERROR {name} timed out"
+        return command.result
+
+    def capture(self, source, target=None, timeout=30):
+        if not self.is_warm():
+            return f"ERROR camera released for {self.get_holders()}"
+        snapshot = self.snapshots.request(source=source, target=target)
+        self.wakeup.set()
+        if not snapshot.done.wait(timeout):
+            return "ERROR timed out"
+        if snapshot.path is None:
+            return f"ERROR {snapshot.error}"
+        return f"SUCCESS {snapshot.path} {time.time() - snapshot.request_time:.3f}"
+
+    def handle_client(self, connection):
+        with connection:
+            try:
+                words = connection.makefile().readline().split()
+                name, arguments = (words[0], words[1:]) if words else ("", [])
+
+                if name == "preview":
+                    if arguments and self.is_warm():
+                        parameters = Parameters(arguments[0])
+                        if {**parameters, "timeout": None} != {**self.parameters, "timeout": None}:
+                            self.run_command("reload", os.path.abspath(arguments[0]))
+                    answer = self.capture("preview", target=self.preview_path)
+                elif name == "snapshot":
+                    answer = self.capture("snapshot")
+                elif name == "release" and len(arguments) == 1 and arguments[0].isdigit():
+                    answer = self.run_command("release", int(arguments[0]))
+                elif name == "status":
+                    answer = "SUCCESS warm" if self.is_warm() else f"SUCCESS released for {self.get_holders()}"
+                elif name == "exit":
+                    self.stop()
+                    answer = "SUCCESS exiting"
+                else:
+                    answer = f"ERROR unknown command '{' '.join(words)}'"
+            except (OSError, ValueError) as e:
+                answer = f"ERROR {e}"
+            try:
+                connection.sendall(f"{answer}\n".encode())
+            except OSError as e:
+                self.logger.log(f"Preview client error: {e}", log_level=2)
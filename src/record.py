@@ -10,8 +10,15 @@ from src.parameters import Parameters
 import os
 import subprocess
 
+from src.adaptive_rate import AdaptiveFrameRate
+from src.cpu_placement import CPUPlacement, LatenessStats
+from src.frame_staging import FrameStaging
+from src.part_rollover import PartRollover
 from src.log import Logger
-from src.upload_manager import SMBManager, EmptyUploader
+from src.recovery import RecoveryService
+from src.snapshot import SnapshotService
+from src.storage_budget import StorageBudget
+from src.upload_manager import SMBManager, SMBDirectManager, SSHManager, S3Manager, EmptyUploader
 from src.utils import *
 
 '''
@@ -86,37 +93,60 @@ class Recorder:
         self.camera = CameraController(parameters_path=parameter_file, logger=self.logger, safe_mode=safe_mode)
         self.camera.start()
 
+        # Reserve cores for the camera process and the recording loop, the background work gets the others
+        self.cpu_placement = CPUPlacement.from_parameters(self.parameters, logger=self.logger)
+        self.cpu_placement.apply_capture(self.camera.process.pid)
+        self.cpu_placement.apply_capture(all_threads=False)
+        self.lateness = LatenessStats()
+
         # Remark : the directory is created on the NAS before initializing the camera
         # If the camera is initialized first, it produces only black frames...
         # It is weird, but at least it works like that
 
         self.uploader = EmptyUploader()
         if self.parameters["use_samba"]:
-            self.uploader = SMBManager(nas_server=self.parameters["nas_server"],
-                                       share_name=self.parameters["share_name"],
-                                       credentials_file=self.parameters["credentials_file"],
-                                       working_dir=self.parameters["smb_dir"],
-                                       recording_name=self.parameters["recording_name"],
-                                       logger=self.logger)
-
-            self.uploader.start()
+            smb_manager = SMBDirectManager if self.parameters.get("smb_backend", "mount") == "direct" else SMBManager
+            self.uploader = smb_manager(nas_server=self.parameters["nas_server"],
+                                        share_name=self.parameters["share_name"],
+                                        credentials_file=self.parameters["credentials_file"],
+                                        working_dir=self.parameters["smb_dir"],
+                                        recording_name=self.parameters["recording_name"],
+                                        logger=self.logger,
+                                        parameters=self.parameters)
 
         elif self.parameters["use_ssh"]:
-            # Not implemented yet, print some warning and quit
-            self.logger.log("SSH upload not implemented yet", log_level=1)
-            print("SSH upload not implemented yet")
-
-            return
-            # self.uploader = SSHManager(ssh_server=self.parameters["ssh_server"],
-            #                            ssh_user=self.parameters["ssh_user"],
-            #                            ssh_password=self.parameters["ssh_password"],
-            #                            working_dir=self.ssh_output,
-            #                            logger=self.logger)
-
-
-
-
-
+            self.uploader = SSHManager(ssh_server=self.parameters["ssh_destination"],
+                                       ssh_user=self.parameters.get("ssh_user"),
+                                       remote_dir=self.parameters.get("ssh_recordings_dir", ""),
+                                       recording_name=self.parameters["recording_name"],
+                                       ssh_dir=self.parameters["ssh_dir"],
+                                       logger=self.logger,
+                                       parameters=self.parameters)
+
+        elif self.parameters.get("use_s3", False):
+            self.uploader = S3Manager(endpoint=self.parameters["s3_endpoint"],
+                                      bucket=self.parameters["s3_bucket"],
+                                      remote_dir=self.parameters.get("s3_prefix", ""),
+                                      recording_name=self.parameters["recording_name"],
+                                      credentials_file=self.parameters.get("s3_credentials_file"),
+                                      logger=self.logger,
+                                      parameters=self.parameters)
+
+        # Bytes of frames, parts and pending uploads on the SD card, and degradation when it fills up
+        self.storage = StorageBudget.from_parameters(recording_folder=self.get_tmp_recording_folder(),
+                                                     spool_dir=f'{self.get_tmp_folder()}/upload_queue/spool',
+                                                     parameters=self.parameters,
+                                                     logger=self.logger)
+        self.storage_report_path = f'{self.get_tmp_folder()}/storage.json'
+        self.storage_check_period = self.parameters.get("storage_check_period_s", 60)
+        self.last_storage_check = 0
+        self.status = None
+
+        self.uploader.set_cpu_placement(self.cpu_placement)
+        self.uploader.set_storage_budget(self.storage)
+        # Capture times of the frames of the adaptive frame rate, for the variable rate encode
+        self.uploader.set_timestamps_dir(f'{self.get_tmp_folder()}/timestamps')
+        self.uploader.start()
 
         self.pause_mode = self.get_pause_mode()
         self.pause_number = 0
@@ -126,6 +156,40 @@ class Recorder:
         self.n_frames_total = self.compute_total_number_of_frames()
 
         self.compress_step = self.parameters["compress"]
+        # Parts are numbered explicitly, since their size may change during the recording (adaptive_part_size)
+        self.part_number = self.parameters["start_frame"] // self.compress_step if self.compress_step > 0 else 0
+        self.part_start_frame = self.part_number * self.compress_step
+        # Parts are closed after a number of frames, a duration, a size or before a pause
+        self.rollover = PartRollover.from_parameters(self.parameters, logger=self.logger)
+        self.parts_waiting_for_compression = []  # Parts refused by a full compression queue
+        self.parts_waiting_for_flush = []  # Parts whose frames are still in the staging area
+        # mkv (x264), ffv1 (lossless video), tzst (zstd tar archive) or tgz
+        self.compression_format = self.parameters.get("compression_format", "mkv")
+
+        # Faster frames during activity and around the optogenetic stimuli (adaptive_rate)
+        self.frame_rate = AdaptiveFrameRate.from_parameters(self.parameters, tmp_folder=self.get_tmp_folder(),
+                                                            logger=self.logger)
+        if self.frame_rate.enabled and self.pause_mode:
+            self.logger.log("Adaptive frame rate is not available in pause mode, disabled", log_level=2)
+            self.frame_rate.enabled = False
+        if self.frame_rate.enabled:
+            # Upper bound, the recording ends at its timeout
+            self.n_frames_total = self.frame_rate.get_max_frames(self.parameters["timeout"])
+        self.next_frame_time = 0
+
+        # Parts left behind by interrupted recordings are finished in the background
+        self.recovery = RecoveryService(recording_folder=self.get_tmp_recording_folder(),
+                                        session_file=f'{self.get_tmp_folder()}/session.json',
+                                        uploader=self.uploader,
+                                        compression_format=self.compression_format,
+                                        timestamps_dir=f'{self.get_tmp_folder()}/timestamps',
+                                        logger=self.logger)
+
+        # Frames written to RAM and flushed to the SD card in batches (disabled without staging_dir)
+        self.staging = FrameStaging.from_parameters(recording_folder=self.get_tmp_recording_folder(),
+                                                    parameters=self.parameters,
+                                                    cpu_placement=self.cpu_placement,
+                                                    logger=self.logger)
 
         self.skip_frame = False
 
@@ -144,6 +208,12 @@ class Recorder:
         # Initialize the LEDs
         self.lights = LightController(parameters=self.parameters, logger=self.logger, enable_legacy_gpio_mode=True)
 
+        # Snapshots requested by SIGUSR1 or the local socket, taken when the schedule leaves time for them
+        self.snapshots = SnapshotService.from_parameters(tmp_folder=self.get_tmp_folder(),
+                                                         camera=self.camera,
+                                                         lights=self.lights,
+                                                         parameters=self.parameters,
+                                                         logger=self.logger)
 
         self.logger.log("Recorder initialized", log_level=5)
 
@@ -167,6 +237,17 @@ class Recorder:
         self.camera.stop()
 
         self.logger.log("Stopping recording", log_level=3)
+        self.logger.log(f"Capture lateness (CPU placement {'on' if self.cpu_placement.enabled else 'off'}): "
+                        f"{self.lateness.summary()}", log_level=3)
+        self.logger.log(f"Capture latency: {self.camera.get_capture_summary()}", log_level=3)
+        if self.frame_rate.enabled:
+            self.logger.log(f"Adaptive frame rate: {self.frame_rate.get_summary()}", log_level=3)
+        self.snapshots.stop()
+        self.logger.log(f"Snapshots: {self.snapshots.get_summary()}", log_level=3)
+
+        self.staging.stop()
+
+        self.uploader.close()
 
         self.update_status('Not Running')
 
@@ -196,14 +277,32 @@ class Recorder:
         # Go to home directory
         self.go_to_tmp_recording_folder()
 
+        if not self.preview_only():
+            # Frames left in RAM by a previous recording join its parts, before they are quarantined
+            self.staging.salvage()
+            if self.recovery.quarantine():
+                # Those of the parts left by the previous session were moved next to them
+                self.frame_rate.clear_timestamps()
+                self.recovery.begin_session(session_id=datetime.datetime.now().strftime("%Y%m%d_%H%M%S"),
+                                            remote_dir=getattr(self.uploader, "remote_dir", None),
+                                            compression_format=self.compression_format)
+
+        # Initial count of the bytes left by previous recordings, in the background
+        self.storage.start_reconcile()
+
+        self.staging.start()
+
         self.update_status('Recording')
 
+        self.snapshots.start()
+
         self.lights.wait_until_ready()
 
         if not self.preview_only():
             # If one does an actual recording and not just a preview (i.e. timeout=0)
 
-            self.lights.start()
+            # The IR LED follows the rate actually used, the adaptive frame rate may have been disabled
+            self.lights.start(ir_period=self.frame_rate.fast_interval if self.frame_rate.enabled else None)
 
 
             wait_until_next_even_second()
@@ -216,6 +315,7 @@ class Recorder:
                 self.logger.log("Illumination board not connected", log_level=2)
 
         self.initial_time = time.time()
+        self.next_frame_time = self.initial_time
 
 
         self.upload_logs()
@@ -233,12 +333,14 @@ class Recorder:
             self.start_time_current_frame = time.time()
 
             capture_ok = False
+            # Path in the staging area, or the final path
+            capture_path = self.staging.get_capture_path(self.get_last_save_path())
 
             try:
                 if not self.skip_frame:
                     self.log_progress()
 
-                    capture_ok = self.camera.capture_frame(self.get_last_save_path())
+                    capture_ok = self.camera.capture_frame(capture_path, deadline=self.get_capture_deadline())
 
             except RuntimeError as e:
 
@@ -253,7 +355,7 @@ class Recorder:
                     self.logger.log(f"Frame {self.current_frame_number} could not be captured. "
                                     f" Saving as empty frame.",
                                     log_level=2)
-                    self.camera.capture_empty_frame(self.get_last_save_path())
+                    self.camera.capture_empty_frame(capture_path)
                 else:
                     self.logger.log(f"Frame {self.current_frame_number} captured."
                                     f" ({self.current_frame_number + 1}/{self.n_frames_total})",
@@ -261,20 +363,34 @@ class Recorder:
 
                 # TODO : write doc about why this check is useful
                 if self.get_last_save_path() is not None:
+                    # Before the frame may be flushed from the staging area
+                    if self.frame_rate.enabled:
+                        self.update_frame_rate(capture_path if capture_ok else None)
+                    self.staging.frame_saved(capture_path, self.get_last_save_path())
+                    self.account_frame(capture_path)
+                    self.check_storage()
 
                     if self.is_time_for_compression():
                         # self.logger.log("time for compression")
                         self.logger.log("Time for compression", log_level=3)
-                        self.uploader.start_async_compression_and_upload(dir_to_compress=self.get_current_dir(),
-                                                                         format="mkv")
+                        self.seal_part(self.get_current_dir())
+                        self.start_next_part()
 
 
                         self.upload_logs()
 
+                    self.queue_flushed_parts()
 
+                # Started once the first frame is saved, so that it does not delay it
+                if not self.preview_only():
+                    self.recovery.start()
 
                 # print(f'end: {datetime.now() - self.initial_datetime}')
 
+            # The adaptive frame rate ends the recording before its upper bound of frames
+            if self.current_frame_number >= self.n_frames_total - 1:
+                break
+
         # End of recording
         # Wait for the end of compression
 
@@ -283,6 +399,9 @@ class Recorder:
         self.logger.log("Terminating LED programs", log_level=5)
         self.lights.close()
 
+        self.staging.wait_flushed()
+        self.queue_flushed_parts()
+        self.queue_part_for_compression(block=True)
         self.uploader.wait_for_compression()
 
         self.uploader.upload_remaining_files(self.go_to_tmp_recording_folder())
@@ -313,6 +432,10 @@ class Recorder:
 
         delay = self.get_delay()
 
+        # Let the uploader throttle itself while the capture is running late
+        self.uploader.report_capture_delay(delay)
+        self.lateness.record(delay)
+
         # If too early, wait until it is time to record
         # print(delay)
         # print(f'current: {current_timedelta}, exp: {expected_timedelta_for_current_frame}, delay: {delay}')
@@ -320,11 +443,13 @@ class Recorder:
             # Recording on time. Wait for the next frame
 
             self.logger.log("Waiting for %fs before next frame" % -delay, log_level=5)
+            next_frame_time = time.time() - delay
+            # Snapshots are lit by the IR LED, between the pulses of the illumination program
             try:
-                time.sleep(-delay)
+                self.snapshots.wait_and_serve(until=next_frame_time, between_ir_pulses=True)
             except BlockingIOError:
                 self.logger.log("\n\n it failed but still trying", log_level=2)
-                time.sleep(-delay)
+                self.snapshots.wait_and_serve(until=next_frame_time, between_ir_pulses=True)
         elif delay < 0.005:  # We need some tolerance in this world...
             pass  # And go on directly with frame capture
         else:
@@ -337,7 +462,8 @@ class Recorder:
         # It the frame has more than one time interval of delay, it just skips the frame and directly
         # goes to the next one
         # The condition on current_frame_number is useful if one just wants one frame and does not care about time sync
-        if delay >= self.parameters["time_interval"] and \
+        # The adaptive frame rate schedules the next frame from the current time instead
+        if delay >= self.parameters["time_interval"] and not self.frame_rate.enabled and \
                 self.current_frame_number < (self.n_frames_total - 1) and self.pause_mode is False:
             self.skip_frame = True
             self.logger.log(f"Delay too long : Frame {self.current_frame_number} skipped", log_level=2)
@@ -353,7 +479,10 @@ class Recorder:
         """
 
         delay = 0
-        if self.pause_mode is False:
+        if self.frame_rate.enabled:
+            # The time of the next frame depends on the rate chosen after the previous one
+            delay = time.time() - self.next_frame_time
+        elif self.pause_mode is False:
             delay = time.time() - (self.initial_time +
                                    self.current_frame_number * self.parameters["time_interval"]) + \
                     self.parameters["start_frame"] * self.parameters["time_interval"]
@@ -365,6 +494,18 @@ class Recorder:
 
         return delay
 
+    def get_capture_deadline(self):
+        """
+        Time when the next frame is due, after which the current capture is cancelled. None for a
+        preview, whose single capture may wait for the camera to start.
+
+        :return: The deadline, as given by time.time(), or None.
+        :rtype: float
+        """
+        if self.preview_only():
+            return None
+        return time.time() - self.get_delay() + self.frame_rate.get_interval()
+
     def log_progress(self):
         """
         Log the current progress in terms of which frame we are about to capture.
@@ -376,23 +517,90 @@ class Recorder:
 
     def is_time_for_compression(self):
         """
-        Check if the current frame is the right time to trigger compression.
+        Check if the current frame is the right time to trigger compression: it is the last frame
+        of the recording, or the rollover policy closes the part after it (see PartRollover).
 
         :return: True if compression should be triggered now, False otherwise.
         :rtype: bool
         """
         try:
-            if self.current_frame_number % self.compress_step == self.compress_step - 1 or \
-                    (self.current_frame_number == self.n_frames_total - 1 and self.n_frames_total > 1):
+            if not self.rollover.is_enabled():
+                return False
+            if self.current_frame_number == self.n_frames_total - 1 and self.n_frames_total > 1:
                 return True
-            else:
+            reason = self.rollover.get_reason(frames_in_part=self.current_frame_number - self.part_start_frame + 1,
+                                              before_pause=self.is_it_pause_time(self.current_frame_number + 1))
+            if reason is None:
                 return False
+            self.logger.log(f"Part {self.part_number} closed on {reason} ({self.rollover.get_summary()})", log_level=4)
+            return True
         except TypeError as e:
             self.logger.log(e)
-        except ZeroDivisionError as e:
-            return False
 
+    def start_next_part(self):
+        """
+        Start a new part after the current frame. Its maximum number of frames is the configured
+        compress step, or the size suggested by the uploader from the measured encode throughput.
+        """
+        self.part_number += 1
+        self.part_start_frame = self.current_frame_number + 1
+        self.rollover.start_part()
 
+        if self.parameters["compress"] <= 0:
+            return
+        part_size = self.uploader.get_part_size(self.parameters["compress"])
+        if part_size != self.compress_step:
+            self.logger.log(f"Part size changed from {self.compress_step} to {part_size} frames", log_level=3)
+            self.compress_step = part_size
+            self.rollover.max_frames = part_size
+
+
+
+    def seal_part(self, part_dir):
+        """
+        Close a finished part: it is queued for compression once its staged frames are flushed.
+
+        :param part_dir: Part directory that just finished.
+        :type part_dir: str
+        """
+        self.staging.seal_part(part_dir)
+        if self.staging.is_flushed(part_dir) and not self.parts_waiting_for_flush:
+            self.queue_part_for_compression(part_dir)
+        else:
+            self.parts_waiting_for_flush.append(part_dir)
+
+    def queue_flushed_parts(self):
+        """
+        Queue for compression the sealed parts whose frames are all out of the staging area, in order.
+        """
+        while self.parts_waiting_for_flush and self.staging.is_flushed(self.parts_waiting_for_flush[0]):
+            self.queue_part_for_compression(self.parts_waiting_for_flush.pop(0))
+            self.logger.log(f"Frame staging: {self.staging.get_summary()}", log_level=4)
+
+    def queue_part_for_compression(self, part_dir=None, block=False):
+        """
+        Hand a finished part to the compression worker of the uploader.
+
+        If the compression queue is full (backpressure), the part stays on disk and is
+        retried at the next compression time, so the capture loop never waits for the encoder.
+
+        :param part_dir: Part directory that just finished, or None to only retry deferred parts.
+        :type part_dir: str
+        :param block: If True, wait for free slots until every deferred part is queued.
+        :type block: bool
+        """
+        if part_dir is not None:
+            self.parts_waiting_for_compression.append(part_dir)
+
+        while self.parts_waiting_for_compression:
+            job = self.uploader.start_async_compression_and_upload(dir_to_compress=self.parts_waiting_for_compression[0],
+                                                                   format=self.compression_format,
+                                                                   block=block)
+            if job is None:
+                self.logger.log(f"Compression is lagging behind capture: "
+                                f"{len(self.parts_waiting_for_compression)} part(s) deferred", log_level=2)
+                break
+            self.parts_waiting_for_compression.pop(0)
 
     def get_tmp_folder(self):
         """
@@ -490,8 +698,8 @@ class Recorder:
             self.lights.pause_all_leds()
 
 
-            # Do the pause and wait for the remaining time minus 3 seconds
-            time.sleep(time_to_pause - 3)
+            # Do the pause and wait for the remaining time minus 3 seconds, taking the requested snapshots
+            self.snapshots.wait_and_serve(until=time.time() + time_to_pause - 3, ir_gating=True)
 
             # 5 seconds before the end of the pause, turn the LEDs back on
             self.lights.resume_all_leds()
@@ -502,7 +710,7 @@ class Recorder:
             self.pause_number += 1
         else:
             # no need to stop the LEDs for a short pause
-            time.sleep(time_to_pause)
+            self.snapshots.wait_and_serve(until=time.time() + time_to_pause, between_ir_pulses=True)
             self.update_status('Recording')  # Update status back to Recording
 
 
@@ -511,31 +719,71 @@ class Recorder:
 
     def update_status(self, status):
         """
-        Write the given status to a status file for external monitoring.
+        Write the given status to a status file for external monitoring. While the local storage
+        is running out, its alert is written on a second line.
 
         :param status: The status string, e.g. 'Recording', 'Paused', 'Not Running'.
         :type status: str
         """
+        self.status = status
+        alert = self.storage.get_alert()
 
         with open(self.status_file_path, 'w') as f:
             f.write(status)
+            if alert is not None:
+                f.write(f"\n{alert}")
 
-    def capture_frame_during_pause(self):
+    def account_frame(self, frame_path):
+        """
+        Add a saved frame to the raw bytes of the storage budget and to the size of the current part.
+        """
+        try:
+            n_bytes = os.path.getsize(frame_path)
+        except OSError:
+            return
+        self.storage.add("raw", n_bytes)
+        self.rollover.add_frame(n_bytes)
+
+    def update_frame_rate(self, frame_path):
+        """
+        Record the capture time of the saved frame and schedule the next one at the rate chosen
+        by the adaptive frame rate. The recording ends with the last frame before its timeout.
+
+        :param frame_path: Path of the captured frame, or None if an empty frame was saved instead.
         """
-        Capture a new frame while the recording process is paused.
+        self.frame_rate.write_timestamp(self.get_last_save_path(), self.start_time_current_frame)
+        self.frame_rate.update(frame_path, self.start_time_current_frame)
+        self.next_frame_time = self.frame_rate.get_next_frame_time()
+        if self.next_frame_time >= self.initial_time + self.parameters["timeout"]:
+            self.n_frames_total = self.current_frame_number + 1
 
-        Turns on IR if available, captures a frame, and turns IR off again.
+    def check_storage(self):
         """
+        Every storage_check_period seconds, update the projection of the local storage, write its
+        report next to the status file, and the alert in the status file when the level changes.
+        """
+        now = time.time()
+        if now - self.last_storage_check < self.storage_check_period:
+            return
+        self.last_storage_check = now
+
+        changed = self.storage.check()
+        try:
+            self.storage.write_report(self.storage_report_path)
+        except OSError as e:
+            self.logger.log(f"Cannot write the storage report: {e}", log_level=2)
+        if changed and self.status is not None:
+            self.update_status(self.status)
 
-        self.logger.log("Capturing a new frame during pause", log_level=3)
+    def capture_frame_during_pause(self):
+        """
+        Request a snapshot, e.g. while the recording process is paused.
+
+        Safe to call from a signal handler: the snapshot is only queued, and taken by the main loop
+        when the schedule leaves time for it (see SnapshotService).
+        """
         if self.current_frame_number < self.n_frames_total:
-            # self.ir_leds.turn_on()
-            self.lights["IR"].turn_on()
-            time.sleep(0.25)
-            self.camera.capture_frame(self.get_last_save_path())
-            # self.ir_leds.turn_off()
-            self.lights["IR"].turn_off()
-            self.logger.log(f"Captured frame {self.current_frame_number} during pause", log_level=3)
+            self.snapshots.request(source="SIGUSR1")
         else:
             self.logger.log("No frames left to capture", log_level=2)
 
@@ -634,16 +882,15 @@ class Recorder:
 
     def get_current_dir(self):
         """
-        If compression is configured with a given step size, group frames into
+        If a part rollover policy is configured (see PartRollover), group frames into
         subfolders named partXX.
 
         :return: The directory name ('partXX') or '.' if no grouping is needed.
         :rtype: str
         """
 
-        if self.compress_step > 0:
-            part = self.current_frame_number // self.compress_step
-            current_dir = "part%02d" % part
+        if self.rollover.is_enabled():
+            current_dir = "part%02d" % self.part_number
 
             try:
                 os.mkdir(current_dir)
@@ -687,13 +934,13 @@ class Recorder:
 
     def upload_logs(self):
         """
-        If using Samba and logs are saved, attempt to upload the current log file
-        for real-time monitoring.
+        If uploading and logs are saved, ship the lines added to the current log file since the
+        last call, for real-time monitoring.
         """
-        if self.parameters["use_samba"] and self.is_it_useful_to_save_logs():
+        if self.is_it_useful_to_save_logs():
             try:
-                self.uploader.upload(file_to_upload=self.logger.get_log_file_path(),
-                                 filename_at_destination=self.logger.get_log_filename())
+                self.uploader.ship_log(log_file=self.logger.get_log_file_path(),
+                                       filename_at_destination=self.logger.get_log_filename())
             except TypeError:
                 pass
 
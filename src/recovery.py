@@ -0,0 +1,204 @@
+import json
+import os
+import posixpath
+import re
+import shutil
+import time
+
+from multiprocessing import Process
+
+import psutil
+
+
+class RecoveryService:
+    """
+    Finishes the parts left behind by recordings that were killed (power loss, SIGKILL, crash).
+
+    Every recording writes a session file describing where its parts go (remote tree, compression
+    format) and which process records them. The file is kept after the recording, since parts
+    whose compression failed are left in the recording folder too. At startup, before the first
+    frame:
+
+    - if the previous session file belongs to a process that is not running anymore, the part
+      folders and compressed parts it left in the recording folder are moved to
+      ``recovery/<session id>/``, with its session file. The capture times of its parts recorded
+      at an adaptive frame rate (``timestamps_dir``) are moved next to them as
+      ``<part>.timestamps.csv``. This only renames entries, so it is fast, and the new recording
+      cannot write its frames into an old part folder;
+    - the new session file is written.
+
+    After the first frame, a background process at the lowest CPU and I/O priority goes through
+    the recovery folder. Part folders are compressed again (a half-written output is discarded)
+    and verified (at the variable frame rate of their timestamps), compressed parts without their
+    folder are verified, then the outputs and their timestamps are queued for upload to the
+    remote tree of their session. Parts that cannot be recovered stay in
+    the recovery folder. The process is a daemon: if the recording ends first, the next one
+    resumes the recovery.
+
+    :param recording_folder: Local folder where the parts are written.
+    :param session_file: Path to the session file, outside the recording folder so it is not uploaded.
+    :param uploader: UploadManager compressing, verifying and queueing the recovered parts.
+    :param compression_format: Format of the parts of sessions without a session file.
+    :param timestamps_dir: Folder of the capture times of the parts (see AdaptiveFrameRate), or None.
+    :param logger: Logger instance.
+    """
+
+    PART_DIR = re.compile(r"^part\d+$")
+    PART_FILE = re.compile(r"^part\d+\.(mkv|tgz|tar\.zst)$")
+    TIMESTAMPS_FILE = re.compile(r"^part\d+\.timestamps\.csv$")
+    SESSION_FILE = "session.json"
+
+    def __init__(self, recording_folder, session_file, uploader, compression_format="mkv", timestamps_dir=None,
+                 logger=None):
+        self.recording_folder = recording_folder
+        self.recovery_folder = os.path.join(recording_folder, "recovery")
+        self.session_file = session_file
+        self.uploader = uploader
+        self.compression_format = compression_format
+        self.timestamps_dir = timestamps_dir
+        self.logger = logger
+        self.started = False
+
+    def read_session(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self.logger.log(f"Cannot read session file {path}: {e}", log_level=2)
+            return {}
+
+    @staticmethod
+    def is_running(session):
+        """:return: True if the process recording the session is still running."""
+        try:
+            process = psutil.Process(session["pid"])
+            # The pid may have been reused since a reboot
+            return abs(process.create_time() - session["pid_create_time"]) < 1
+        except (psutil.Error, KeyError, TypeError):
+            return False
+
+    def get_orphans(self):
+        """:return: Names of the part folders, compressed parts and their timestamps in the recording folder."""
+        orphans = []
+        for name in sorted(os.listdir(self.recording_folder)):
+            path = os.path.join(self.recording_folder, name)
+            if (self.PART_DIR.match(name) and os.path.isdir(path)) or \
+                    ((self.PART_FILE.match(name) or self.TIMESTAMPS_FILE.match(name)) and os.path.isfile(path)):
+                orphans.append(name)
+        return orphans
+
+    def quarantine(self):
+        """
+        Move the parts left by a previous session out of the way of the new one.
+
+        :return: False if another recording is running in the same folder, True otherwise.
+        """
+        previous = self.read_session(self.session_file)
+        if previous and self.is_running(previous):
+            self.logger.log(f"Recording of session {previous.get('session_id')} is still running "
+                            f"(pid {previous.get('pid')}), no recovery", log_level=2)
+            return False
+
+        orphans = self.get_orphans()
+        if not orphans:
+            return True
+
+        if not previous:
+            # Session of a version without session file: named after its most recent part
+            last_change = max(os.path.getmtime(os.path.join(self.recording_folder, name)) for name in orphans)
+            previous = {"session_id": time.strftime("%Y%m%d_%H%M%S", time.localtime(last_change))}
+
+        session_folder = os.path.join(self.recovery_folder, previous["session_id"])
+        os.makedirs(session_folder, exist_ok=True)
+        with open(os.path.join(session_folder, self.SESSION_FILE), "w") as f:
+            json.dump(previous, f, indent=4)
+
+        for name in orphans:
+            destination = os.path.join(session_folder, name)
+            if os.path.exists(destination):
+                self.logger.log(f"{destination} already exists, {name} left in place", log_level=1)
+                continue
+            os.rename(os.path.join(self.recording_folder, name), destination)
+
+            # Capture times of a part not compressed yet
+            timestamps = os.path.join(self.timestamps_dir, f"{name}.csv") if self.timestamps_dir else None
+            if self.PART_DIR.match(name) and timestamps is not None and os.path.exists(timestamps):
+                shutil.move(timestamps, os.path.join(session_folder, f"{name}.timestamps.csv"))
+
+        self.logger.log(f"Moved {len(orphans)} orphaned part(s) of session {previous['session_id']} "
+                        f"to {session_folder}", log_level=2)
+        return True
+
+    def begin_session(self, session_id, remote_dir, compression_format):
+        """
+        Write the session file of the new recording.
+        """
+        process = psutil.Process()
+        session = {"session_id": session_id,
+                   "remote_dir": remote_dir,
+                   "compression_format": compression_format,
+                   "pid": process.pid,
+                   "pid_create_time": process.create_time(),
+                   "start_time": time.time()}
+        os.makedirs(os.path.dirname(self.session_file), exist_ok=True)
+        with open(self.session_file, "w") as f:
+            json.dump(session, f, indent=4)
+
+    def start(self):
+        """
+        Start the background recovery, if there is anything to recover.
+        """
+        if self.started:
+            return
+        self.started = True
+        if not os.path.isdir(self.recovery_folder) or not os.listdir(self.recovery_folder):
+            return
+        Process(target=self.run, daemon=True).start()
+
+    def run(self):
+        self.uploader.set_background_priority()
+        start_time = time.time()
+        recovered, failed = 0, 0
+
+        for session_id in sorted(os.listdir(self.recovery_folder)):
+            session_folder = os.path.join(self.recovery_folder, session_id)
+            if not os.path.isdir(session_folder):
+                continue
+
+            session = self.read_session(os.path.join(session_folder, self.SESSION_FILE)) or {}
+            remote_dir = session.get("remote_dir")
+            if not remote_dir:
+                # Unknown tree: next to the parts of the current recording
+                remote_dir = posixpath.join(getattr(self.uploader, "remote_dir", ""), f"recovered_{session_id}")
+            compression_format = session.get("compression_format", self.compression_format)
+
+            parts = sorted(name for name in os.listdir(session_folder) if self.PART_DIR.match(name))
+            # Compressed parts whose folder is gone: the compression was verified, not the upload
+            parts += sorted(name for name in os.listdir(session_folder)
+                            if self.PART_FILE.match(name) and name.split(".")[0] not in parts)
+            # Timestamps of parts already uploaded (queued with their part otherwise)
+            parts += sorted(name for name in os.listdir(session_folder)
+                            if self.TIMESTAMPS_FILE.match(name) and
+                            name.split(".")[0] not in [part.split(".")[0] for part in parts])
+
+            for name in parts:
+                path = os.path.join(session_folder, name)
+                if self.PART_DIR.match(name):
+                    # Partial outputs of an interrupted compression are encoded again
+                    for output in os.listdir(session_folder):
+                        if self.PART_FILE.match(output) and output.split(".")[0] == name:
+                            os.remove(os.path.join(session_folder, output))
+
+                if self.uploader.recover_part(path, compression_format, remote_dir):
+                    recovered += 1
+                else:
+                    failed += 1
+
+            remaining = [name for name in os.listdir(session_folder) if name != self.SESSION_FILE]
+            if not remaining:
+                shutil.rmtree(session_folder)
+
+        self.logger.log(f"Recovery done in {time.time() - start_time:.0f}s: {recovered} part(s) recovered, "
+                        f"{failed} kept in {self.recovery_folder}", log_level=3)
@@ -0,0 +1,152 @@
+import os
+import re
+import socket
+import threading
+import time
+
+from multiprocessing import Array
+
+
+class RemoteHealth:
+    """
+    Cached health checks of the remote storage, without spawning any process.
+
+    - Mount state: the mount point is looked up in ``/proc/self/mountinfo``.
+    - Reachability: a TCP connection to the service port (SMB, SSH, S3...) with a short timeout.
+
+    Results are cached for ``ttl`` seconds in shared memory, so the upload processes forked by
+    the UploadManager see the results of the checks done by the others. An optional monitor
+    thread refreshes the checks in the background, so that callers normally only read the cache.
+
+    Listeners registered with ``add_listener`` are called as ``listener(check, state)`` when the
+    state of a check (``"mounted"`` or ``"reachable"``) changes, in the process that detected it.
+
+    :param host: Host name or address of the remote server.
+    :param port: TCP port of the service.
+    :param mount_point: Local mount point of the remote storage, or None if it is not mounted.
+    :param ttl: Time to live of the cached results, in seconds.
+    :param connect_timeout: Timeout of the TCP connection, in seconds.
+    :param logger: Logger instance.
+    """
+
+    CHECKS = ("mounted", "reachable")
+    UNKNOWN = -1.0
+
+    # Indices of a check in the shared state: state (1, 0 or UNKNOWN) and time of the check
+    STATE, CHECKED = range(2)
+
+    def __init__(self, host, port, mount_point=None, ttl=10, connect_timeout=1.0, logger=None):
+        self.host = host
+        self.port = port
+        # String normalization only: resolving the path would stat a possibly stale mount point
+        self.mount_point = os.path.abspath(mount_point) if mount_point else None
+        self.ttl = ttl
+        self.connect_timeout = connect_timeout
+        self.logger = logger
+
+        self.state = {check: Array('d', [self.UNKNOWN, 0.0]) for check in self.CHECKS}
+        self.listeners = []
+        self.monitor = None
+        self.monitor_stop = threading.Event()
+
+    @staticmethod
+    def get_mounts():
+        """
+        :return: Dictionary of the mount points of the process and their filesystem type.
+        """
+        mounts = {}
+        with open("/proc/self/mountinfo") as f:
+            for line in f:
+                fields = line.split()
+                # Optional fields are terminated by "-", followed by the filesystem type
+                separator = fields.index("-")
+                mount_point = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[4])
+                mounts[mount_point] = fields[separator + 1]
+        return mounts
+
+    def check_mounted(self):
+        if self.mount_point is None:
+            return True
+        try:
+            return self.mount_point in self.get_mounts()
+        except (OSError, ValueError, IndexError) as e:
+            self.logger.log(f"Cannot read the mount table: {e}", log_level=1)
+            return False
+
+    def check_reachable(self):
+        try:
+            with socket.create_connection((self.host, self.port), timeout=self.connect_timeout):
+                return True
+        except OSError as e:
+            self.logger.log(f"{self.host}:{self.port} not reachable: {e}", log_level=4)
+            return False
+
+    def get(self, check, force=False):
+        """
+        :return: Cached state of the check, refreshed if older than ttl or if force is set.
+        """
+        state = self.state[check]
+        with state.get_lock():
+            cached, checked = state[self.STATE], state[self.CHECKED]
+        if not force and cached != self.UNKNOWN and time.time() - checked < self.ttl:
+            return cached == 1
+
+        result = self.check_mounted() if check == "mounted" else self.check_reachable()
+        self.update(check, result)
+        return result
+
+    def update(self, check, result):
+        state = self.state[check]
+        with state.get_lock():
+            previous = state[self.STATE]
+            state[self.STATE] = 1 if result else 0
+            state[self.CHECKED] = time.time()
+
+        if previous != self.UNKNOWN and previous != state[self.STATE]:
+            self.logger.log(f"Remote storage {self.host}: {check} is now {result}", log_level=3)
+            for listener in self.listeners:
+                try:
+                    listener(check, result)
+                except Exception as e:
+                    self.logger.log(f"Remote health listener failed: {e}", log_level=1)
+
+    def is_mounted(self, force=False):
+        return self.get("mounted", force)
+
+    def is_reachable(self, force=False):
+        return self.get("reachable", force)
+
+    def invalidate(self, check=None):
+        """
+        Expire the cached result (e.g. after a mount, or an operation failing), so that the next
+        call checks again. The last known state is kept to detect the change.
+        """
+        for name in (self.CHECKS if check is None else (check,)):
+            with self.state[name].get_lock():
+                self.state[name][self.CHECKED] = 0.0
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def start_monitor(self, period=5):
+        """
+        Refresh the checks every period seconds in a background thread.
+        """
+        if self.monitor is not None:
+            return
+        self.monitor_stop.clear()
+        self.monitor = threading.Thread(target=self.run_monitor, args=(period,), daemon=True)
+        self.monitor.start()
+
+    def run_monitor(self, period):
+        while not self.monitor_stop.is_set():
+            for check in self.CHECKS:
+                self.get(check, force=True)
+            self.monitor_stop.wait(period)
+
+    def stop_monitor(self):
+        if self.monitor is None:
+            return
+        self.monitor_stop.set()
+        self.monitor.join(self.connect_timeout + 1)
+        self.monitor = None
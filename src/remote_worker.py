@@ -0,0 +1,158 @@
+import os
+import signal
+import threading
+import time
+
+from multiprocessing import Pipe
+
+
+class RemoteOperationTimeout(TimeoutError):
+    """Raised when a remote filesystem operation misses its deadline. The worker running it is killed."""
+
+
+class RemoteFSWorker:
+    """
+    Runs the filesystem operations on the remote mount in a dedicated worker process, with hard
+    deadlines.
+
+    An operation on a stale CIFS/sshfs mount can block in uninterruptible sleep, and nothing can
+    interrupt the process running it. The calling process only waits for the result up to the
+    deadline. If the deadline passes, the worker is killed and abandoned, and the caller gets a
+    RemoteOperationTimeout (an OSError). The next call starts a new worker.
+
+    The operations are registered by name at creation. The worker is forked from the process
+    calling it, so the registered callables are inherited rather than pickled, and can use shared
+    state such as the rate limiter. Only the names, arguments and results go through the pipe.
+    Each process using the instance gets its own worker, started on its first call. The worker is
+    a plain fork rather than a multiprocessing Process, so that daemon processes (compression
+    workers, upload queue drainer) can use it too. It exits when the pipe is closed, i.e. when
+    the process owning it exits.
+
+    :param operations: Dictionary of the callables the worker can run, by name.
+    :param timeout: Default deadline of an operation, in seconds.
+    :param logger: Logger instance.
+    """
+
+    def __init__(self, operations, timeout=15, logger=None):
+        self.operations = operations
+        self.timeout = timeout
+        self.logger = logger
+
+        self.pid = None
+        self.connection = None
+        self.owner_pid = None
+        self.killed_pids = []  # Killed workers not reaped yet (possibly still stuck in the kernel)
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.connection is not None and self.owner_pid == os.getpid():
+            self.connection.close()
+
+        parent_connection, child_connection = Pipe()
+        pid = os.fork()
+        if pid == 0:
+            parent_connection.close()
+            try:
+                self.serve(child_connection)
+            finally:
+                os._exit(0)
+
+        child_connection.close()
+        self.pid = pid
+        self.connection = parent_connection
+        self.owner_pid = os.getpid()
+
+    def is_alive(self):
+        if self.pid is None or self.owner_pid != os.getpid():
+            return False
+        try:
+            return os.waitpid(self.pid, os.WNOHANG) == (0, 0)
+        except ChildProcessError:
+            return False
+
+    def serve(self, connection):
+        """Loop of the worker process: run the requested operations and send back the results."""
+        while True:
+            try:
+                name, args, kwargs = connection.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                result = (True, self.operations[name](*args, **kwargs))
+            except Exception as e:
+                result = (False, e)
+            try:
+                connection.send(result)
+            except Exception as e:
+                # The exception or the result cannot be pickled
+                connection.send((False, OSError(f"{name} failed: {e!r}")))
+
+    def kill(self):
+        """Kill the worker and forget it, without waiting for a process that may be stuck in the kernel."""
+        if self.pid is not None and self.owner_pid == os.getpid():
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+                self.killed_pids.append(self.pid)
+            except ProcessLookupError:
+                pass
+            self.connection.close()
+        self.pid = None
+        self.connection = None
+        self.reap()
+
+    def reap(self):
+        """Collect the killed workers that have finally exited."""
+        for pid in list(self.killed_pids):
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                    continue
+            except ChildProcessError:
+                pass
+            self.killed_pids.remove(pid)
+
+    def call(self, name, *args, timeout=None, **kwargs):
+        """
+        Run an operation in the worker and return its result.
+
+        :param name: Name of the registered operation.
+        :param timeout: Deadline in seconds, defaults to the timeout of the worker.
+        :raises RemoteOperationTimeout: If the operation did not finish in time.
+        :raises Exception: The exception raised by the operation.
+        """
+        timeout = timeout if timeout is not None else self.timeout
+
+        with self.lock:
+            if not self.is_alive():
+                self.start()
+
+            start_time = time.time()
+            try:
+                self.connection.send((name, args, kwargs))
+                ready = self.connection.poll(timeout)
+                if ready:
+                    ok, result = self.connection.recv()
+            except (EOFError, OSError) as e:
+                self.kill()
+                raise OSError(f"Remote filesystem worker died during {name}: {e}")
+
+            if not ready:
+                self.logger.log(f"Remote operation {name}{args} did not finish within {timeout:.0f}s, "
+                                f"killing worker {self.pid}", log_level=1)
+                self.kill()
+                raise RemoteOperationTimeout(f"{name} timed out after {time.time() - start_time:.1f}s")
+
+        if not ok:
+            raise result
+        return result
+
+    def stop(self):
+        with self.lock:
+            if self.is_alive():
+                self.connection.close()
+                deadline = time.time() + 1
+                while self.is_alive() and time.time() < deadline:
+                    time.sleep(0.05)
+                if self.is_alive():
+                    self.kill()
+            self.pid = None
+            self.connection = None
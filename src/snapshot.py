@@ -0,0 +1,235 @@
+import os
+import socket
+import threading
+import time
+
+from collections import deque
+
+from src.cpu_placement import LatenessStats
+
+
+class SnapshotRequest:
+    """A snapshot requested by a signal or a socket client, completed by the Recorder loop."""
+
+    def __init__(self, source, target=None):
+        self.source = source
+        self.target = target  # Path of the file, or None for a new file in the snapshot folder
+        self.request_time = time.time()
+        self.path = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class SnapshotService:
+    """
+    Queue of on-demand snapshots, served by the recording loop between two frames or during a
+    pause, so that they never race with the capture of the recording.
+
+    Requests come from SIGUSR1 (``request`` only appends to a deque, which is safe in a signal
+    handler) or, if ``socket_path`` is set, from a local Unix socket: a client sends ``snapshot``
+    and receives ``SUCCESS <path> <latency in s>`` or ``ERROR <message>`` once the file is written.
+
+    A request is served only if it can be completed before the next frame is due: the expected
+    duration of a snapshot is the 95th percentile of the previous ones (``min_duration`` at first).
+    The snapshots are saved to ``snapshot_dir``, not to the part folders, with a
+    ``last_snapshot.jpg`` link to the most recent one.
+
+    The IR LED is turned on ``ir_lead`` seconds before the capture (one exposure and the frame in
+    flight) and turned off as soon as the frame is captured. During a recording, the snapshots are
+    taken between two pulses of the IR illumination program (which lights the frames only), so
+    that neither turns the LED off during the exposure of the other.
+
+    The snapshots do not count as frames of the recording: a late one is cancelled before the next
+    frame, without restarting the camera script (see CameraController.capture_snapshot).
+
+    :param snapshot_dir: Folder of the snapshots.
+    :param camera: CameraController capturing the snapshots.
+    :param lights: LightController, for the IR LED.
+    :param ir_lead: Time between turning the IR LED on and the capture, in seconds.
+    :param min_duration: Initial estimate of the duration of a snapshot, in seconds.
+    :param socket_path: Path of the Unix socket accepting requests, or None.
+    :param logger: Logger instance.
+    """
+
+    PULSE_MARGIN = 0.05  # Time between the end of a snapshot and the next IR pulse, in seconds
+
+    def __init__(self, snapshot_dir, camera, lights, ir_lead=0.25, min_duration=0.5, socket_path=None,
+                 logger=None):
+        self.snapshot_dir = snapshot_dir
+        self.camera = camera
+        self.lights = lights
+        self.ir_lead = ir_lead
+        self.min_duration = min_duration
+        self.socket_path = socket_path
+        self.logger = logger
+
+        self.pending = deque()
+        self.n_snapshots = 0
+        self.latency = LatenessStats(late_threshold=1.0)  # Request to file
+        self.durations = LatenessStats()  # Capture alone, to decide if a request fits before the next frame
+        self.server = None
+
+    @classmethod
+    def from_parameters(cls, tmp_folder, camera, lights, parameters, logger=None):
+        # One exposure plus the frame already being exposed when the LED is turned on
+        default_lead = 2 * parameters.get("shutter_speed", 50000) / 1e6 + 0.05
+        return cls(snapshot_dir=os.path.join(tmp_folder, "snapshots"),
+                   camera=camera,
+                   lights=lights,
+                   ir_lead=parameters.get("snapshot_ir_lead_s") or default_lead,
+                   min_duration=parameters.get("snapshot_min_duration_s", 0.5),
+                   socket_path=os.path.join(tmp_folder, "snapshot.sock") if parameters.get("snapshot_socket", False)
+                   else None,
+                   logger=logger)
+
+    def request(self, source="signal", target=None):
+        """
+        Queue a snapshot. Safe to call from a signal handler.
+
+        :param source: Origin of the request, for the logs.
+        :param target: Path of the file, or None for a new file in the snapshot folder.
+        :return: The SnapshotRequest, whose ``done`` event is set once it is served.
+        """
+        snapshot = SnapshotRequest(source, target)
+        self.pending.append(snapshot)
+        return snapshot
+
+    def has_pending(self):
+        return len(self.pending) > 0
+
+    def get_expected_duration(self, ir_gating=False):
+        duration = max(self.durations.percentile(95), self.min_duration)
+        return duration + (self.ir_lead if ir_gating else 0.0)
+
+    def serve(self, deadline, ir_gating=False):
+        """
+        Take the pending snapshots that can be completed before the deadline.
+
+        :param deadline: Time when the next frame is due, as given by time.time().
+        :param ir_gating: Turn the IR LED on for the snapshot (the LEDs are paused).
+        """
+        while self.pending and time.time() + self.get_expected_duration(ir_gating) < deadline:
+            self.capture(self.pending.popleft(), deadline, ir_gating)
+
+    def wait_and_serve(self, until, ir_gating=False, poll_interval=0.05, between_ir_pulses=False):
+        """
+        Sleep until the given time, serving the snapshots requested meanwhile.
+
+        :param between_ir_pulses: The IR illumination program is running: the snapshots are lit by
+            the IR LED and only taken between its pulses.
+        """
+        while True:
+            if between_ir_pulses:
+                now = time.time()
+                dark_start, dark_end = self.lights.get_ir_dark_window(now)
+                if now >= dark_start:
+                    self.serve(min(until, dark_end - self.PULSE_MARGIN), ir_gating=True)
+            else:
+                self.serve(until, ir_gating=ir_gating)
+            remaining = until - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(poll_interval, remaining))
+
+    def get_snapshot_path(self):
+        self.n_snapshots += 1
+        name = time.strftime("snapshot_%Y%m%d_%H%M%S", time.localtime()) + f"_{self.n_snapshots:03d}.jpg"
+        return os.path.join(self.snapshot_dir, name)
+
+    def capture(self, snapshot, deadline, ir_gating=False):
+        path = snapshot.target or self.get_snapshot_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        ir = self.lights["IR"] if ir_gating else None
+
+        start_time = time.time()
+        try:
+            if ir is not None:
+                ir.turn_on()
+                time.sleep(self.ir_lead)
+            capture_start = time.time()
+            if self.camera.capture_snapshot(path, deadline=deadline):
+                self.durations.record(time.time() - capture_start)
+                snapshot.path = path
+            else:
+                snapshot.error = "capture failed"
+        except (RuntimeError, TimeoutError, OSError) as e:
+            snapshot.error = str(e)
+        finally:
+            if ir is not None:
+                ir.turn_off()
+
+        if snapshot.path is not None:
+            self.latency.record(time.time() - snapshot.request_time)
+            if snapshot.target is None:
+                self.update_link(path)
+            self.logger.log(f"Snapshot ({snapshot.source}) saved to {path}: "
+                            f"{time.time() - snapshot.request_time:.2f}s after the request, "
+                            f"{time.time() - start_time:.2f}s to capture", log_level=3)
+        else:
+            self.logger.log(f"Snapshot ({snapshot.source}) failed: {snapshot.error}", log_level=2)
+        snapshot.done.set()
+
+    def update_link(self, path):
+        link = os.path.join(self.snapshot_dir, "last_snapshot.jpg")
+        tmp_link = f"{link}.tmp"
+        try:
+            if os.path.lexists(tmp_link):
+                os.remove(tmp_link)
+            os.symlink(path, tmp_link)
+            os.replace(tmp_link, link)
+        except OSError as e:
+            self.logger.log(f"Cannot link {link} to the last snapshot: {e}", log_level=2)
+
+    # Local socket
+
+    def start(self):
+        """Listen for requests on the Unix socket, if one is configured."""
+        if self.socket_path is None:
+            return
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        self.server.listen()
+        threading.Thread(target=self.accept_requests, daemon=True).start()
+        self.logger.log(f"Snapshot requests accepted on {self.socket_path}", log_level=3)
+
+    def accept_requests(self):
+        while self.server is not None:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle_client, args=(connection,), daemon=True).start()
+
+    def handle_client(self, connection, timeout=60):
+        with connection:
+            try:
+                command = connection.makefile().readline().strip()
+                if command != "snapshot":
+                    connection.sendall(f"ERROR unknown command '{command}'\n".encode())
+                    return
+                snapshot = self.request(source="socket")
+                if not snapshot.done.wait(timeout):
+                    connection.sendall(b"ERROR timed out\n")
+                elif snapshot.path is None:
+                    connection.sendall(f"ERROR {snapshot.error}\n".encode())
+                else:
+                    latency = time.time() - snapshot.request_time
+                    connection.sendall(f"SUCCESS {snapshot.path} {latency:.3f}\n".encode())
+            except OSError as e:
+                self.logger.log(f"Snapshot client error: {e}", log_level=2)
+
+    def get_summary(self):
+        return f"request to file: {self.latency.summary()}"
+
+    def stop(self):
+        if self.server is not None:
+            server, self.server = self.server, None
+            server.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+        for snapshot in self.pending:
+            snapshot.error = "recording stopped"
+            snapshot.done.set()
+        self.pending.clear()
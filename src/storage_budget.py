@@ -0,0 +1,263 @@
+import json
+import os
+import threading
+import time
+
+from multiprocessing import Array, Value
+
+from src.recovery import RecoveryService
+
+
+class StorageBudget:
+    """
+    Budget of the local storage used by a recording, so that a long outage of the remote storage
+    does not silently fill the SD card.
+
+    The bytes are tracked per state, with incremental updates done where the files are created,
+    compressed, queued and deleted (in the Recorder, the compression workers and the upload
+    processes, hence the shared memory):
+
+    - ``raw``: frames not compressed yet;
+    - ``encoded``: compressed parts (and analysis outputs) not uploaded yet;
+    - ``pending``: files in the spool of the upload queue.
+
+    The folders are only scanned by ``reconcile``, in a background thread at startup and then
+    every ``reconcile_period`` seconds, to correct the drift of the incremental accounting (files
+    removed by hand, crashes...).
+
+    ``check`` measures the net growth of the tracked bytes and the free space of the filesystem, and
+    projects the time until it is full. The storage level is:
+
+    - ``critical`` if the free space is under ``min_free_mb`` or will be within ``critical_hours``,
+    - ``warning`` if it will be full within ``warning_hours``,
+    - ``ok`` otherwise.
+
+    Each level activates a configurable list of degradation policies:
+
+    - ``lower_quality``: the parts are encoded in x264 (instead of a lossless or archival format)
+      with a higher CRF;
+    - ``reencode``: a part whose compression failed is encoded again, with the lower_quality
+      settings, before its frames are kept for a later recovery;
+    - ``delete_unencoded``: the frames of a part whose compression failed (after the retry of
+      ``reencode``) are deleted instead of kept. As this loses the only copy of the part, it is in
+      no default level and logged as an alert.
+
+    :param recording_folder: Local folder where the parts are written.
+    :param spool_dir: Spool folder of the upload queue.
+    :param warning_hours: Time to full under which the level is "warning".
+    :param critical_hours: Time to full under which the level is "critical".
+    :param min_free_mb: Free space under which the level is "critical".
+    :param policies: Dictionary of the policies active at each level.
+    :param crf_increase: CRF added by the lower_quality policy.
+    :param reconcile_period: Time between two scans of the folders, in seconds.
+    :param logger: Logger instance.
+    """
+
+    STATES = ("raw", "encoded", "pending")
+    LEVELS = ("ok", "warning", "critical")
+    POLICIES = ("lower_quality", "reencode", "delete_unencoded")
+    DEFAULT_POLICIES = {"warning": ["lower_quality"], "critical": ["lower_quality", "reencode"]}
+
+    RATE_SMOOTHING = 0.3  # Weight of the last measure in the smoothed growth rate
+
+    def __init__(self, recording_folder, spool_dir=None, warning_hours=24, critical_hours=2, min_free_mb=500,
+                 policies=None, crf_increase=6, reconcile_period=3600, logger=None):
+        self.recording_folder = recording_folder
+        self.spool_dir = spool_dir
+        self.warning_hours = warning_hours
+        self.critical_hours = critical_hours
+        self.min_free = min_free_mb * 1024 * 1024
+        self.policies = policies if policies is not None else self.DEFAULT_POLICIES
+        self.crf_increase = crf_increase
+        self.reconcile_period = reconcile_period
+        self.logger = logger
+
+        for level, names in self.policies.items():
+            for name in names:
+                if name not in self.POLICIES:
+                    self.logger.log(f"Unknown storage policy '{name}' for level {level}, ignored", log_level=2)
+
+        self.bytes = Array('d', [0.0] * len(self.STATES))
+        self.level = Value('i', 0)
+
+        # Growth measures, only used by the process calling check (the Recorder)
+        self.rate = 0.0
+        self.free = None
+        self.time_to_full = float('inf')
+        self.last_total = None
+        self.last_check = None
+        self.last_reconcile = 0.0
+        self.reconciling = None
+
+    @classmethod
+    def from_parameters(cls, recording_folder, spool_dir, parameters, logger=None):
+        return cls(recording_folder, spool_dir=spool_dir,
+                   warning_hours=parameters.get("storage_warning_h", 24),
+                   critical_hours=parameters.get("storage_critical_h", 2),
+                   min_free_mb=parameters.get("storage_min_free_mb", 500),
+                   policies=parameters.get("storage_policies"),
+                   crf_increase=parameters.get("storage_crf_increase", 6),
+                   reconcile_period=parameters.get("storage_reconcile_period_s", 3600),
+                   logger=logger)
+
+    # Incremental accounting
+
+    def add(self, state, n_bytes):
+        with self.bytes.get_lock():
+            self.bytes[self.STATES.index(state)] += n_bytes
+
+    def remove(self, state, n_bytes):
+        with self.bytes.get_lock():
+            index = self.STATES.index(state)
+            self.bytes[index] = max(0.0, self.bytes[index] - n_bytes)
+
+    def move(self, source, destination, n_bytes, n_bytes_destination=None):
+        """
+        Account for files going from one state to another, e.g. a part folder compressed to a
+        smaller file (n_bytes_destination).
+        """
+        self.remove(source, n_bytes)
+        if destination is not None:
+            self.add(destination, n_bytes if n_bytes_destination is None else n_bytes_destination)
+
+    def get(self, state):
+        return self.bytes[self.STATES.index(state)]
+
+    def total(self):
+        with self.bytes.get_lock():
+            return sum(self.bytes)
+
+    # Scans
+
+    def scan(self):
+        """
+        :return: Bytes per state found in the folders.
+        """
+        found = dict.fromkeys(self.STATES, 0)
+        folders = [self.recording_folder]
+        recovery_folder = os.path.join(self.recording_folder, "recovery")
+        if os.path.isdir(recovery_folder):
+            folders += [entry.path for entry in os.scandir(recovery_folder) if entry.is_dir()]
+
+        for folder in folders:
+            for entry in os.scandir(folder):
+                # Parts linked to the RAM staging area are not on the SD card
+                if entry.is_dir(follow_symlinks=False) and RecoveryService.PART_DIR.match(entry.name):
+                    found["raw"] += sum(frame.stat().st_size for frame in os.scandir(entry.path) if frame.is_file())
+                elif entry.is_file() and entry.name.endswith(".jpg"):
+                    found["raw"] += entry.stat().st_size
+                elif entry.is_file() and RecoveryService.PART_FILE.match(entry.name):
+                    found["encoded"] += entry.stat().st_size
+
+        if self.spool_dir and os.path.isdir(self.spool_dir):
+            found["pending"] = sum(entry.stat().st_size for entry in os.scandir(self.spool_dir) if entry.is_file())
+        return found
+
+    def reconcile(self):
+        """Replace the tracked bytes by the ones found in the folders."""
+        start_time = time.time()
+        try:
+            found = self.scan()
+        except OSError as e:
+            self.logger.log(f"Cannot scan the local storage: {e}", log_level=2)
+            return
+
+        with self.bytes.get_lock():
+            drift = {state: found[state] - self.bytes[i] for i, state in enumerate(self.STATES)}
+            for i, state in enumerate(self.STATES):
+                self.bytes[i] = found[state]
+        # The correction is not growth: the next check starts a new measure
+        self.last_check = None
+
+        self.logger.log(f"Local storage scanned in {time.time() - start_time:.1f}s: "
+                        + ", ".join(f"{state} {found[state] / 1e6:.0f} MB ({drift[state] / 1e6:+.0f} MB)"
+                                    for state in self.STATES), log_level=4)
+
+    def start_reconcile(self):
+        """Reconcile in a background thread, unless a scan is already running."""
+        if self.reconciling is not None and self.reconciling.is_alive():
+            return
+        self.last_reconcile = time.time()
+        self.reconciling = threading.Thread(target=self.reconcile, daemon=True)
+        self.reconciling.start()
+
+    # Projection and policies
+
+    def get_free_space(self):
+        stats = os.statvfs(self.recording_folder)
+        return stats.f_bavail * stats.f_frsize
+
+    def check(self):
+        """
+        Update the growth rate, the time to full and the storage level.
+
+        :return: True if the level changed.
+        """
+        now = time.time()
+        if now - self.last_reconcile > self.reconcile_period:
+            self.start_reconcile()
+
+        total = self.total()
+        if self.last_check is not None and now > self.last_check:
+            rate = (total - self.last_total) / (now - self.last_check)
+            self.rate = self.RATE_SMOOTHING * rate + (1 - self.RATE_SMOOTHING) * self.rate
+        self.last_total, self.last_check = total, now
+
+        try:
+            self.free = self.get_free_space()
+        except OSError as e:
+            self.logger.log(f"Cannot read the free space of {self.recording_folder}: {e}", log_level=2)
+            return False
+
+        self.time_to_full = (self.free - self.min_free) / self.rate if self.rate > 0 else float('inf')
+
+        if self.free < self.min_free or self.time_to_full < self.critical_hours * 3600:
+            level = 2
+        elif self.time_to_full < self.warning_hours * 3600:
+            level = 1
+        else:
+            level = 0
+
+        if level == self.level.value:
+            return False
+
+        previous = self.LEVELS[self.level.value]
+        self.level.value = level
+        policies = self.get_active_policies()
+        self.logger.log(f"Local storage {previous} -> {self.LEVELS[level]}: {self.get_summary()}"
+                        + (f", policies: {', '.join(policies)}" if policies else ""),
+                        log_level=1 if level == 2 else 2 if level == 1 else 3)
+        return True
+
+    def get_level(self):
+        return self.LEVELS[self.level.value]
+
+    def get_active_policies(self):
+        return list(self.policies.get(self.get_level(), []))
+
+    def is_active(self, policy):
+        return policy in self.get_active_policies()
+
+    def get_summary(self):
+        time_to_full = "never" if self.time_to_full == float('inf') else f"{self.time_to_full / 3600:.1f}h"
+        free = f"{self.free / 1e6:.0f} MB" if self.free is not None else "unknown"
+        return (f"{free} free, full in {time_to_full} at {self.rate * 3600 / 1e6:+.0f} MB/h ("
+                + ", ".join(f"{state} {self.get(state) / 1e6:.0f} MB" for state in self.STATES) + ")")
+
+    def get_alert(self):
+        """:return: Alert line for the status file, or None if the level is ok."""
+        if self.level.value == 0:
+            return None
+        return f"Storage {self.get_level()}: {self.get_summary()}"
+
+    def write_report(self, path):
+        """Write the state of the budget to a JSON file, next to the status file."""
+        report = {"level": self.get_level(),
+                  "free_bytes": self.free,
+                  "time_to_full_s": None if self.time_to_full == float('inf') else self.time_to_full,
+                  "growth_bytes_per_s": self.rate,
+                  "bytes": {state: self.get(state) for state in self.STATES},
+                  "policies": self.get_active_policies(),
+                  "time": time.time()}
+        with open(path, "w") as f:
+            json.dump(report, f, indent=4)
@@ -0,0 +1,146 @@
+"""
+Compare the compression formats of the parts on real part folders:
+
+- mkv: lossy x264 video (the default),
+- ffv1: lossless FFV1 video,
+- tzst: tar archive compressed in-process by multi-threaded zstd,
+- tgz: tar archive compressed by gzip.
+
+Each part is compressed with UploadManager.compress, as in a recording, and checked by the
+CompressionVerifier. The part folders are only read: the outputs are written to a temporary
+directory and deleted. The frames are read once before the runs, so that every format reads
+them from the page cache. The thread counts are the ones of a recording with the CPU placement
+of the configuration file.
+
+Reported for each format: compression ratio, throughput (MB of frames per second), CPU share
+(CPU time of the compression over its duration, 100% per busy core) and encode speed relative
+to capture (seconds of capture encoded per second).
+
+Usage:
+    python3 src/tools/compression_benchmark/compare_formats.py ~/.wormstation_recordings/part00 [part01 ...] \
+        [--formats mkv ffv1 tzst tgz] [--zstd-levels 3 9] [--config config.json]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Dynamically add the project root directory to the Python module search path
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(current_dir, "../../../"))
+sys.path.insert(0, project_root)
+
+from src.archive import get_folder_size, process_cpu_time
+from src.cpu_placement import CPUPlacement
+from src.log import FakeLogger
+from src.upload_manager import UploadManager
+
+
+class BenchmarkCompressor(UploadManager):
+    """UploadManager without remote storage, only used for its compression."""
+
+    def get_tree_structure(self, remote_dir, recording_name):
+        return recording_name
+
+    def get_remote_address(self):
+        return "127.0.0.1", 0
+
+    def get_mount_point(self):
+        return None
+
+
+def read_frames(folder_name):
+    for name in os.listdir(folder_name):
+        with open(os.path.join(folder_name, name), "rb") as f:
+            while f.read(4 * 1024 * 1024):
+                pass
+
+
+def run(compressor, part, format):
+    n_frames = compressor.count_frames(part)
+    input_size = get_folder_size(part)
+
+    start_time, start_cpu = time.time(), process_cpu_time()
+    output_file = compressor.compress(part, format=format, n_frames=n_frames)
+    elapsed, cpu_time = time.time() - start_time, process_cpu_time() - start_cpu
+
+    if output_file is None:
+        return None
+    ok = compressor.check_compression(output_file, expected_frames=n_frames)
+    output_size = os.path.getsize(output_file)
+    os.remove(output_file)
+    return {"input": input_size, "output": output_size, "elapsed": elapsed, "cpu": cpu_time,
+            "frames": n_frames, "ok": ok}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the ratio, throughput and CPU share of the compression formats.")
+    parser.add_argument("parts", nargs="+", help="Part folders of a recording")
+    parser.add_argument("--formats", nargs="+", default=list(UploadManager.COMPRESSION_FORMATS),
+                        choices=UploadManager.COMPRESSION_FORMATS)
+    parser.add_argument("--zstd-levels", type=int, nargs="+", default=[3], help="zstd levels of the tzst runs")
+    parser.add_argument("--time-interval", type=float, default=None,
+                        help="Time between two frames of the recording (default: the one of the configuration)")
+    parser.add_argument("--config", default=os.path.join(project_root, "config.json"),
+                        help="Configuration of the station, for the CPU placement and encoder settings")
+    parser.add_argument("--verify-level", default="sample", choices=("header", "sample", "full"))
+    args = parser.parse_args()
+
+    logger = FakeLogger(max_level=2)
+    with open(args.config) as f:
+        config = json.load(f)
+    time_interval = args.time_interval or config.get("time_interval", 1)
+
+    runs = []
+    for format in args.formats:
+        for level in (args.zstd_levels if format == "tzst" else [None]):
+            runs.append((format, level))
+
+    tmp_dir = tempfile.mkdtemp()
+    results = {}
+    try:
+        for format, level in runs:
+            parameters = {**config, "encoder_adaptive": False, "verify_level": args.verify_level,
+                          "time_interval": time_interval}
+            if level is not None:
+                parameters["zstd_level"] = level
+            compressor = BenchmarkCompressor(remote_server="", remote_dir="", recording_name="compression_benchmark",
+                                             local_dir=tmp_dir, logger=logger, parameters=parameters)
+            compressor.set_cpu_placement(CPUPlacement.from_parameters(config, logger=logger))
+
+            name = format if level is None else f"{format}-{level}"
+            results[name] = []
+            for part in args.parts:
+                # The outputs are written next to a link to the part, in the temporary directory
+                link = os.path.join(tmp_dir, os.path.basename(os.path.normpath(part)))
+                if not os.path.islink(link):
+                    os.symlink(os.path.abspath(part), link)
+                    read_frames(link)
+                result = run(compressor, link, format)
+                if result is None:
+                    print(f"{name:8s} {part}: compression failed")
+                    continue
+                results[name].append(result)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print(f"\n{'format':8s} {'ratio':>7s} {'MB/s':>7s} {'CPU':>6s} {'speed':>8s}  verified")
+    for name, parts in results.items():
+        if not parts:
+            continue
+        input_size = sum(r["input"] for r in parts)
+        output_size = sum(r["output"] for r in parts)
+        elapsed = sum(r["elapsed"] for r in parts)
+        cpu_time = sum(r["cpu"] for r in parts)
+        capture_time = sum(r["frames"] for r in parts) * time_interval
+        print(f"{name:8s} {input_size / max(output_size, 1):7.2f} {input_size / 1e6 / max(elapsed, 1e-3):7.1f} "
+              f"{cpu_time / max(elapsed, 1e-3):6.0%} {capture_time / max(elapsed, 1e-3):7.0f}x  "
+              f"{sum(r['ok'] for r in parts)}/{len(parts)}")
+
+
+if __name__ == "__main__":
+    main()
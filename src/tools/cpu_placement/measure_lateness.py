@@ -0,0 +1,107 @@
+"""
+Measure the lateness of a capture-like loop under compression load, with and without the CPU
+placement policy.
+
+The loop wakes up every --interval seconds and writes a frame-sized file, like the Recorder
+loop. Meanwhile, --encoders ffmpeg processes encode a synthetic video (or busy loops if ffmpeg
+is not installed), confined to the worker cores when the policy is on.
+
+Usage:
+    python3 src/tools/cpu_placement/measure_lateness.py [--interval 0.5] [--duration 60] [--capture-cores 3]
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from multiprocessing import Process
+
+# Dynamically add the project root directory to the Python module search path
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(current_dir, "../../../"))
+sys.path.insert(0, project_root)
+
+from src.cpu_placement import CPUPlacement, LatenessStats
+from src.log import FakeLogger
+
+
+def busy_loop():
+    while True:
+        pass
+
+
+def start_load(placement, n_encoders, threads):
+    processes = []
+    for _ in range(n_encoders):
+        if shutil.which("ffmpeg"):
+            cmd = ["ffmpeg", "-f", "lavfi", "-i", "testsrc2=size=1920x1080:rate=25", "-vcodec", "libx264",
+                   "-preset", "veryfast", "-threads", str(threads), "-f", "null", "-", "-loglevel", "quiet"]
+            process = subprocess.Popen(cmd, preexec_fn=lambda: (placement.apply_worker(), os.nice(19)))
+            processes.append(process)
+        else:
+            for _ in range(threads):
+                process = Process(target=busy_loop, daemon=True)
+                process.start()
+                placement.apply_worker(process.pid)
+                processes.append(process)
+    return processes
+
+
+def stop_load(processes):
+    for process in processes:
+        process.kill() if isinstance(process, subprocess.Popen) else process.terminate()
+    for process in processes:
+        process.wait() if isinstance(process, subprocess.Popen) else process.join()
+
+
+def run(placement, args, frame):
+    placement.apply_capture(all_threads=False)
+    load = start_load(placement, args.encoders, placement.get_worker_threads())
+    stats = LatenessStats()
+
+    tmp_dir = tempfile.mkdtemp()
+    start_time = time.time()
+    n_frames = int(args.duration / args.interval)
+    try:
+        for frame_number in range(n_frames):
+            delay = time.time() - (start_time + frame_number * args.interval)
+            stats.record(delay)
+            if delay < 0:
+                time.sleep(-delay)
+            with open(os.path.join(tmp_dir, f"frame{frame_number:06d}.jpg"), "wb") as f:
+                f.write(frame)
+    finally:
+        stop_load(load)
+        shutil.rmtree(tmp_dir)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the capture lateness with and without CPU placement.")
+    parser.add_argument("--interval", type=float, default=0.5, help="Time between two frames in seconds")
+    parser.add_argument("--duration", type=float, default=60, help="Duration of each run in seconds")
+    parser.add_argument("--encoders", type=int, default=1, help="Number of concurrent encoders")
+    parser.add_argument("--capture-cores", type=int, nargs="+", default=None)
+    parser.add_argument("--frame-kb", type=int, default=800, help="Size of the written frames")
+    args = parser.parse_args()
+
+    logger = FakeLogger(max_level=3)
+    frame = os.urandom(args.frame_kb * 1024)
+
+    results = {}
+    all_cores = os.sched_getaffinity(0)
+    for enabled in (False, True):
+        placement = CPUPlacement(enabled=enabled, capture_cores=args.capture_cores, logger=logger)
+        results["on" if enabled else "off"] = run(placement, args, frame)
+        os.sched_setaffinity(0, all_cores)
+
+    for name, stats in results.items():
+        print(f"CPU placement {name:3s}: {stats.summary()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Check the S3 upload backend (S3Manager) against an S3-compatible store, typically a local MinIO:
+multipart upload, resume of an interrupted multipart upload, tagging, size and checksum
+verification, and throughput for several concurrency levels.
+
+A throwaway MinIO server can be started with:
+
+    minio server /tmp/minio --address 127.0.0.1:9000 &
+    printf "access_key=minioadmin\nsecret_key=minioadmin\n" > /tmp/s3creds
+    mc alias set local http://127.0.0.1:9000 minioadmin minioadmin && mc mb local/wormstation
+
+Usage:
+    python3 src/tools/upload_benchmark/check_s3_backend.py http://127.0.0.1:9000 wormstation /tmp/s3creds \
+        [--size-mb 200] [--concurrency 1 4 8]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+# Dynamically add the project root directory to the Python module search path
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(current_dir, "../../../"))
+sys.path.insert(0, project_root)
+
+from src.file_transfer import ChunkedCopier
+from src.log import FakeLogger
+from src.upload_manager import S3Manager
+
+
+def get_uploader(args, logger, concurrency):
+    parameters = {"s3_part_mb": args.part_mb, "s3_max_concurrency": concurrency, "upload_verify": "checksum"}
+    uploader = S3Manager(endpoint=args.endpoint, bucket=args.bucket, remote_dir="s3_check", recording_name="check",
+                         credentials_file=args.credentials_file, logger=logger, parameters=parameters)
+    if not uploader.mount():
+        sys.exit(f"Cannot access bucket {args.bucket} on {args.endpoint}")
+    return uploader
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the S3 upload backend against an S3-compatible store.")
+    parser.add_argument("endpoint", help="URL of the store, e.g. http://127.0.0.1:9000")
+    parser.add_argument("bucket")
+    parser.add_argument("credentials_file", help="File with access_key= and secret_key= lines")
+    parser.add_argument("--size-mb", type=int, default=200)
+    parser.add_argument("--part-mb", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args()
+
+    logger = FakeLogger(max_level=3)
+    copier = ChunkedCopier(logger=logger)
+    results = []
+
+    # The checksum manifest is written in the working directory
+    tmp_dir = tempfile.mkdtemp()
+    os.chdir(tmp_dir)
+    source = os.path.join(tmp_dir, "part.mkv")
+    with open(source, "wb") as f:
+        for _ in range(args.size_mb):
+            f.write(os.urandom(1024 * 1024))
+
+    try:
+        for concurrency in args.concurrency:
+            uploader = get_uploader(args, logger, concurrency)
+            stats = uploader.remote_copy(copier, source, f"{uploader.full_path}/part.mkv")
+            print(f"Concurrency {concurrency}: {stats.throughput():.1f} MB/s ({stats.duration:.1f}s)")
+        results.append(("multipart upload verified", uploader.upload_check(source)))
+
+        tags = uploader.s3_call("get_object_tagging", Key=f"{uploader.full_path}/part.mkv")["TagSet"]
+        results.append(("object tagged", {tag["Key"] for tag in tags} >= {"recording", "host", "kind"}))
+
+        # Interrupted upload: upload the first half of the parts only, then resume
+        destination = f"{uploader.full_path}/resumed.mkv"
+        upload_id = uploader.s3_call("create_multipart_upload", Key=destination,
+                                     ChecksumAlgorithm=uploader.s3_checksum)["UploadId"]
+        n_parts = -(-os.path.getsize(source) // uploader.part_size)
+        with open(source, "rb") as f:
+            for number in range(1, n_parts // 2 + 1):
+                data = os.pread(f.fileno(), uploader.part_size, (number - 1) * uploader.part_size)
+                uploader.s3_call("upload_part", Key=destination, UploadId=upload_id, PartNumber=number, Body=data,
+                                 **{f"Checksum{uploader.s3_checksum}": uploader.part_checksum(data)})
+        stats = uploader.remote_copy(copier, source, destination)
+        print(f"Resumed upload: from byte {stats.resumed_from}, {stats.throughput():.1f} MB/s")
+        results.append(("upload resumed", stats.resumed_from > 0))
+        results.append(("resumed upload verified", uploader.upload_check(source, "resumed.mkv")))
+
+        for key in ("part.mkv", "resumed.mkv", f"checksums.{uploader.checksum_algorithm}"):
+            uploader.s3_call("delete_object", Key=f"{uploader.full_path}/{key}")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    for name, ok in results:
+        print(f"{'OK  ' if ok else 'FAIL'} {name}")
+    sys.exit(0 if all(ok for _, ok in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
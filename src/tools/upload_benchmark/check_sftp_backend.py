@@ -0,0 +1,93 @@
+"""
+Check the SFTP upload backend (SSHManager) against an SSH server, typically a local sshd:
+full upload, resume of an interrupted upload, size and checksum verification, and throughput.
+
+A throwaway sshd for the current user can be started with:
+
+    ssh-keygen -q -N "" -t ed25519 -f /tmp/sshd_host_key
+    /usr/sbin/sshd -D -p 2222 -h /tmp/sshd_host_key -o PidFile=/tmp/sshd.pid &
+    ssh-keyscan -p 2222 127.0.0.1 >> ~/.ssh/known_hosts
+
+Usage:
+    python3 src/tools/upload_benchmark/check_sftp_backend.py 127.0.0.1 /tmp/sftp_upload --port 2222 [--size-mb 200]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+# Dynamically add the project root directory to the Python module search path
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(current_dir, "../../../"))
+sys.path.insert(0, project_root)
+
+from src.file_transfer import ChunkedCopier
+from src.log import FakeLogger
+from src.upload_manager import SSHManager
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the SFTP upload backend against an SSH server.")
+    parser.add_argument("server", help="SSH server, e.g. 127.0.0.1")
+    parser.add_argument("ssh_dir", help="Base directory on the server")
+    parser.add_argument("--user", default=None)
+    parser.add_argument("--port", type=int, default=22)
+    parser.add_argument("--key-file", default=None)
+    parser.add_argument("--size-mb", type=int, default=200)
+    parser.add_argument("--chunk-mb", type=int, default=8)
+    args = parser.parse_args()
+
+    logger = FakeLogger(max_level=3)
+    parameters = {"ssh_port": args.port, "ssh_key_file": args.key_file, "upload_chunk_mb": args.chunk_mb,
+                  "upload_verify": "checksum"}
+    uploader = SSHManager(ssh_server=args.server, ssh_user=args.user, remote_dir="sftp_check", recording_name="check",
+                          ssh_dir=args.ssh_dir, logger=logger, parameters=parameters)
+
+    if not uploader.mount():
+        sys.exit(f"Cannot connect to {args.server}:{args.port}")
+    uploader.create_working_dir()
+
+    # The checksum manifest is written in the working directory
+    tmp_dir = tempfile.mkdtemp()
+    os.chdir(tmp_dir)
+    source = os.path.join(tmp_dir, "part.bin")
+    with open(source, "wb") as f:
+        for _ in range(args.size_mb):
+            f.write(os.urandom(1024 * 1024))
+
+    copier = ChunkedCopier(chunk_size=args.chunk_mb * 1024 * 1024, logger=logger)
+    destination = f"{uploader.full_path}/part.bin"
+    results = []
+
+    try:
+        # Full upload
+        stats = uploader.remote_copy(copier, source, destination)
+        print(f"Full upload: {stats.throughput():.1f} MB/s ({stats.duration:.1f}s)")
+        results.append(("full upload verified", uploader.upload_check(source)))
+
+        # Interrupted upload: leave the first half as a partial file, then resume
+        uploader.sftp_call("remove", destination)
+        half = os.path.getsize(source) // 2
+        with open(source, "rb") as src, uploader.sftp_call("open", destination + ".partial", "wb") as partial:
+            partial.write(src.read(half))
+        stats = uploader.remote_copy(copier, source, destination)
+        print(f"Resumed upload: from byte {stats.resumed_from}, {stats.throughput():.1f} MB/s")
+        results.append(("upload resumed", stats.resumed_from > 0))
+        results.append(("resumed upload verified", uploader.upload_check(source)))
+
+        # Dropped connection: the next operation must open a new one
+        uploader.client.close()
+        results.append(("reconnected", uploader.ensure_remote_access() and uploader.file_exists("part.bin")))
+    finally:
+        shutil.rmtree(tmp_dir)
+        uploader.unmount()
+
+    for name, ok in results:
+        print(f"{'OK  ' if ok else 'FAIL'} {name}")
+    sys.exit(0 if all(ok for _, ok in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
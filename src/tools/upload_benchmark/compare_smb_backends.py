@@ -0,0 +1,89 @@
+"""
+Compare the upload throughput of the two SMB backends on the same server:
+
+- mount: ChunkedCopier writing to a cifs mount point of the share (SMBManager),
+- direct: pipelined writes over smbprotocol, without mount (SMBDirectManager).
+
+A local Samba server is enough to run it, e.g. with a share "bench" in /etc/samba/smb.conf,
+mounted on /mnt/bench with the same credentials file:
+
+    python3 src/tools/upload_benchmark/compare_smb_backends.py //127.0.0.1/bench /etc/.smbpicreds \
+        --mount-point /mnt/bench [--size-mb 500] [--depths 1 4 8 16]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+# Dynamically add the project root directory to the Python module search path
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(current_dir, "../../../"))
+sys.path.insert(0, project_root)
+
+from src.file_transfer import ChunkedCopier
+from src.log import FakeLogger
+from src.upload_manager import SMBDirectManager
+
+
+def run_mount(source, mount_point, chunk_size, logger):
+    copier = ChunkedCopier(chunk_size=chunk_size, logger=logger)
+    destination = os.path.join(mount_point, "smb_benchmark.bin")
+    stats = copier.copy(source, destination)
+    os.remove(destination)
+    return stats
+
+
+def run_direct(source, server, credentials_file, depth, chunk_size, logger):
+    share_name = server.lstrip("/").split("/")[1]
+    uploader = SMBDirectManager(nas_server=server, share_name=share_name, credentials_file=credentials_file,
+                                working_dir="", logger=logger,
+                                parameters={"smb_pipeline_depth": depth, "upload_chunk_mb": chunk_size // 1024 // 1024})
+    if not uploader.mount():
+        raise RuntimeError(f"Cannot open a SMB session to {server}")
+
+    copier = ChunkedCopier(chunk_size=chunk_size, logger=logger)
+    destination = f"{uploader.local_dir}/smb_benchmark.bin"
+    stats = uploader.remote_copy(copier, source, destination)
+
+    import smbclient
+    uploader.smb_call(smbclient.remove, destination)
+    uploader.unmount()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the mount and mount-free SMB upload backends.")
+    parser.add_argument("server", help="Share to upload to, e.g. //127.0.0.1/bench")
+    parser.add_argument("credentials_file", help="Credentials file (username=, password=, domain=)")
+    parser.add_argument("--mount-point", help="Mount point of the same share, to benchmark the mount backend")
+    parser.add_argument("--size-mb", type=int, default=500, help="Size of the uploaded file")
+    parser.add_argument("--chunk-mb", type=int, default=8)
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 4, 8, 16],
+                        help="Pipeline depths to benchmark for the direct backend")
+    args = parser.parse_args()
+
+    logger = FakeLogger(max_level=2)
+    chunk_size = args.chunk_mb * 1024 * 1024
+
+    tmp_dir = tempfile.mkdtemp()
+    source = os.path.join(tmp_dir, "part.bin")
+    with open(source, "wb") as f:
+        for _ in range(args.size_mb):
+            f.write(os.urandom(1024 * 1024))
+
+    try:
+        if args.mount_point:
+            stats = run_mount(source, args.mount_point, chunk_size, logger)
+            print(f"mount:            {stats.throughput():7.1f} MB/s ({stats.duration:.1f}s)")
+
+        for depth in args.depths:
+            stats = run_direct(source, args.server, args.credentials_file, depth, chunk_size, logger)
+            print(f"direct, depth {depth:2d}: {stats.throughput():7.1f} MB/s ({stats.duration:.1f}s)")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Simulate several stations uploading a part at the same time, and measure the aggregate
+throughput to the destination (typically the mounted NAS) for each upload scheduling mode:
+
+- none: all stations upload immediately (thundering herd),
+- slots: each station waits for its hostname-hash slot,
+- coordinator: a local UploadCoordinator grants a limited number of tokens.
+
+Usage:
+    python3 src/tools/upload_benchmark/simulate_stations.py <destination_dir> [--stations 8] [--size-mb 200]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from multiprocessing import Process, Queue
+
+# Dynamically add the project root directory to the Python module search path
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(current_dir, "../../../"))
+sys.path.insert(0, project_root)
+
+from src.file_transfer import ChunkedCopier
+from src.log import FakeLogger
+from src.upload_slots import UploadScheduler, UploadCoordinator
+
+
+def station(hostname, mode, source, destination_dir, slot_period, n_slots, coordinator, results):
+    logger = FakeLogger(max_level=2)
+    scheduler = UploadScheduler(slot_period=slot_period, n_slots=n_slots,
+                                coordinator=coordinator if mode == "coordinator" else None,
+                                logger=logger, hostname=hostname)
+    copier = ChunkedCopier(logger=logger)
+    destination = os.path.join(destination_dir, f"{hostname}.bin")
+
+    request_time = time.time()
+    if mode == "none":
+        stats = copier.copy(source, destination)
+    else:
+        with scheduler.upload_slot():
+            stats = copier.copy(source, destination)
+
+    results.put((hostname, request_time, time.time() - stats.duration, time.time(), stats.transferred))
+    os.remove(destination)
+
+
+def run_mode(mode, args, source):
+    results = Queue()
+    coordinator = None
+    server = None
+
+    if mode == "coordinator":
+        server = UploadCoordinator(("127.0.0.1", 0), max_tokens=args.tokens)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        coordinator = f"127.0.0.1:{server.server_address[1]}"
+
+    stations = [Process(target=station,
+                        args=(f"wormstation{i:02d}", mode, source, args.destination, args.slot_period,
+                              args.slots, coordinator, results))
+                for i in range(args.stations)]
+
+    for p in stations:
+        p.start()
+    rows = [results.get() for _ in stations]
+    for p in stations:
+        p.join()
+
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+    first_request = min(row[1] for row in rows)
+    first_start = min(row[2] for row in rows)
+    last_end = max(row[3] for row in rows)
+    total_bytes = sum(row[4] for row in rows)
+    mb = 1024 * 1024
+
+    print(f"\n=== Mode: {mode} ===")
+    for hostname, request, start, end, size in sorted(rows, key=lambda row: row[2]):
+        print(f"{hostname}: waited {start - request:6.1f}s, copied in {end - start:6.1f}s "
+              f"({size / mb / (end - start):6.1f} MB/s)")
+    print(f"Aggregate throughput while uploading: {total_bytes / mb / (last_end - first_start):.1f} MB/s")
+    print(f"Time from first request to last upload done: {last_end - first_request:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure aggregate upload throughput of simulated stations.")
+    parser.add_argument("destination", help="Destination directory, e.g. a folder in the mounted NAS")
+    parser.add_argument("--stations", type=int, default=8)
+    parser.add_argument("--size-mb", type=int, default=200, help="Size of the simulated part")
+    parser.add_argument("--slot-period", type=float, default=60)
+    parser.add_argument("--slots", type=int, default=12)
+    parser.add_argument("--tokens", type=int, default=2, help="Tokens granted by the coordinator")
+    parser.add_argument("--modes", nargs="+", default=["none", "slots", "coordinator"])
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    source = os.path.join(tmp_dir, "part.bin")
+    with open(source, "wb") as f:
+        for _ in range(args.size_mb):
+            f.write(os.urandom(1024 * 1024))
+
+    try:
+        for mode in args.modes:
+            run_mode(mode, args, source)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,51 @@
+import base64
+import csv
+import fcntl
+import hashlib
 import os
+import posixpath
+import shlex
+import shutil
 import subprocess
 import pwd
 import time
 import pathlib
 import psutil
 
-import random
-
-from multiprocessing import Process
+from collections import deque
+from contextlib import nullcontext
+from multiprocessing import Array, Event, Lock, Process, Value
 from datetime import datetime
 from socket import gethostname
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlencode, urlparse
+
+from src.archive import get_folder_size, process_cpu_time, write_tar_zst, zstd_available
+from src.checksum import file_checksum, run_and_hash_output, append_to_manifest
+from src.compression_check import CompressionVerifier
+from src.compression_worker import CompressionWorker
+from src.cpu_placement import CPUPlacement
+from src.encoder_tuning import EncoderTuner
+from src.frame_staging import materialize_part, remove_part_folder
+from src.file_transfer import ChunkedCopier, RateLimiter, TransferStats
+from src.remote_health import RemoteHealth
+from src.remote_worker import RemoteFSWorker, RemoteOperationTimeout
+from src.upload_priority import UploadPriority
+from src.upload_queue import UploadQueue
+from src.upload_slots import UploadScheduler
 
 
 class UploadManager:
-    def __init__(self, remote_server, remote_dir, recording_name, local_dir=None, logger=None):
+    COMPRESSION_FORMATS = ("mkv", "ffv1", "tzst", "tgz")
+
+    def __init__(self, remote_server, remote_dir, recording_name, local_dir=None, logger=None, parameters=None):
+        """
+        :param parameters: Recording parameters, used for the optional upload and compression
+            settings (defaults are used for missing keys).
+        """
         self.username, self.uid, self.gid = self.get_user_info()
         self.remote_server = remote_server
+        self.parameters = parameters if parameters is not None else {}
 
         if logger is None:
             from src.log import Logger
@@ -27,15 +56,102 @@ class UploadManager:
         self.local_dir = local_dir if local_dir else f"/home/{self.username}/Remote"
         self.full_path = os.path.join(self.local_dir, self.remote_dir)
 
-        # self.task_queue = Queue()
-        self.compress_process = None
-
-        # Start the process manager
-        # self.manager_process = Process(target=self._process_queue)
-        # self.manager_process.start()
-
-
-
+        # Long-lived compression service, the worker processes are started on the first part
+        self.compression_worker = CompressionWorker(task=self.compress_analyze_and_upload,
+                                                    max_concurrent=self.parameters.get("compression_workers", 1),
+                                                    max_pending=self.parameters.get("compression_queue_size", 4),
+                                                    logger=self.logger)
+
+        self.verifier = CompressionVerifier(level=self.parameters.get("verify_level", "sample"), logger=self.logger)
+
+        # Smoothed capture lateness in seconds, reported by the Recorder and shared with the upload processes
+        self.capture_lateness = Value('d', 0.0)
+        self.lateness_threshold = self.parameters.get("upload_lateness_threshold", 0.1)
+
+        # Host-wide bandwidth cap (0 means unlimited), lowered automatically while the capture is late
+        max_rate = self.parameters.get("upload_max_mb_per_s", 0) * 1024 * 1024
+        self.rate_limiter = RateLimiter(max_rate=max_rate if max_rate > 0 else None,
+                                        min_rate=self.parameters.get("upload_min_mb_per_s", 0.5) * 1024 * 1024,
+                                        pressure=self.is_capture_late,
+                                        logger=self.logger)
+
+        # Priority classes: small realtime files (logs, status...) go before bulk videos
+        self.priority = UploadPriority(max_realtime=self.parameters.get("upload_max_realtime", 2),
+                                       max_bulk=self.parameters.get("upload_max_bulk", 1))
+
+        chunk_size = self.parameters.get("upload_chunk_mb", 8) * 1024 * 1024
+        self.copier = ChunkedCopier(chunk_size=chunk_size,
+                                    logger=self.logger,
+                                    rate_limiter=self.rate_limiter,
+                                    yield_to=self.priority.is_realtime_running)
+        self.realtime_copier = ChunkedCopier(chunk_size=chunk_size, logger=self.logger)
+
+        # Operations on the mount point run in a killable worker process with hard deadlines, so that
+        # a stale mount never blocks the calling process (e.g. the capture loop)
+        self.remote_fs = RemoteFSWorker(operations={"exists": os.path.exists,
+                                                    "getsize": os.path.getsize,
+                                                    "makedirs": os.makedirs,
+                                                    "copy": self.copier.copy,
+                                                    "copy_realtime": self.realtime_copier.copy,
+                                                    "append": self.realtime_copier.append,
+                                                    "checksum": file_checksum},
+                                        timeout=self.parameters.get("remote_op_timeout_s", 15),
+                                        logger=self.logger)
+        self.remote_min_rate = self.parameters.get("remote_min_mb_per_s", 0.25) * 1024 * 1024
+
+        # Verification of the remote copy: "exists", "size" or "checksum"
+        self.upload_verify = self.parameters.get("upload_verify", "checksum")
+        self.checksum_algorithm = self.parameters.get("checksum_algorithm", "sha256")
+        self.checksums = {}  # Checksums computed while compressing, indexed by absolute local path
+
+        # Large uploads wait for a token of the coordinator or for the slot of the station
+        self.upload_scheduler = UploadScheduler(slot_period=self.parameters.get("upload_slot_period", 60),
+                                                n_slots=self.parameters.get("upload_slots", 12),
+                                                coordinator=self.parameters.get("upload_coordinator"),
+                                                logger=self.logger)
+
+        # Durable queue of the failed uploads, drained by a background process
+        self.upload_queue = UploadQueue(path=f"/home/{self.username}/tmp/upload_queue/queue.sqlite",
+                                        backoff_base=self.parameters.get("upload_retry_base_s", 30),
+                                        backoff_max=self.parameters.get("upload_retry_max_s", 3600),
+                                        logger=self.logger)
+        self.queue_drainer = None
+        self.queue_drainer_stop = Event()
+
+        # CPU placement of the background processes, set by the Recorder (disabled by default)
+        self.cpu_placement = CPUPlacement()
+
+        # x264 preset and threads adapted to the measured encode throughput
+        self.encoder_tuner = EncoderTuner(frame_interval=self.parameters.get("time_interval", 1),
+                                          target_fraction=self.parameters.get("encoder_target_fraction", 0.5),
+                                          preset=self.parameters.get("encoder_preset", "veryfast"),
+                                          threads=self.cpu_placement.get_worker_threads(),
+                                          max_threads=os.cpu_count() or 4,
+                                          adaptive=self.parameters.get("encoder_adaptive", True),
+                                          logger=self.logger)
+
+        # Budget of the local storage, set by the Recorder (no accounting nor degradation without it)
+        self.storage = None
+
+        # Capture times of the parts recorded at an adaptive frame rate, set by the Recorder
+        self.timestamps_dir = None
+
+        # Settings of the archival (tzst) and lossless (ffv1) compression formats
+        self.zstd_level = self.parameters.get("zstd_level", 3)
+        self.ffv1_slices = self.parameters.get("ffv1_slices", 4)
+        self.queue_drainer_wakeup = Event()
+
+        # Cached mount and reachability checks, the drainer is woken up when the remote comes back
+        host, port = self.get_remote_address()
+        self.health = RemoteHealth(host, port, mount_point=self.get_mount_point(),
+                                   ttl=self.parameters.get("health_ttl_s", 10),
+                                   connect_timeout=self.parameters.get("health_connect_timeout_s", 1.0),
+                                   logger=self.logger)
+        self.health.add_listener(self.on_remote_state_change)
+
+        # Incremental log shipping: one shipment at a time, and bytes shipped so far
+        self.log_shipping_lock = Lock()
+        self.log_shipped = Array('d', [0.0, 0.0, time.time()])  # Total bytes, shipments, time of last shipment
 
     def get_user_info(self):
         username = os.getlogin()
@@ -45,12 +161,20 @@ class UploadManager:
     def create_working_dir(self):
         # Ensure working directory exists
         self.logger.log(f"Creating working directory {self.full_path}", log_level=5)
-        os.makedirs(self.full_path, exist_ok=True)
+        try:
+            self.remote_makedirs(self.full_path)
+        except OSError as e:
+            self.logger.log(f"Cannot create working directory {self.full_path}: {e}", log_level=1)
+            return False
+        return True
 
-    def file_exists(self, filename):
+    def file_exists(self, filename, remote_dir=None):
         """
         Check if a file exists in the local mount point.
         Handles potential errors gracefully.
+
+        :param remote_dir: Remote directory of the file, relative to the mount point. Defaults to the
+            directory of the current recording.
         """
         if not self.is_mounted():
             self.logger.log(f"Cannot check file existence: {self.full_path} is not mounted", log_level=1)
@@ -61,25 +185,210 @@ class UploadManager:
             return False
 
         try:
-            file_path = os.path.join(self.full_path, filename)
-            exists = os.path.exists(file_path)
+            file_path = os.path.join(self.get_mounted_path(remote_dir), filename)
+            exists = self.remote_exists(file_path)
             self.logger.log(f"File existence check for {file_path}: {exists}", log_level=3)
             return exists
         except Exception as e:
             self.logger.log(f"Error checking file existence for {filename}: {e}", log_level=1)
             return False
 
-    def upload(self, file_to_upload, filename_at_destination="", async_upload=True):
+    def upload(self, file_to_upload, filename_at_destination="", async_upload=True, kind="part"):
+        """
+        :param kind: Kind of artifact, which sets its priority class (see UploadPriority).
+        """
         if async_upload:
-            self.async_upload(file_to_upload, filename_at_destination)
+            self.async_upload(file_to_upload, filename_at_destination, kind)
         else:
-            return self.sync_upload(file_to_upload, filename_at_destination)
+            return self.sync_upload(file_to_upload, filename_at_destination, kind=kind)
 
-    def async_upload(self, file_to_upload, filename_at_destination=""):
-        upload_proc = Process(target=self.sync_upload, args=(file_to_upload, filename_at_destination))
+    def async_upload(self, file_to_upload, filename_at_destination="", kind="part"):
+        upload_proc = Process(target=self.background_upload,
+                              args=(file_to_upload, filename_at_destination, kind, time.time()))
         upload_proc.start()
 
-    def sync_upload(self, file_to_upload, filename_at_destination=""):
+    def background_upload(self, file_to_upload, filename_at_destination="", kind="part", request_time=None):
+        self.set_background_priority()
+        if not self.sync_upload(file_to_upload, filename_at_destination, kind=kind, request_time=request_time):
+            # Files uploaded in the background (logs, status...) are kept locally, the queue only keeps track of them
+            self.upload_queue.add(file_to_upload, self.remote_dir, filename_at_destination,
+                                  kind=kind, delete_after_upload=False)
+            return False
+        return True
+
+    def ship_log(self, log_file, filename_at_destination="", async_upload=True):
+        """
+        Append the part of a growing log file not shipped yet to its remote copy, instead of
+        uploading the whole file again.
+        """
+        if async_upload:
+            Process(target=self.background_ship_log, args=(log_file, filename_at_destination)).start()
+        else:
+            return self.sync_ship_log(log_file, filename_at_destination)
+
+    def background_ship_log(self, log_file, filename_at_destination=""):
+        self.set_background_priority()
+        return self.sync_ship_log(log_file, filename_at_destination)
+
+    def sync_ship_log(self, log_file, filename_at_destination=""):
+        # A shipment still running will be followed by the next one, no need to wait for it
+        if not self.log_shipping_lock.acquire(block=False):
+            self.logger.log(f"Previous shipment of {log_file} still running, skipped", log_level=4)
+            return True
+
+        try:
+            if not self.ensure_remote_access() or not self.is_accessible():
+                self.logger.log("Remote directory is not accessible, log shipment skipped", log_level=2)
+                return False
+
+            filename = filename_at_destination if filename_at_destination else os.path.basename(log_file)
+            destination = os.path.join(self.full_path, filename)
+
+            try:
+                size = os.path.getsize(log_file)
+                offset = self.remote_getsize(destination) if self.remote_exists(destination) else 0
+                if offset > size:
+                    self.logger.log(f"Remote copy of {filename} is larger than the log, shipping it again",
+                                    log_level=2)
+                    offset = 0
+                if offset == size:
+                    return True
+
+                with self.priority.slot(UploadPriority.REALTIME):
+                    stats = self.remote_append(self.realtime_copier, log_file, destination, offset, size)
+            except OSError as e:
+                self.logger.log(f"Log shipment of {filename} failed: {e}", log_level=1)
+                return False
+
+            self.record_log_shipment(filename, stats.transferred)
+            return True
+        finally:
+            self.log_shipping_lock.release()
+
+    def record_log_shipment(self, filename, n_bytes):
+        with self.log_shipped.get_lock():
+            now = time.time()
+            interval = now - self.log_shipped[2]
+            self.log_shipped[0] += n_bytes
+            self.log_shipped[1] += 1
+            self.log_shipped[2] = now
+            total = self.log_shipped[0]
+        self.logger.log(f"Shipped {n_bytes} bytes of {filename} ({n_bytes / max(interval, 1e-3):.0f} B/s over "
+                        f"the last {interval:.0f}s, {total:.0f} bytes in total)", log_level=4)
+
+    def set_cpu_placement(self, cpu_placement):
+        """Set the CPU placement policy applied to the compression, analysis and upload processes."""
+        self.cpu_placement = cpu_placement
+        self.encoder_tuner.set_threads(cpu_placement.get_worker_threads(),
+                                       len(cpu_placement.worker_cores) if cpu_placement.enabled else os.cpu_count() or 4)
+
+    def set_storage_budget(self, storage):
+        """Set the StorageBudget updated by the compression and upload processes."""
+        self.storage = storage
+
+    def set_timestamps_dir(self, timestamps_dir):
+        """Set the folder of the capture times of the parts (see AdaptiveFrameRate)."""
+        self.timestamps_dir = timestamps_dir
+
+    def get_timestamps_path(self, folder_name):
+        # Next to the part once it is compressed or recovered (see RecoveryService)
+        beside = f"{os.path.normpath(folder_name)}.timestamps.csv"
+        if os.path.exists(beside) or self.timestamps_dir is None:
+            return beside
+        return os.path.join(self.timestamps_dir, f"{os.path.basename(os.path.normpath(folder_name))}.csv")
+
+    def read_timestamps(self, folder_name):
+        """
+        :return: List of (frame, capture time) of the part in capture order, or None if the part has
+            no timestamps or they do not match its frames (e.g. a part recovered after a crash).
+        """
+        path = self.get_timestamps_path(folder_name)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                rows = [(row["frame"], float(row["time"])) for row in csv.DictReader(f)]
+            frames = {f for f in os.listdir(folder_name) if f.endswith('.jpg')}
+        except (OSError, KeyError, ValueError) as e:
+            self.logger.log(f"Cannot read the timestamps of {folder_name}: {e}", log_level=2)
+            return None
+        if not rows or {frame for frame, _ in rows} != frames:
+            self.logger.log(f"Timestamps of {folder_name} do not match its frames, encoded at a fixed rate",
+                            log_level=2)
+            return None
+        return rows
+
+    def write_concat_list(self, folder_name, timestamps):
+        """
+        Write the ffconcat list of a part recorded at a variable frame rate: each frame lasts until
+        the next one, on the time scale of the fixed rate encode (25 frames per time_interval).
+        """
+        time_interval = self.parameters.get("time_interval", 1)
+        folder = pathlib.Path(folder_name).absolute()
+        list_path = f"{folder}.ffconcat"
+        with open(list_path, "w") as f:
+            f.write("ffconcat version 1.0\n")
+            for i, (frame, capture_time) in enumerate(timestamps):
+                if i + 1 < len(timestamps):
+                    duration = timestamps[i + 1][1] - capture_time
+                else:
+                    duration = time_interval if len(timestamps) == 1 else capture_time - timestamps[i - 1][1]
+                f.write(f"file '{folder / frame}'\nduration {max(duration, 1e-3) / time_interval / 25:.6f}\n")
+            # The duration of the last entry is only used if the file is repeated
+            f.write(f"file '{folder / timestamps[-1][0]}'\n")
+        return list_path
+
+    def account(self, source, destination, n_bytes, n_bytes_destination=None):
+        """Account for local files going from one storage state to another (None if created or deleted)."""
+        if self.storage is None:
+            return
+        if source is None:
+            self.storage.add(destination, n_bytes)
+        else:
+            self.storage.move(source, destination, n_bytes, n_bytes_destination)
+
+    def get_part_size(self, n_frames):
+        """
+        Number of frames of the next part: n_frames, or more if adaptive_part_size is set and the
+        fixed overhead of each encode is too large for parts of that size.
+        """
+        if not self.parameters.get("adaptive_part_size", False):
+            return n_frames
+        max_frames = self.parameters.get("max_part_frames") or 4 * n_frames
+        return self.encoder_tuner.get_part_size(n_frames, max_frames)
+
+    def set_background_priority(self):
+        """
+        Lower the CPU and I/O priority of the current process, so that uploads and compression do not
+        slow down the frame saving, and confine it to the worker cores of the CPU placement policy.
+        The I/O class is "idle" (default) or "best-effort" (lowest level), and only has an effect
+        with an I/O scheduler supporting priorities (BFQ).
+        """
+        self.cpu_placement.apply_worker()
+        process = psutil.Process(os.getpid())
+        try:
+            process.nice(19)
+            if self.parameters.get("upload_io_priority", "idle") == "idle":
+                process.ionice(psutil.IOPRIO_CLASS_IDLE)
+            else:
+                process.ionice(psutil.IOPRIO_CLASS_BE, value=7)
+        except (psutil.Error, OSError) as e:
+            self.logger.log(f"Could not lower the priority of process {os.getpid()}: {e}", log_level=2)
+
+    def report_capture_delay(self, delay):
+        """
+        Called by the Recorder before each frame, with the delay of the frame in seconds
+        (negative when in advance). The smoothed lateness drives the bandwidth cap.
+        """
+        with self.capture_lateness.get_lock():
+            self.capture_lateness.value = 0.7 * self.capture_lateness.value + 0.3 * max(delay, 0.0)
+
+    def is_capture_late(self):
+        return self.capture_lateness.value > self.lateness_threshold
+
+    def sync_upload(self, file_to_upload, filename_at_destination="", remote_dir=None, kind="part", request_time=None):
+        request_time = request_time if request_time is not None else time.time()
+
         # Check if the remote directory is accessible
         if not self.is_mounted() or not self.is_accessible():
             self.logger.log(f"Remote directory is not accessible, trying to mount it", log_level=2)
@@ -97,109 +406,166 @@ class UploadManager:
             # Get file size
             file_size = os.path.getsize(file_to_upload)
 
-            # If file is bigger than 10MB, add some random delay to avoid all devices to upload simultaneously
-            if file_size > 10 * 1024 * 1024:
-                self.wait_random_delay()
+            upload_class = self.priority.get_class(kind)
+            copier = self.realtime_copier if upload_class == UploadPriority.REALTIME else self.copier
+
+            # If file is bigger than 10MB, wait for the upload slot of the station to avoid all devices to upload
+            # simultaneously
+            upload_slot = nullcontext()
+            if file_size > 10 * 1024 * 1024 and upload_class == UploadPriority.BULK:
+                upload_slot = self.upload_scheduler.upload_slot()
 
             # Get path to the mounted remote directory
-            remote_dir = self.get_mounted_path()
+            mounted_dir = self.get_mounted_path(remote_dir)
+            if remote_dir is not None:
+                try:
+                    self.remote_makedirs(mounted_dir)
+                except OSError as e:
+                    self.logger.log(f'Cannot create remote directory {mounted_dir}: {e}', log_level=1)
+                    return False
+
+            if not filename_at_destination:
+                filename_at_destination = os.path.basename(file_to_upload)
+            destination = os.path.join(mounted_dir, filename_at_destination)
+
+            self.logger.log(f'Uploading {file_to_upload} to {destination}', log_level=5)
+
+            # Copy the file in the mounted remote directory, through a .partial file renamed when complete
+            try:
+                with self.priority.slot(upload_class), upload_slot:
+                    stats = self.remote_copy(copier, file_to_upload, destination)
+            except OSError as e:
+                self.logger.log(f'Error occurred during upload: {e}', log_level=1)
+                return False
 
-            # Copy the file in the mounted remote directory
-            command = f'cp {file_to_upload} {remote_dir}/{filename_at_destination}'
+            latency = self.priority.record_latency(upload_class, request_time)
+            self.logger.log(f'Uploaded {file_to_upload} ({upload_class}): {stats.throughput():.1f} MB/s, '
+                            f'{latency:.1f}s after request', log_level=3)
 
-            self.logger.log(f'Uploading {file_to_upload} to {remote_dir}/{filename_at_destination}', log_level=5)
+        return True
 
-            # Run the command
-            result = subprocess.run(command, shell=True, capture_output=True)
 
-            # Check if the command was successful
-            if result.returncode != 0:
-                # Log an error message if the command failed
-                self.logger.log(f'Error occurred during upload: {result.stderr.decode()}', log_level=1)
-                return False
-
-        return True
+    def upload_check(self, file, filename_at_destination="", remote_dir=None):
+        """
+        Check that the remote copy of a file exists and, depending on upload_verify, that it has
+        the same size and checksum as the local file. Verified files are added to the checksum
+        manifest of the recording, which is uploaded along with them.
+        """
+        filename = filename_at_destination if filename_at_destination else os.path.basename(file)
 
+        upload_check = self.file_exists(filename, remote_dir)
+        if upload_check and self.upload_verify in ("size", "checksum"):
+            upload_check = self.check_remote_size(file, filename, remote_dir)
 
-    def wait_random_delay(self):
-        delay = random.randint(0, 60)
-        self.logger.log(f"Delay upload for {delay} seconds", log_level=5)
-        time.sleep(delay)
+        checksum = None
+        if upload_check and self.upload_verify == "checksum":
+            checksum = self.get_checksum(file)
+            upload_check = self.verify_remote_checksum(file, filename, checksum, remote_dir)
 
-    def upload_check(self, file):
-        upload_check = self.file_exists(file)
         if upload_check:
             self.logger.log(f"File {file} uploaded successfully", log_level=5)
+            self.add_to_manifest(file, filename, checksum, remote_dir)
             return True
         else:
             self.logger.log(f"Failed to upload {file}", log_level=1)
             return False
 
-    # def _process_queue(self):
-    #     """
-    #     Processes tasks in the queue sequentially using a separate compression process.
-    #     """
-    #     while True:
-    #         dir_to_compress, format = self.task_queue.get()  # Get the next task
-    #         self.logger.log(f"Starting compression for {dir_to_compress} with format {format}", log_level=3)
-    #
-    #         # Create a separate process for the compression task
-    #         self.compress_process = Process(target=self.compress_analyze_and_upload, args=(dir_to_compress, format))
-    #         self.compress_process.start()
-    #
-    #         # Wait for the compression process to complete
-    #         self.compress_process.join()
-    #         self.logger.log(f"Compression and upload for {dir_to_compress} completed.", log_level=3)
-    #
-    #         # Mark the task as done
-    #         # self.task_queue.task_done()
-    #
-    #         time.sleep(10)
-
-    def start_async_compression_and_upload(self, dir_to_compress, format):
-        # if not hasattr(self, 'compress_pool') or self.compress_pool is None:
-        #     self.logger.log("Compression pool is not initialized!", log_level=1)
-        #     return
-        # self.logger.log(f"Queueing compression for {dir_to_compress} with format {format}", log_level=3)
-        # self.compress_pool.apply_async(
-        #     self.compress_analyze_and_upload,
-        #     args=(dir_to_compress, format),
-        #     callback=self.task_success,
-        #     error_callback=self.task_failure
-        # )
-
-        # self.logger.log(f"Queueing compression and upload for {dir_to_compress} with format {format}", log_level=3)
-        # self.task_queue.put((dir_to_compress, format))
-
-
-        # if self.compress_process and self.compress_process.is_alive():
-        #     self.logger.log("Compression already in progress, waiting for the previous compression to end", log_level=3)
-            # self.compress_process.join() # Wait for the previous compression to end
+    def check_remote_size(self, file, filename, remote_dir=None):
+        try:
+            local_size = os.path.getsize(file)
+            remote_size = self.remote_getsize(os.path.join(self.get_mounted_path(remote_dir), filename))
+        except OSError as e:
+            self.logger.log(f"Cannot compare sizes of {file} and its remote copy: {e}", log_level=1)
+            return False
 
-        self.logger.log(f'Compressing and uploading {dir_to_compress}, with format {format}', log_level=3)
-        # log("Dest path : %s " % output_folder)
-        # self.save_process.join()
-        self.compress_process = Process(target=self.compress_analyze_and_upload,
-                                        args=(dir_to_compress, format,))
-        self.compress_process.start()
+        if local_size != remote_size:
+            self.logger.log(f"Size mismatch for {filename}: local {local_size}, remote {remote_size}", log_level=1)
+            return False
+        return True
 
-    def task_success(self, result):
-        self.logger.log(f"Task completed successfully: {result}", log_level=3)
+    def get_checksum(self, file):
+        """
+        Return the checksum of a local file, computed during compression if possible.
+        """
+        path = os.path.abspath(file)
+        if path not in self.checksums:
+            self.checksums[path] = file_checksum(path, algorithm=self.checksum_algorithm)
+        return self.checksums[path]
 
-    def task_failure(self, error):
-        self.logger.log(f"Task failed with error: {error}", log_level=1)
+    def verify_remote_checksum(self, file, filename, checksum, remote_dir=None):
+        """
+        Compare the checksum of a local file with that of its remote copy.
 
+        :param checksum: Checksum of the local file.
+        """
+        remote_checksum = self.remote_checksum(filename, remote_dir)
+        if remote_checksum != checksum:
+            self.logger.log(f"Checksum mismatch for {filename}: local {checksum}, remote {remote_checksum}",
+                            log_level=1)
+            return False
+        return True
 
+    def remote_checksum(self, filename, remote_dir=None):
+        """
+        Compute the checksum of the remote copy of a file by reading it back over the mount.
+        Subclasses with shell access to the server may compute it server-side instead.
+        """
+        try:
+            return self.remote_file_checksum(os.path.join(self.get_mounted_path(remote_dir), filename))
+        except OSError as e:
+            self.logger.log(f"Cannot read back {filename}: {e}", log_level=1)
+            return None
 
+    def get_manifest_path(self, remote_dir=None):
+        """
+        Local path of the checksum manifest of the recording. It is kept in the tmp folder of the
+        user, the same for the Recorder, the compression workers and the queue drainer whatever
+        their current directory, and out of the recording folder so that upload_remaining_files
+        does not upload and delete it.
+        """
+        remote_dir = remote_dir if remote_dir is not None else self.remote_dir
+        return f'/home/{self.username}/tmp/manifests/{remote_dir.replace("/", "_")}.{self.checksum_algorithm}'
+
+    def add_to_manifest(self, file, filename, checksum=None, remote_dir=None):
+        if checksum is None:
+            try:
+                checksum = self.get_checksum(file)
+            except OSError as e:
+                self.logger.log(f"Cannot compute checksum of {file}: {e}", log_level=2)
+                return
+
+        manifest_path = self.get_manifest_path(remote_dir)
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        # Several processes add to the manifest: each upload must contain all the lines, and two
+        # uploads must not write the same remote .partial file at the same time
+        with open(f"{manifest_path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            append_to_manifest(manifest_path, checksum, filename)
 
-    # def is_compressing(self):
-    #     return self.compress_process.is_alive()
+            # The manifest is small, upload it again every time it changes
+            self.sync_upload(manifest_path, f"checksums.{self.checksum_algorithm}", remote_dir, kind="manifest")
+        self.checksums.pop(os.path.abspath(file), None)
+
+    def start_async_compression_and_upload(self, dir_to_compress, format, block=False):
+        """
+        Queue a part for compression, analysis and upload in the compression worker.
+
+        :param dir_to_compress: Path of the part folder.
+        :param format: Output format, one of COMPRESSION_FORMATS.
+        :param block: Wait for a free slot if the queue is full.
+        :return: The queued CompressionJob, or None if the queue is full (backpressure).
+        """
+        self.logger.log(f'Compressing and uploading {dir_to_compress}, with format {format}', log_level=3)
+        return self.compression_worker.submit(dir_to_compress, format, block=block)
+
+    def is_compression_backlogged(self):
+        return self.compression_worker.is_backlogged()
 
     def wait_for_compression(self):
         """
-        Waits for all tasks in the queue to be processed.
+        Waits for all the compression jobs to be processed, then stops the compression worker.
         """
-        self.compress_process.join()
+        self.compression_worker.stop()
 
     def ensure_remote_access(self):
         """Ensure the remote directory is accessible, attempting to mount if necessary."""
@@ -223,22 +589,55 @@ class UploadManager:
         return True
 
     def compress_analyze_and_upload(self, folder_name, format, analyze=False):
-        compressed_file = self.compress(folder_name=folder_name, format=format)
+        self.set_background_priority()
+
+        # Count the frames before compression, to check that none is missing afterwards
+        expected_frames = self.count_frames(folder_name)
+        raw_size = get_folder_size(folder_name)
+
+        compressed_file = self.compress(folder_name=folder_name, format=format, n_frames=expected_frames)
+        compression_ok = self.check_compression(compressed_file, expected_frames=expected_frames)
+
+        # Short of space, a failed part is encoded again with the settings of the smallest output
+        if not compression_ok and self.storage is not None and self.storage.is_active("reencode"):
+            self.logger.log(f"Compression failed for {folder_name}. Local storage is {self.storage.get_level()}, "
+                            f"encoding it again to mkv with the lower_quality settings", log_level=2)
+            if compressed_file is not None:
+                pathlib.Path(compressed_file).unlink(missing_ok=True)
+            compressed_file = self.compress(folder_name=folder_name, format="mkv", n_frames=expected_frames,
+                                            lower_quality=True)
+            compression_ok = self.check_compression(compressed_file, expected_frames=expected_frames)
 
         # Check if the compressed file is valid
-        if not self.check_compression(compressed_file):
-            self.logger.log(f"Compression failed for {folder_name}. Original files retained.", log_level=1)
+        if not compression_ok:
+            if self.storage is not None and self.storage.is_active("delete_unencoded"):
+                # The only copy of the part is lost, only done if explicitly configured
+                self.logger.log(f"ALERT: compression failed for {folder_name} and local storage is "
+                                f"{self.storage.get_level()}. Its {expected_frames} frames were DELETED "
+                                f"without being encoded (delete_unencoded storage policy).", log_level=1)
+                remove_part_folder(folder_name)
+                self.account("raw", None, raw_size)
+                return False
 
-            # Upload remaining files
-            abs_path = os.path.abspath(folder_name)
-            parent_folder = os.path.dirname(abs_path)
-            self.upload_remaining_files(parent_folder)
+            self.logger.log(f"Compression failed for {folder_name}. Original files retained.", log_level=1)
+            # Frames encoded from the RAM staging area are kept on the persistent storage
+            materialize_part(folder_name)
+            # The invalid output is not uploaded, the part is encoded again by the next recovery
+            if compressed_file is not None:
+                pathlib.Path(compressed_file).unlink(missing_ok=True)
 
             return False  # Exit early without deleting the original files
 
+        # The capture times are shipped next to the part
+        timestamps_path = self.get_timestamps_path(folder_name)
+        if os.path.exists(timestamps_path):
+            shutil.move(timestamps_path, f"{os.path.normpath(folder_name)}.timestamps.csv")
+
         # Delete original folder only after all checks pass
         self.logger.log(f"Removing original folder {folder_name}", log_level=5)
-        subprocess.run(['rm', '-rf', '%s' % folder_name])
+        remove_part_folder(folder_name)
+        compressed_size = os.path.getsize(compressed_file)
+        self.account("raw", "encoded", raw_size, compressed_size)
 
         # Perform analysis if required
         output_files = []
@@ -254,88 +653,166 @@ class UploadManager:
 
         # Upload the compressed file(s) and validate uploads
         if not self.ensure_remote_access():
-            return False  # Stop if we can't access the remote directory
+            self.queue_for_upload(output_files, compressed_file)
+            return False  # Stop if we can't access the remote directory, the queue will retry
 
-        for output_file in output_files:
+        for i, output_file in enumerate(output_files):
             self.upload(output_file, async_upload=False)
 
             # Verify upload success before deleting compressed file
             if not self.upload_check(output_file):
-                self.logger.log(f"Failed to upload {output_file}. Original files retained.", log_level=1)
-                return False  # Exit early without deleting original files or compressed files
+                self.logger.log(f"Failed to upload {output_file}. Queued for a later retry.", log_level=1)
+                self.queue_for_upload(output_files[i:], compressed_file)
+                return False  # Exit early, the queue takes care of the remaining files
 
             # Remove the compressed file after successful upload
             self.logger.log(f"Removing {output_file}", log_level=5)
             pathlib.Path(output_file).unlink(missing_ok=True)
+            if output_file == compressed_file:
+                self.account("encoded", None, compressed_size)
 
 
-        # Upload remaining files
-        # self.logger.log(f"Uploading remaining files in {folder_name}", log_level=5)
-        # get the parent parent folder name from the path of the compressed file
+        # Upload the remaining files of the part (e.g. its timestamps). Only its own: the other
+        # compression workers may be writing their outputs in the same folder.
         abs_path = os.path.abspath(folder_name)
         parent_folder = os.path.dirname(abs_path)
-        self.upload_remaining_files(parent_folder)
+        self.upload_remaining_files(parent_folder, prefix=f"{os.path.basename(abs_path)}.")
 
 
         return True
 
-    def check_compression(self, compressed_file):
-        # Check if the file has been created
-        if not os.path.exists(compressed_file):
-            self.logger.log(f"Compression failed: {compressed_file} not created.", log_level=1)
-            return False
+    def check_compression(self, compressed_file, expected_frames=None):
+        """
+        Check the compressed file with the tiered verifier (see CompressionVerifier).
+        """
+        return self.verifier.verify(compressed_file, expected_frames=expected_frames)
 
-        # Check if the file is empty
-        if os.path.getsize(compressed_file) == 0:
-            self.logger.log(f"Compression failed: {compressed_file} is empty.", log_level=1)
-            return False
+    @staticmethod
+    def count_frames(folder_name):
+        try:
+            return len([f for f in os.listdir(folder_name) if f.endswith('.jpg')])
+        except OSError:
+            return None
 
-        # Verify video integrity with FFmpeg
-        check_cmd = ['ffmpeg', '-v', 'error', '-i', compressed_file, '-f', 'null', '-']
-        result = subprocess.run(check_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if result.returncode != 0:
-            self.logger.log(f"Compression failed: {compressed_file} is not a valid video.", log_level=1)
-            return False
+    def compress(self, folder_name, format="tgz", timeout=2700, n_frames=None, lower_quality=False):    # timeout after 45 minutes
+        """
+        Compress a part folder to one of the COMPRESSION_FORMATS:
 
-        return True
+        - ``mkv``: lossy x264 video, with the preset and threads adapted by the encoder tuner;
+        - ``ffv1``: lossless FFV1 video, multi-threaded and sliced, with per-slice CRCs;
+        - ``tzst``: archival tar of the frames, compressed in-process by multi-threaded zstd;
+        - ``tgz``: tar of the frames compressed by gzip (single-threaded).
 
-    def compress(self, folder_name, format="tgz", timeout=2700):    # timeout after 45 minutes
+        :param n_frames: Number of frames of the part, used to adapt the encoder settings to the
+            measured throughput.
+        :param lower_quality: Encode to mkv with a higher CRF, as the lower_quality storage policy
+            (only with a storage budget).
+        """
 
         self.logger.log(f'Compressing {folder_name} to {format}', log_level=5)
 
-        pid = psutil.Process(os.getpid())
-        pid.nice(19)
-
+        if format == "tzst" and not zstd_available():
+            self.logger.log("Neither the zstandard module nor the zstd command is available, "
+                            "compressing to tgz instead", log_level=2)
+            format = "tgz"
+
+        crf = 22
+        if self.storage is not None and (lower_quality or self.storage.is_active("lower_quality")):
+            if format != "mkv":
+                self.logger.log(f"Local storage is {self.storage.get_level()}, {folder_name} compressed to mkv "
+                                f"instead of {format}", log_level=2)
+                format = "mkv"
+            crf += self.storage.crf_increase
+
+        threads = self.cpu_placement.get_worker_threads()
+        concat_list = None
         if format == "tgz":
             output_file = '%s.tgz' % folder_name
-            call_args = ['tar', '--xattrs', '-czf', output_file, '-C', '%s' % folder_name, '.']
+            call_args = ['tar', '--xattrs', '-czf', '-', '-C', '%s' % folder_name, '.']
+        elif format == "tzst":
+            output_file = '%s.tar.zst' % folder_name
+            call_args = ['tar', '-cf', '-', '-C', folder_name, '.', '|', 'zstd', f'-{self.zstd_level}', f'-T{threads}']
         else:
             input_files = str(pathlib.Path(folder_name).absolute()) + '/*.jpg'
             output_file = '%s.mkv' % folder_name
-            call_args = ['ffmpeg', '-r', '25', '-pattern_type', 'glob', '-i',
-                         input_files, '-vcodec', 'libx264',
-                         '-crf', '22', '-y',
-                         '-refs', '2', '-preset', 'veryfast', '-profile:v',
-                         'main', '-threads', '4', '-hide_banner',
-                         '-loglevel', 'warning', output_file]
+            if format == "ffv1":
+                codec_args = ['-vcodec', 'ffv1', '-level', '3', '-coder', '1', '-context', '1',
+                              '-slices', str(self.ffv1_slices), '-slicecrc', '1']
+            else:
+                preset, threads = self.encoder_tuner.get_settings()
+                codec_args = ['-vcodec', 'libx264', '-crf', str(crf), '-refs', '2', '-preset', preset,
+                              '-profile:v', 'main']
+            # Parts recorded at an adaptive frame rate keep the time between their frames
+            timestamps = self.read_timestamps(folder_name)
+            if timestamps is not None:
+                concat_list = self.write_concat_list(folder_name, timestamps)
+                input_args = ['-f', 'concat', '-safe', '0', '-i', concat_list]
+                codec_args += ['-vsync', 'vfr']
+            else:
+                input_args = ['-r', '25', '-pattern_type', 'glob', '-i', input_files]
+            call_args = ['ffmpeg'] + input_args + codec_args + ['-y', '-threads', str(threads), '-hide_banner',
+                                                                '-loglevel', 'warning', output_file]
 
         args_string = ' '.join(call_args)
         self.logger.log(f'Running command : {args_string}', log_level=5)
 
+        input_size = get_folder_size(folder_name)
+        start_time, start_cpu = time.time(), process_cpu_time()
         try:
-            subprocess.run(call_args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+            if format == "tgz":
+                # The archive is written through Python, which hashes it on the fly
+                checksum = run_and_hash_output(call_args, output_file, algorithm=self.checksum_algorithm,
+                                               timeout=timeout)
+            elif format == "tzst":
+                checksum = write_tar_zst(folder_name, output_file, level=self.zstd_level, threads=threads,
+                                         algorithm=self.checksum_algorithm, timeout=timeout)
+            else:
+                subprocess.run(call_args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout,
+                               check=True)
+                if n_frames and format == "mkv":
+                    self.encoder_tuner.record(n_frames, time.time() - start_time)
+                # ffmpeg seeks back in the file to finalize the mkv, so it cannot be hashed as a stream.
+                # Hash it right away while it is still in the page cache instead of reading the SD card again.
+                checksum = file_checksum(output_file, algorithm=self.checksum_algorithm)
+            self.checksums[os.path.abspath(output_file)] = checksum
+            self.log_compression_stats(folder_name, format, input_size, os.path.getsize(output_file),
+                                       time.time() - start_time, process_cpu_time() - start_cpu)
             self.logger.log(f"Compression of {folder_name} done", begin="\n")
-        except subprocess.TimeoutExpired:
+        except (subprocess.TimeoutExpired, TimeoutError):
             self.logger.log(f"Compression process for {folder_name} timed out after {timeout} seconds", log_level=1)
             return None  # Return None to indicate failure
-        except subprocess.CalledProcessError as e:
+        except (subprocess.CalledProcessError, OSError) as e:
             self.logger.log(f"Compression failed for {folder_name}. Error: {e}", log_level=1)
             return None  # Return None to indicate failure
+        except Exception as e:
+            # e.g. zstandard.ZstdError
+            self.logger.log(f"Compression failed for {folder_name}. Error: {e!r}", log_level=1)
+            return None
+        finally:
+            if concat_list is not None:
+                pathlib.Path(concat_list).unlink(missing_ok=True)
 
         return output_file
 
+    def log_compression_stats(self, folder_name, format, input_size, output_size, elapsed, cpu_time):
+        """
+        Log the ratio, throughput and CPU share of a compression, to compare the formats.
+        The CPU share is the CPU time of the compression (all threads and child processes) over
+        the wall-clock time, e.g. 300% for three busy cores.
+        """
+        self.logger.log(f"Compressed {folder_name} to {format}: {input_size / 1e6:.1f} MB -> {output_size / 1e6:.1f} MB "
+                        f"(ratio {input_size / max(output_size, 1):.2f}), {elapsed:.1f}s, "
+                        f"{input_size / 1e6 / max(elapsed, 1e-3):.1f} MB/s, "
+                        f"CPU {cpu_time / max(elapsed, 1e-3):.0%}", log_level=3)
+
+
+    def upload_remaining_files(self, rec_folder, prefix=""):
+        """
+        Upload the files left in the recording folder and delete them.
 
-    def upload_remaining_files(self, rec_folder):
+        :param prefix: Only the files whose name starts with it, e.g. those of a part. All the
+            files are only uploaded once no compression is running.
+        """
         self.logger.log(f"Checking if all files are uploaded in folder {rec_folder}", log_level=3)
 
         # Check if there are some not uploaded files
@@ -344,7 +821,8 @@ class UploadManager:
             return
 
         # Get list of files in the current directory, excluding directories
-        files = [f for f in os.listdir(rec_folder) if os.path.isfile(os.path.join(rec_folder, f))]
+        files = [f for f in os.listdir(rec_folder)
+                 if f.startswith(prefix) and os.path.isfile(os.path.join(rec_folder, f))]
 
         # Filter out empty files
         files = [f for f in files if os.path.getsize(os.path.join(rec_folder, f)) > 0]
@@ -363,22 +841,169 @@ class UploadManager:
                     os.remove(file)
 
                 else:
-                    self.logger.log(f"File {file} not uploaded, keeping it locally", log_level=1)
-                    # Create a folder in the parent folder named after recodring name
-                    local_folder_save = os.path.join('../', self.remote_dir)
-                    os.makedirs(local_folder_save, exist_ok=True)
-                    # Move the file to the folder
-                    self.logger.log(f"Moving {file} to {local_folder_save}", log_level=3)
-                    os.rename(file, os.path.join(local_folder_save, file))
+                    self.logger.log(f"File {file} not uploaded, keeping it locally in the upload queue", log_level=1)
+                    self.upload_queue.add(file, self.remote_dir, kind="other")
 
 
         else:
             self.logger.log("No files to upload", log_level=3)
 
 
+    def queue_for_upload(self, output_files, compressed_file):
+        for output_file in output_files:
+            kind = "part" if output_file == compressed_file else "analysis"
+            size = os.path.getsize(output_file) if os.path.exists(output_file) else 0
+            self.upload_queue.add(output_file, self.remote_dir, kind=kind)
+            self.account("encoded" if kind == "part" else None, "pending", size)
+
+    def recover_part(self, path, format, remote_dir):
+        """
+        Compress (if needed) and verify a part of an interrupted recording, then queue it for upload
+        to the remote tree of that recording (see RecoveryService).
+
+        :param path: Part folder, compressed part whose folder was already removed, or timestamps
+            of a part already uploaded.
+        :param format: Compression format of the part folder.
+        :param remote_dir: Remote directory of the recording of the part.
+        :return: True if the part was queued for upload.
+        """
+        if path.endswith(".timestamps.csv"):
+            self.upload_queue.add(path, remote_dir, kind="other")
+            self.queue_drainer_wakeup.set()
+            return True
+
+        # Timestamps of an adaptive frame rate recording, next to the part (see RecoveryService)
+        part = os.path.basename(os.path.normpath(path)).split(".")[0]
+        timestamps_path = os.path.join(os.path.dirname(os.path.normpath(path)), f"{part}.timestamps.csv")
+        if os.path.isdir(path):
+            raw_size = get_folder_size(path)
+            expected_frames = self.count_frames(path)
+            if not expected_frames:
+                self.logger.log(f"Recovery: {path} has no frame, removed", log_level=2)
+                remove_part_folder(path)
+                self.account("raw", None, raw_size)
+                return True
+            # n_frames is not given: the encode times at the lowest priority would mislead the encoder tuner
+            compressed_file = self.compress(folder_name=path, format=format)
+            if not self.check_compression(compressed_file, expected_frames=expected_frames):
+                self.logger.log(f"Recovery: compression of {path} failed, kept for the next recovery", log_level=1)
+                if compressed_file is not None:
+                    pathlib.Path(compressed_file).unlink(missing_ok=True)
+                return False
+            remove_part_folder(path)
+            self.account("raw", "encoded", raw_size, os.path.getsize(compressed_file))
+        else:
+            compressed_file = path
+            if not self.check_compression(compressed_file):
+                self.logger.log(f"Recovery: {path} is not valid and its frames are gone, kept for inspection",
+                                log_level=1)
+                return False
+
+        size = os.path.getsize(compressed_file)
+        self.upload_queue.add(compressed_file, remote_dir, kind="part")
+        self.account("encoded", "pending", size)
+        if os.path.exists(timestamps_path):
+            self.upload_queue.add(timestamps_path, remote_dir, kind="other")
+        self.queue_drainer_wakeup.set()
+        self.logger.log(f"Recovery: {os.path.basename(path)} queued for upload to {remote_dir}", log_level=3)
+        return True
+
+    def on_remote_state_change(self, check, state):
+        """
+        Called by the health checks when the remote storage goes up or down.
+        """
+        if state:
+            if self.upload_queue.count():
+                self.logger.log(f"Remote storage available again, draining "
+                                f"{self.upload_queue.count()} queued upload(s)", log_level=3)
+                self.upload_queue.retry_now()
+            self.queue_drainer_wakeup.set()
+        else:
+            self.logger.log(f"Remote storage not available ({check} check failed), uploads will be queued",
+                            log_level=2)
+
+    def start_upload_queue_drainer(self):
+        """
+        Start the background process retrying the queued uploads.
+        """
+        self.queue_drainer_stop.clear()
+        self.queue_drainer = Process(target=self.drain_upload_queue, args=(self.queue_drainer_stop,), daemon=True)
+        self.queue_drainer.start()
+
+    def stop_upload_queue_drainer(self, timeout=5):
+        """
+        Stop the queue drainer. An upload interrupted here is resumed from its .partial file later.
+        """
+        if self.queue_drainer is None:
+            return
+        self.queue_drainer_stop.set()
+        self.queue_drainer_wakeup.set()
+        self.queue_drainer.join(timeout)
+        if self.queue_drainer.is_alive():
+            self.queue_drainer.terminate()
+        self.queue_drainer = None
+
+    def drain_upload_queue(self, stop_event):
+        """
+        Loop of the queue drainer: when entries are due and the remote directory is accessible,
+        upload them one by one, waiting upload_drain_interval seconds between two files so that the
+        backlog accumulated during an outage is drained at a controlled rate. Between two rounds, it
+        sleeps until the next retry period or until the health checks report the remote is back.
+        """
+        self.set_background_priority()
+        retry_period = self.parameters.get("upload_retry_period_s", 60)
+        drain_interval = self.parameters.get("upload_drain_interval_s", 5)
+
+        while not stop_event.is_set():
+            entries = self.upload_queue.get_due()
+
+            if entries and self.ensure_remote_access():
+                for entry in entries:
+                    if stop_event.is_set():
+                        break
+                    self.upload_queued_entry(entry)
+                    stop_event.wait(drain_interval)
+                continue
+
+            self.queue_drainer_wakeup.wait(retry_period)
+            self.queue_drainer_wakeup.clear()
+
+    def upload_queued_entry(self, entry):
+        local_path = entry["local_path"]
+        if not os.path.exists(local_path):
+            self.logger.log(f"Queued file {local_path} does not exist anymore, dropped from the queue", log_level=2)
+            self.upload_queue.mark_done(entry["id"])
+            return False
+
+        ok = self.sync_upload(local_path, entry["filename"], entry["remote_dir"], kind=entry["kind"]) and \
+            self.upload_check(local_path, entry["filename"], entry["remote_dir"])
+
+        if not ok:
+            self.upload_queue.mark_failed(entry["id"], "upload failed")
+            return False
+
+        self.upload_queue.mark_done(entry["id"])
+        if entry["delete_after_upload"]:
+            size = os.path.getsize(local_path) if os.path.exists(local_path) else 0
+            pathlib.Path(local_path).unlink(missing_ok=True)
+            self.account("pending", None, size)
+        self.logger.log(f"Queued upload of {entry['filename']} done after {entry['attempts'] + 1} attempt(s)",
+                        log_level=3)
+        return True
+
     def start(self):
         self.mount()
         self.create_working_dir()
+        self.health.start_monitor(self.parameters.get("health_monitor_period_s", 5))
+        self.start_upload_queue_drainer()
+
+    def close(self):
+        self.stop_upload_queue_drainer()
+        self.health.stop_monitor()
+        self.remote_fs.stop()
+        self.logger.log(f"Upload latency per class: {self.priority.summary()}", log_level=3)
+        self.logger.log(f"Log shipping: {self.log_shipped[0]:.0f} bytes in {self.log_shipped[1]:.0f} shipment(s)",
+                        log_level=3)
 
     def mount(self):
         raise NotImplementedError("Mount method should be implemented in subclass")
@@ -395,8 +1020,56 @@ class UploadManager:
     def get_tree_structure(self, remote_dir, recording_name):
         raise NotImplementedError("get_tree_structure method should be implemented in subclass")
 
-    def get_mounted_path(self):
-        return self.full_path
+    def get_remote_address(self):
+        """:return: (host, port) of the remote service, probed by the health checks."""
+        raise NotImplementedError("get_remote_address method should be implemented in subclass")
+
+    def get_mount_point(self):
+        """:return: Local mount point checked by the health checks, or None for backends without mount."""
+        return self.local_dir
+
+    # Remote filesystem primitives. The default implementation works on the mount point, in the
+    # RemoteFSWorker; backends talking to the server directly override them.
+
+    def remote_call(self, operation, *args, timeout=None, **kwargs):
+        try:
+            return self.remote_fs.call(operation, *args, timeout=timeout, **kwargs)
+        except RemoteOperationTimeout:
+            # The mount is probably stale, check it again before the next operation
+            self.health.invalidate()
+            raise
+
+    def get_transfer_timeout(self, file):
+        """Deadline of the copy of a file, based on the minimum rate expected from the server."""
+        return self.remote_fs.timeout + os.path.getsize(file) / self.remote_min_rate
+
+    def remote_exists(self, path):
+        return self.remote_call("exists", path)
+
+    def remote_getsize(self, path):
+        return self.remote_call("getsize", path)
+
+    def remote_makedirs(self, path):
+        self.remote_call("makedirs", path, exist_ok=True)
+
+    def remote_copy(self, copier, source, destination):
+        operation = "copy_realtime" if copier is self.realtime_copier else "copy"
+        return self.remote_call(operation, source, destination, timeout=self.get_transfer_timeout(source))
+
+    def remote_append(self, copier, source, destination, offset, size):
+        return self.remote_call("append", source, destination, offset, size,
+                                timeout=self.remote_fs.timeout + (size - offset) / self.remote_min_rate)
+
+    def remote_file_checksum(self, path):
+        # Drop the cached pages first so that the data is read back from the server
+        timeout = self.remote_fs.timeout + self.remote_getsize(path) / self.remote_min_rate
+        return self.remote_call("checksum", path, algorithm=self.checksum_algorithm, drop_cache=True,
+                                timeout=timeout)
+
+    def get_mounted_path(self, remote_dir=None):
+        if remote_dir is None:
+            return self.full_path
+        return os.path.join(self.local_dir, remote_dir)
 
     def test(self):
         try:
@@ -426,9 +1099,10 @@ class UploadManager:
 
 
 class SMBManager(UploadManager):
-    def __init__(self, nas_server, share_name, credentials_file, working_dir, recording_name=None, local_dir=None, logger=None):
+    def __init__(self, nas_server, share_name, credentials_file, working_dir, recording_name=None, local_dir=None, logger=None,
+                 parameters=None):
         local_dir = local_dir if local_dir else f"/home/{os.getlogin()}/NAS"
-        super().__init__(nas_server, working_dir, recording_name, local_dir, logger)
+        super().__init__(nas_server, working_dir, recording_name, local_dir, logger, parameters)
         self.share_name = share_name
         self.credentials_file = credentials_file
 
@@ -436,15 +1110,18 @@ class SMBManager(UploadManager):
         """
         Mount the NAS share to the local directory. Adds a timeout to handle long-running commands.
         """
-        # Create local mount point if it does not exist
-        if not os.path.exists(self.local_dir):
-            os.makedirs(self.local_dir)
-
-        # Check if the NAS is already mounted
-        if self.is_mounted():
+        # Check if the NAS is already mounted, in the mount table: the mount point itself may be stale
+        if self.health.is_mounted(force=True):
             self.logger.log(f"{self.remote_server}/{self.share_name} is already mounted", log_level=3)
             return True
 
+        # Create local mount point if it does not exist
+        try:
+            self.remote_call("makedirs", self.local_dir, exist_ok=True)
+        except OSError as e:  # Including RemoteOperationTimeout
+            self.logger.log(f"Cannot create the mount point {self.local_dir}: {e}", log_level=1)
+            return False
+
         # Mount the NAS share
         mount_cmd = [
             "sudo", "mount", "-t", "cifs",
@@ -459,6 +1136,7 @@ class SMBManager(UploadManager):
                 return False
 
             self.logger.log(f"Mounted {self.remote_server}/{self.share_name} to {self.local_dir}", log_level=3)
+            self.health.invalidate("mounted")
             return True
         except subprocess.TimeoutExpired:
             self.logger.log(f"Mount operation timed out after 30 seconds", log_level=1)
@@ -467,109 +1145,951 @@ class SMBManager(UploadManager):
             self.logger.log(f"Unexpected error during mount operation: {e}", log_level=1)
             return False
 
+    def unmount(self, timeout=15):
+        # Unmount the NAS share. Lazily, so that a stale mount does not block: it is detached right
+        # away and cleaned up once the processes still using it are done.
+        if not self.is_mounted():
+            return True
+        unmount_cmd = ["sudo", "umount", "-l", self.local_dir]
+        try:
+            result = subprocess.run(unmount_cmd, capture_output=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.logger.log(f"Unmount of {self.local_dir} timed out after {timeout} seconds", log_level=1)
+            return False
+        except OSError as e:
+            self.logger.log(f"Cannot unmount {self.local_dir}: {e}", log_level=1)
+            return False
+        finally:
+            self.health.invalidate("mounted")
+        if result.returncode != 0:
+            self.logger.log(f"Failed to unmount {self.local_dir}: {result.stderr.decode().strip()}", log_level=1)
+            return False
+        self.logger.log(f"Unmounted {self.local_dir}", log_level=3)
+        return True
+
+    def is_mounted(self):
+        """
+        Check if self.local_dir is a mount point (cached, see RemoteHealth).
+        """
+        return self.health.is_mounted()
+
+    def is_accessible(self):
+        """
+        Check if the SMB port of the NAS server accepts connections (cached, see RemoteHealth).
+        """
+        return self.health.is_reachable()
+
+    def get_remote_address(self):
+        return self.remote_server.lstrip("/").split("/")[0], self.parameters.get("smb_port", 445)
+
+    def get_tree_structure(self, remote_dir, recording_name):
+        #self.logger.log(f"Creating tree structure with SMB protocol", log_level=5)
+        try:
+            folder1 = f'{(datetime.now()).strftime("%Y%m%d_%H%M")}_{recording_name}'
+        except:
+            folder1 = (datetime.now()).strftime("%Y%m%d_%H%M")
+        folder2 = gethostname()
+
+        return f'{remote_dir}/{folder1}/{folder2}'
+
+
+
+class SMBDirectManager(SMBManager):
+    """
+    SMB backend talking to the NAS directly from Python with smbprotocol, without a cifs mount.
+
+    - No ``sudo mount``, so no hung mount can block a process in uninterruptible sleep.
+    - One authenticated session per process, reused for every operation (the connection of the
+      parent cannot be used after a fork, so each process opens its own on first use).
+    - Writes are pipelined: up to ``smb_pipeline_depth`` write requests are in flight at the same time.
+    - Existence, size and checksum checks are done on the server through the same session.
+
+    Requires the optional ``smbprotocol`` package. Selected with ``"smb_backend": "direct"``.
+    """
+
+    SMB_PAYLOAD_SIZE = 65536  # Size of the data covered by one SMB credit
+
+    def __init__(self, nas_server, share_name, credentials_file, working_dir, recording_name=None, local_dir=None,
+                 logger=None, parameters=None):
+        self.server_name = nas_server.lstrip("/").split("/")[0]
+
+        # The UNC path of the share replaces the mount point
+        local_dir = f"//{self.server_name}/{share_name}"
+        super().__init__(nas_server, share_name, credentials_file, working_dir, recording_name, local_dir, logger,
+                         parameters)
+
+        self.pipeline_depth = max(1, self.parameters.get("smb_pipeline_depth", 8))
+        self.connection_cache = None
+        self.session_pid = None
+
+    def read_credentials(self):
+        """Read the credentials file used by mount.cifs (username=, password=, domain= lines)."""
+        credentials = {}
+        with open(self.credentials_file) as f:
+            for line in f:
+                if "=" in line:
+                    key, value = line.strip().split("=", 1)
+                    credentials[key.strip()] = value.strip()
+
+        username = credentials.get("username")
+        if credentials.get("domain"):
+            username = f'{credentials["domain"]}\\{username}'
+        return username, credentials.get("password")
+
+    def mount(self):
+        """
+        Open the SMB session of the current process, if not open yet.
+        """
+        if self.is_mounted():
+            return True
+
+        import smbclient
+
+        try:
+            username, password = self.read_credentials()
+            self.connection_cache = {}
+            smbclient.register_session(self.server_name, username=username, password=password,
+                                       port=self.parameters.get("smb_port", 445),
+                                       connection_timeout=10, connection_cache=self.connection_cache)
+        except Exception as e:
+            self.logger.log(f"Failed to open SMB session to {self.server_name}: {e}", log_level=1)
+            self.connection_cache = None
+            return False
+
+        self.session_pid = os.getpid()
+        self.logger.log(f"SMB session opened to {self.server_name} (process {self.session_pid})", log_level=3)
+        return True
+
     def unmount(self):
-        # Unmount the NAS share
         if self.is_mounted():
-            unmount_cmd = ["sudo", "umount", self.local_dir]
-            subprocess.run(unmount_cmd, check=True)
-            print(f"Unmounted {self.local_dir}")
+            import smbclient
+            smbclient.reset_connection_cache(fail_on_error=False, connection_cache=self.connection_cache)
+        self.connection_cache = None
 
     def is_mounted(self):
+        return self.connection_cache is not None and self.session_pid == os.getpid()
+
+    def get_mount_point(self):
+        return None
+
+    def smb_call(self, function, *args, **kwargs):
         """
-        Check if the NAS is mounted by verifying if self.local_dir is a mount point.
-        Handles subprocess timeout gracefully.
+        Run a smbclient function with the session of the process. Connection errors close the session,
+        so that the next call to ensure_remote_access opens a new one, and are raised as OSError.
         """
+        if not self.mount():
+            raise OSError(f"No SMB session to {self.server_name}")
         try:
-            result = subprocess.run(['mountpoint', '-q', self.local_dir], timeout=10, check=False)
-            return result.returncode == 0
-        except subprocess.TimeoutExpired:
-            self.logger.log(f"Timeout expired while checking mount status of {self.local_dir}", log_level=1)
-            return False  # Treat it as not mounted if the check times out
-        except subprocess.CalledProcessError as e:
-            self.logger.log(f"Error checking mount status: {e}", log_level=1)
+            return function(*args, connection_cache=self.connection_cache, **kwargs)
+        except OSError:
+            raise
+        except Exception as e:
+            self.logger.log(f"SMB connection error: {e}", log_level=1)
+            self.unmount()
+            self.health.invalidate("reachable")
+            raise OSError(str(e))
+
+    def remote_exists(self, path):
+        import smbclient
+        try:
+            self.smb_call(smbclient.stat, path)
+            return True
+        except FileNotFoundError:
             return False
+
+    def remote_getsize(self, path):
+        import smbclient
+        return self.smb_call(smbclient.stat, path).st_size
+
+    def remote_makedirs(self, path):
+        import smbclient
+        self.smb_call(smbclient.makedirs, path, exist_ok=True)
+
+    def remote_file_checksum(self, path):
+        import smbclient
+        hasher = hashlib.new(self.checksum_algorithm)
+        with self.smb_call(smbclient.open_file, path, mode='rb') as f:
+            while True:
+                chunk = f.read(4 * 1024 * 1024)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def remote_copy(self, copier, source, destination):
+        """
+        Upload with pipelined writes to <destination>.partial, resume an interrupted upload after
+        checking its last chunk, and rename it on the server once complete.
+        """
+        import smbclient
+
+        partial_path = destination + ChunkedCopier.PARTIAL_SUFFIX
+        size = os.path.getsize(source)
+        start_time = time.time()
+
+        offset = self.get_resume_offset(source, partial_path, size, copier.chunk_size)
+        if offset > 0:
+            self.logger.log(f"Resuming upload of {source} from byte {offset}/{size}", log_level=3)
+
+        try:
+            with open(source, 'rb') as src, \
+                    self.smb_call(smbclient.open_file, partial_path, mode='r+b' if offset > 0 else 'wb',
+                                  buffering=0) as dst:
+                dst.truncate(offset)
+                self.pipelined_write(copier, src, dst.fd, offset, size)
+        except OSError:
+            raise
+        except Exception as e:
+            self.unmount()
+            raise OSError(f"SMB upload of {source} failed: {e}")
+
+        if self.remote_getsize(partial_path) != size:
+            raise OSError(f"Size mismatch after upload of {source}")
+
+        self.smb_call(smbclient.replace, partial_path, destination)
+
+        stats = TransferStats(source, destination, size, size - offset, offset, time.time() - start_time)
+        self.logger.log(f"Upload done: {stats}", log_level=4)
+        return stats
+
+    def remote_append(self, copier, source, destination, offset, size):
+        import smbclient
+
+        start_time = time.time()
+        try:
+            with open(source, 'rb') as src, \
+                    self.smb_call(smbclient.open_file, destination, mode='r+b' if offset > 0 else 'wb',
+                                  buffering=0) as dst:
+                self.pipelined_write(copier, src, dst.fd, offset, size)
+        except OSError:
+            raise
+        except Exception as e:
+            self.unmount()
+            raise OSError(f"SMB append to {destination} failed: {e}")
+
+        return TransferStats(source, destination, size, size - offset, offset, time.time() - start_time)
+
+    def get_resume_offset(self, source, partial_path, size, chunk_size):
+        import smbclient
+        try:
+            partial_size = self.remote_getsize(partial_path)
+        except OSError:
+            return 0
+        if partial_size > size:
+            return 0
+
+        check_start = max(0, partial_size - chunk_size)
+        if partial_size == check_start:
+            return partial_size
+
+        with open(source, 'rb') as src, self.smb_call(smbclient.open_file, partial_path, mode='rb') as partial:
+            src.seek(check_start)
+            partial.seek(check_start)
+            if src.read(partial_size - check_start) == partial.read(partial_size - check_start):
+                return partial_size
+
+        self.logger.log(f"Partial file {partial_path} does not match the source after byte {check_start}",
+                        log_level=2)
+        return check_start
+
+    def pipelined_write(self, copier, src, smb_open, offset, size):
+        """
+        Send the write requests without waiting for each response, keeping up to pipeline_depth
+        requests in flight, as far as the credits granted by the server allow.
+        """
+        connection = smb_open.connection
+        session_id = smb_open.tree_connect.session.session_id
+        tree_id = smb_open.tree_connect.tree_connect_id
+        max_chunk = min(connection.max_write_size, copier.chunk_size)
+
+        in_flight = deque()
+        src.seek(offset)
+
+        while offset < size or in_flight:
+            if offset < size and len(in_flight) < self.pipeline_depth:
+                available_credits = connection.sequence_window["high"] - connection.sequence_window["low"]
+                chunk_size = min(max_chunk, size - offset, available_credits * self.SMB_PAYLOAD_SIZE)
+                if copier.rate_limiter is not None:
+                    chunk_size = min(chunk_size, copier.rate_limiter.get_chunk_size(chunk_size))
+
+                if chunk_size > 0:
+                    copier.give_way()
+                    if copier.rate_limiter is not None:
+                        copier.rate_limiter.consume(chunk_size)
+
+                    data = src.read(chunk_size)
+                    credit_charge = (len(data) - 1) // self.SMB_PAYLOAD_SIZE + 1
+                    write_msg, receive = smb_open.write(data, offset=offset, send=False)
+                    # Ask for more credits than consumed, to grow the window up to the pipeline depth
+                    request = connection.send(write_msg, sid=session_id, tid=tree_id,
+                                              credit_request=credit_charge * 2)
+                    in_flight.append((request, receive, len(data)))
+                    offset += len(data)
+                    continue
+
+            if not in_flight:
+                raise OSError("No SMB credits available to send the next write request")
+
+            request, receive, length = in_flight.popleft()
+            if receive(request) != length:
+                raise OSError("Short write on the SMB server")
+
+
+class SSHManager(UploadManager):
+    """
+    SFTP backend, for sites without SMB. Talks to the server with paramiko instead of an sshfs mount.
+
+    - One long-lived SSH connection per process, with keepalive packets so that idle periods
+      between two parts do not get it dropped by firewalls (the connection of the parent cannot
+      be used after a fork, so each process opens its own on first use).
+    - Pipelined writes to ``<destination>.partial``: the chunks are sent without waiting for the
+      acknowledgement of the previous one. An interrupted upload is resumed after checking its
+      last chunk, and the file is renamed once its size matches.
+    - Checksums are computed on the server (``sha256sum``...) when a shell is available,
+      otherwise by reading the file back.
+
+    Authentication uses the SSH agent, the default keys of the user or ``ssh_key_file``. The
+    host key must be in ``~/.ssh/known_hosts`` unless ``ssh_accept_unknown_hosts`` is set.
+    Requires the optional ``paramiko`` package.
+
+    :param ssh_server: Host name or address of the server.
+    :param ssh_user: User on the server (defaults to the local user).
+    :param remote_dir: Directory of the recordings, relative to ssh_dir.
+    :param ssh_dir: Base directory on the server (plays the role of the mount point).
+    """
+
+    def __init__(self, ssh_server, ssh_user, remote_dir, recording_name, ssh_dir="", logger=None, parameters=None):
+        super().__init__(ssh_server, remote_dir, recording_name, ssh_dir.rstrip("/") or ".", logger, parameters)
+        self.ssh_user = ssh_user if ssh_user else self.username
+        self.port = self.parameters.get("ssh_port", 22)
+        self.key_file = self.parameters.get("ssh_key_file")
+        self.keepalive = self.parameters.get("ssh_keepalive_s", 15)
+        self.accept_unknown_hosts = self.parameters.get("ssh_accept_unknown_hosts", False)
+
+        self.client = None
+        self.sftp = None
+        self.session_pid = None
+        self.has_shell = True
+
+    def get_tree_structure(self, remote_dir, recording_name):
+        try:
+            folder1 = f'{(datetime.now()).strftime("%Y%m%d_%H%M")}_{recording_name}'
+        except:
+            folder1 = (datetime.now()).strftime("%Y%m%d_%H%M")
+        folder2 = gethostname()
+
+        return "/".join(folder for folder in (remote_dir.strip("/"), folder1, folder2) if folder)
+
+    def mount(self):
+        """
+        Open the SSH connection and the SFTP session of the current process, if not open yet.
+        """
+        if self.is_mounted():
+            return True
+
+        import paramiko
+
+        self.close_connection()
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        if self.accept_unknown_hosts:
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+        try:
+            client.connect(self.remote_server, port=self.port, username=self.ssh_user, key_filename=self.key_file,
+                           timeout=10, banner_timeout=10, auth_timeout=10)
+            client.get_transport().set_keepalive(self.keepalive)
+            self.sftp = client.open_sftp()
+            self.sftp.get_channel().settimeout(60)
         except Exception as e:
-            self.logger.log(f"Unexpected error: {e}", log_level=1)
+            self.logger.log(f"Failed to connect to {self.ssh_user}@{self.remote_server}:{self.port}: {e}",
+                            log_level=1)
+            client.close()
+            self.sftp = None
             return False
 
+        self.client = client
+        self.session_pid = os.getpid()
+        self.logger.log(f"SFTP session opened to {self.ssh_user}@{self.remote_server} (process {self.session_pid})",
+                        log_level=3)
+        return True
+
+    def unmount(self):
+        self.close_connection()
+
+    def close_connection(self):
+        if self.client is not None and self.session_pid == os.getpid():
+            self.client.close()
+        self.client = None
+        self.sftp = None
+
+    def is_mounted(self):
+        if self.client is None or self.session_pid != os.getpid():
+            return False
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
     def is_accessible(self):
         """
-        Check if the NAS server is accessible by pinging it.
-        Handles timeout and unexpected errors gracefully.
+        The server is accessible if the connection is alive, or if its SSH port accepts a connection
+        (cached, see RemoteHealth).
         """
-        nas_host = self.remote_server.lstrip("//").split("/")[0]
-        ping_cmd = ["ping", "-c", "1", nas_host]
+        return self.is_mounted() or self.health.is_reachable()
 
+    def get_remote_address(self):
+        return self.remote_server, self.parameters.get("ssh_port", 22)
+
+    def get_mount_point(self):
+        return None
+
+    def sftp_call(self, method, *args, **kwargs):
+        """
+        Call a method of the SFTP client of the process. Errors returned by the server are raised
+        as they are (OSError). Connection errors close the connection, so that the next call to
+        ensure_remote_access opens a new one, and are raised as OSError.
+        """
+        if not self.mount():
+            raise OSError(f"No SFTP session to {self.remote_server}")
         try:
-            result = subprocess.run(ping_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=5)
-            return result.returncode == 0
-        except subprocess.TimeoutExpired:
-            self.logger.log(f"Ping to {nas_host} timed out after 5 seconds", log_level=1)
-            return False
+            return getattr(self.sftp, method)(*args, **kwargs)
+        except OSError:
+            raise
         except Exception as e:
-            self.logger.log(f"Error checking accessibility of {nas_host}: {e}", log_level=1)
+            self.logger.log(f"SFTP connection error: {e}", log_level=1)
+            self.close_connection()
+            self.health.invalidate("reachable")
+            raise OSError(str(e))
+
+    def remote_exists(self, path):
+        try:
+            self.sftp_call("stat", path)
+            return True
+        except FileNotFoundError:
             return False
 
+    def remote_getsize(self, path):
+        return self.sftp_call("stat", path).st_size
+
+    def remote_makedirs(self, path):
+        current = "/" if path.startswith("/") else ""
+        for folder in path.strip("/").split("/"):
+            current = posixpath.join(current, folder) if current else folder
+            if not self.remote_exists(current):
+                self.sftp_call("mkdir", current)
+
+    def remote_file_checksum(self, path):
+        if self.has_shell:
+            checksum = self.server_side_checksum(path)
+            if checksum is not None:
+                return checksum
+
+        hasher = hashlib.new(self.checksum_algorithm)
+        with self.sftp_call("open", path, "rb") as f:
+            f.prefetch()
+            while True:
+                chunk = f.read(4 * 1024 * 1024)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def server_side_checksum(self, path):
+        """
+        Run <algorithm>sum on the server, which avoids transferring the file back.
+        Returns None if the server has no shell or no such command.
+        """
+        command = f"{self.checksum_algorithm}sum -- {shlex.quote(path)}"
+        if not self.mount():
+            raise OSError(f"No SSH connection to {self.remote_server}")
+        try:
+            _, stdout, _ = self.client.exec_command(command, timeout=600)
+            output = stdout.read().decode()
+            if stdout.channel.recv_exit_status() == 0 and output:
+                return output.split()[0]
+        except Exception as e:
+            self.logger.log(f"Server-side checksum not available ({e}), reading the file back", log_level=4)
+            self.has_shell = False
+            return None
+
+        self.logger.log(f"'{command}' failed on the server, reading the file back", log_level=4)
+        self.has_shell = False
+        return None
+
+    def remote_copy(self, copier, source, destination):
+        """
+        Upload with pipelined writes to <destination>.partial, resume an interrupted upload after
+        checking its last chunk, and rename it on the server once complete.
+        """
+        partial_path = destination + ChunkedCopier.PARTIAL_SUFFIX
+        size = os.path.getsize(source)
+        start_time = time.time()
+
+        offset = self.get_resume_offset(source, partial_path, size, copier.chunk_size)
+        if offset > 0:
+            self.logger.log(f"Resuming upload of {source} from byte {offset}/{size}", log_level=3)
+
+        try:
+            with open(source, 'rb') as src, self.sftp_call("open", partial_path, 'r+b' if offset > 0 else 'wb') as dst:
+                dst.truncate(offset)
+                dst.seek(offset)
+                dst.set_pipelined(True)
+                src.seek(offset)
+                self.write_chunks(copier, src, dst, offset, size)
+            # Closing the file waits for the acknowledgement of all the pipelined writes
+
+            if self.remote_getsize(partial_path) != size:
+                raise OSError(f"Size mismatch after upload of {source}")
+
+            self.sftp_call("posix_rename", partial_path, destination)
+        except OSError:
+            raise
+        except Exception as e:
+            self.close_connection()
+            raise OSError(f"SFTP upload of {source} failed: {e}")
+
+        stats = TransferStats(source, destination, size, size - offset, offset, time.time() - start_time)
+        self.logger.log(f"Upload done: {stats}", log_level=4)
+        return stats
+
+    def remote_append(self, copier, source, destination, offset, size):
+        start_time = time.time()
+        try:
+            with open(source, 'rb') as src, self.sftp_call("open", destination, 'r+b' if offset > 0 else 'wb') as dst:
+                dst.seek(offset)
+                dst.set_pipelined(True)
+                src.seek(offset)
+                self.write_chunks(copier, src, dst, offset, size)
+        except OSError:
+            raise
+        except Exception as e:
+            self.close_connection()
+            raise OSError(f"SFTP append to {destination} failed: {e}")
+
+        return TransferStats(source, destination, size, size - offset, offset, time.time() - start_time)
+
+    @staticmethod
+    def write_chunks(copier, src, dst, offset, size):
+        while offset < size:
+            chunk_size = copier.chunk_size
+            if copier.rate_limiter is not None:
+                chunk_size = copier.rate_limiter.get_chunk_size(chunk_size)
+
+            copier.give_way()
+            if copier.rate_limiter is not None:
+                copier.rate_limiter.consume(min(chunk_size, size - offset))
+
+            data = src.read(min(chunk_size, size - offset))
+            if not data:
+                raise OSError(f"Unexpected end of file at byte {offset}")
+            dst.write(data)
+            offset += len(data)
+
+    def get_resume_offset(self, source, partial_path, size, chunk_size):
+        try:
+            partial_size = self.remote_getsize(partial_path)
+        except OSError:
+            return 0
+        if partial_size > size:
+            return 0
+
+        check_start = max(0, partial_size - chunk_size)
+        if partial_size == check_start:
+            return partial_size
+
+        with open(source, 'rb') as src, self.sftp_call("open", partial_path, 'rb') as partial:
+            src.seek(check_start)
+            partial.seek(check_start)
+            if src.read(partial_size - check_start) == partial.read(partial_size - check_start):
+                return partial_size
+
+        self.logger.log(f"Partial file {partial_path} does not match the source after byte {check_start}",
+                        log_level=2)
+        return check_start
+
+
+class S3Manager(UploadManager):
+    """
+    Backend for S3-compatible object stores (MinIO...).
+
+    - Files larger than one part are sent with a multipart upload, with up to
+      ``s3_max_concurrency`` parts in flight from a thread pool.
+    - Each part carries its checksum, which the server verifies before accepting it. The checksum
+      of the whole source file is stored in the object metadata.
+    - Objects are tagged with the recording, the host and the kind of file.
+    - A multipart upload interrupted by a crash or a network failure is found again on the server
+      and resumed; the parts already uploaded are kept if their checksum matches the local data.
+
+    Keys are ``<s3_prefix>/<date>_<recording>/<hostname>/<file>`` in ``s3_bucket``. The access keys
+    are read from ``s3_credentials_file`` (access_key=, secret_key= lines), or from the usual
+    boto3 configuration if it is not set. Requires the optional ``boto3`` package.
+
+    :param endpoint: URL of the object store, e.g. http://minio.local:9000.
+    :param bucket: Bucket of the recordings.
+    :param remote_dir: Prefix of the recordings in the bucket.
+    """
+
+    MIN_PART_SIZE = 5 * 1024 * 1024  # Smallest part accepted by S3, except for the last one
+    MAX_PARTS = 10000
+
+    # Checksum algorithms supported by S3, by name of the hashlib algorithm
+    CHECKSUM_ALGORITHMS = {"sha256": "SHA256", "sha1": "SHA1"}
+
+    def __init__(self, endpoint, bucket, remote_dir, recording_name, credentials_file=None, logger=None,
+                 parameters=None):
+        self.recording_name = recording_name
+        super().__init__(endpoint, remote_dir, recording_name, f"s3://{bucket}", logger, parameters)
+        self.endpoint = endpoint
+        self.bucket = bucket
+        self.credentials_file = credentials_file
+        self.full_path = self.remote_dir
+
+        self.part_size = max(self.MIN_PART_SIZE, self.parameters.get("s3_part_mb", 16) * 1024 * 1024)
+        self.max_concurrency = max(1, self.parameters.get("s3_max_concurrency", 4))
+        self.s3_checksum = self.CHECKSUM_ALGORITHMS.get(self.checksum_algorithm, "SHA256")
+
+        self.client = None
+        self.client_pid = None
+
     def get_tree_structure(self, remote_dir, recording_name):
-        #self.logger.log(f"Creating tree structure with SMB protocol", log_level=5)
         try:
             folder1 = f'{(datetime.now()).strftime("%Y%m%d_%H%M")}_{recording_name}'
         except:
             folder1 = (datetime.now()).strftime("%Y%m%d_%H%M")
         folder2 = gethostname()
 
-        return f'{remote_dir}/{folder1}/{folder2}'
-
+        return "/".join(folder for folder in (remote_dir.strip("/"), folder1, folder2) if folder)
 
+    def get_mounted_path(self, remote_dir=None):
+        """Key prefix of a remote directory in the bucket."""
+        return remote_dir.strip("/") if remote_dir is not None else self.remote_dir
 
-class SSHManager(UploadManager):
-    def __init__(self, ssh_server, ssh_user, remote_dir, recording_name, local_dir=None, logger=None):
-        super().__init__(ssh_server, remote_dir, recording_name,local_dir, logger)
-        self.ssh_user = ssh_user
+    def read_credentials(self):
+        credentials = {}
+        with open(self.credentials_file) as f:
+            for line in f:
+                if "=" in line:
+                    key, value = line.strip().split("=", 1)
+                    credentials[key.strip()] = value.strip()
+        return credentials.get("access_key"), credentials.get("secret_key")
 
     def mount(self):
-        # Create local mount point if it does not exist
-        if not os.path.exists(self.local_dir):
-            os.makedirs(self.local_dir)
-
-        # Check if the SSH is already mounted
+        """
+        Create the S3 client of the current process, if not created yet, and check that the bucket exists.
+        """
         if self.is_mounted():
-            self.logger.log(f"{self.ssh_user}@{self.remote_server}:{self.remote_dir} is already mounted", log_level=3)
             return True
 
-        # Mount the SSH share
-        mount_cmd = [
-            "sshfs",
-            f"{self.ssh_user}@{self.remote_server}:{self.remote_dir}",
-            self.local_dir,
-            "-o", f"uid={self.uid},gid={self.gid}"
-        ]
-        result = subprocess.run(mount_cmd, capture_output=True)
-        if result.returncode != 0:
-            self.logger.log(f"Failed to mount SSH: {result.stderr.decode()}", log_level=1)
+        import boto3
+        from botocore.config import Config
+
+        try:
+            access_key, secret_key = self.read_credentials() if self.credentials_file else (None, None)
+            client = boto3.client("s3", endpoint_url=self.endpoint,
+                                  aws_access_key_id=access_key, aws_secret_access_key=secret_key,
+                                  region_name=self.parameters.get("s3_region", "us-east-1"),
+                                  config=Config(connect_timeout=10, read_timeout=60,
+                                                retries={"max_attempts": 3, "mode": "standard"},
+                                                max_pool_connections=self.max_concurrency + 2))
+            client.head_bucket(Bucket=self.bucket)
+        except Exception as e:
+            self.logger.log(f"Cannot access bucket {self.bucket} on {self.endpoint}: {e}", log_level=1)
             return False
 
-        print(f"Mounted {self.ssh_user}@{self.remote_server}:{self.remote_dir} to {self.local_dir}")
+        self.client = client
+        self.client_pid = os.getpid()
+        self.logger.log(f"S3 client connected to {self.endpoint}/{self.bucket} (process {self.client_pid})",
+                        log_level=3)
         return True
 
     def unmount(self):
-        # Unmount the SSH share
-        if self.is_mounted():
-            unmount_cmd = ["fusermount", "-u", self.local_dir]
-            subprocess.run(unmount_cmd, check=True)
-            print(f"Unmounted {self.local_dir}")
+        self.client = None
 
     def is_mounted(self):
-        # Check if the SSH is mounted
-        result = subprocess.run(['mountpoint', '-q', self.local_dir])
-        return result.returncode == 0
+        return self.client is not None and self.client_pid == os.getpid()
 
     def is_accessible(self):
-        # Check if the SSH server is accessible by pinging it
-        ssh_host = self.remote_server
-        ping_cmd = ["ping", "-c", "1", ssh_host]
-        result = subprocess.run(ping_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return result.returncode == 0
+        """The object store is accessible if its port accepts a connection (cached, see RemoteHealth)."""
+        return self.health.is_reachable()
+
+    def get_remote_address(self):
+        url = urlparse(self.remote_server)
+        return url.hostname, url.port if url.port else (443 if url.scheme == "https" else 80)
+
+    def get_mount_point(self):
+        return None
+
+    def s3_call(self, method, **kwargs):
+        """
+        Call a method of the S3 client of the process. Missing objects are raised as FileNotFoundError
+        and any other error as OSError.
+        """
+        if not self.mount():
+            raise OSError(f"No connection to {self.endpoint}")
+
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        try:
+            return getattr(self.client, method)(Bucket=self.bucket, **kwargs)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NoSuchUpload"):
+                raise FileNotFoundError(str(e))
+            raise OSError(str(e))
+        except BotoCoreError as e:
+            self.logger.log(f"S3 connection error: {e}", log_level=1)
+            self.unmount()
+            self.health.invalidate("reachable")
+            raise OSError(str(e))
+
+    def remote_exists(self, path):
+        try:
+            self.s3_call("head_object", Key=path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def remote_getsize(self, path):
+        return self.s3_call("head_object", Key=path)["ContentLength"]
+
+    def remote_makedirs(self, path):
+        pass  # Prefixes do not need to be created
+
+    def remote_file_checksum(self, path):
+        """
+        Checksum of the source file stored in the metadata at upload, as sent by the client (see
+        verify_remote_checksum for the verification).
+        """
+        return self.s3_call("head_object", Key=path)["Metadata"].get(self.checksum_algorithm)
+
+    def get_object_parts(self, key):
+        """
+        :return: Checksum computed by the server (of the object, or of the checksums of its parts
+            for a multipart upload) and the sizes of the parts, or None for a single upload.
+        """
+        attributes = self.s3_call("get_object_attributes", Key=key, ObjectAttributes=["Checksum", "ObjectParts"])
+        checksum = attributes.get("Checksum", {}).get(f"Checksum{self.s3_checksum}")
+        if "ObjectParts" not in attributes:
+            return checksum, None
+
+        parts, marker = [], 0
+        while True:
+            object_parts = attributes["ObjectParts"]
+            parts += object_parts.get("Parts", [])
+            if not object_parts.get("IsTruncated"):
+                break
+            marker = object_parts["NextPartNumberMarker"]
+            attributes = self.s3_call("get_object_attributes", Key=key, ObjectAttributes=["ObjectParts"],
+                                      PartNumberMarker=marker)
+        return checksum, [part["Size"] for part in sorted(parts, key=lambda part: part["PartNumber"])]
+
+    @staticmethod
+    def hash_ranges(path, sizes, algorithm):
+        """:return: Digests of the consecutive ranges of the given sizes of a file."""
+        digests = []
+        with open(path, 'rb') as f:
+            for size in sizes:
+                hasher = hashlib.new(algorithm)
+                remaining = size
+                while remaining > 0:
+                    chunk = f.read(min(remaining, 4 * 1024 * 1024))
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    remaining -= len(chunk)
+                digests.append(hasher.digest())
+        return digests
+
+    def verify_remote_checksum(self, file, filename, checksum, remote_dir=None):
+        """
+        Compare the local file with the checksum the server computed when it stored the object, not
+        the metadata sent by the client: the checksum of the object for a single upload, or the
+        checksum of the checksums of its parts for a multipart upload (whose part sizes are read
+        from the object attributes).
+        """
+        key = os.path.join(self.get_mounted_path(remote_dir), filename)
+        algorithm = self.s3_checksum.lower()
+        try:
+            remote, sizes = self.get_object_parts(key)
+            if remote is None:
+                self.logger.log(f"No {self.s3_checksum} checksum computed by the server for {filename}", log_level=1)
+                return False
+            if sizes is None:
+                local = base64.b64encode(self.hash_ranges(file, [os.path.getsize(file)], algorithm)[0]).decode()
+            elif sum(sizes) != os.path.getsize(file):
+                self.logger.log(f"Size mismatch for the parts of {filename}", log_level=1)
+                return False
+            else:
+                digests = b"".join(self.hash_ranges(file, sizes, algorithm))
+                local = base64.b64encode(hashlib.new(algorithm, digests).digest()).decode()
+        except OSError as e:
+            self.logger.log(f"Cannot verify the checksum of {filename}: {e}", log_level=1)
+            return False
+
+        # Checksums of multipart objects may be suffixed with their number of parts
+        if remote.split("-")[0] != local:
+            self.logger.log(f"Checksum mismatch for {filename}: local {local}, remote {remote}", log_level=1)
+            return False
+        return True
+
+    def get_tagging(self, path):
+        tags = {"recording": self.recording_name or "", "host": gethostname(),
+                "kind": "video" if path.endswith((".mkv", ".tgz", ".tar.zst")) else "other"}
+        return urlencode(tags)
+
+    def part_checksum(self, data):
+        return base64.b64encode(hashlib.new(self.s3_checksum.lower(), data).digest()).decode()
+
+    def remote_copy(self, copier, source, destination):
+        """
+        Upload a file to the object at key destination, with a multipart upload if larger than one part.
+        """
+        size = os.path.getsize(source)
+        start_time = time.time()
+
+        metadata = {self.checksum_algorithm: self.get_checksum(source)}
+        if size <= self.part_size:
+            copier.give_way()
+            if copier.rate_limiter is not None:
+                copier.rate_limiter.consume(size)
+            with open(source, 'rb') as f:
+                data = f.read()
+            self.s3_call("put_object", Key=destination, Body=data, Metadata=metadata,
+                         Tagging=self.get_tagging(destination),
+                         **{f"Checksum{self.s3_checksum}": self.part_checksum(data)})
+            resumed_from = 0
+        else:
+            resumed_from = self.multipart_upload(copier, source, destination, size, metadata)
+
+        stats = TransferStats(source, destination, size, size - resumed_from, resumed_from, time.time() - start_time)
+        self.logger.log(f"Upload done: {stats}", log_level=4)
+        return stats
+
+    def remote_append(self, copier, source, destination, offset, size):
+        """
+        Objects cannot be appended to. Once the remote copy is larger than the minimum part size,
+        a new version is composed on the server: the current object is copied as the first part
+        (UploadPartCopy) and only the new range is sent as the second part. Smaller copies are
+        simply uploaded again.
+        """
+        if offset < self.MIN_PART_SIZE:
+            return self.remote_copy(copier, source, destination)
+
+        start_time = time.time()
+        copier.give_way()
+        if copier.rate_limiter is not None:
+            copier.rate_limiter.consume(size - offset)
+        with open(source, 'rb') as f:
+            data = os.pread(f.fileno(), size - offset, offset)
+
+        # The metadata describes the new version (the source may have grown since size was taken)
+        metadata = {self.checksum_algorithm: self.hash_ranges(source, [size], self.checksum_algorithm)[0].hex()}
+        checksum_key = f"Checksum{self.s3_checksum}"
+        upload_id = self.s3_call("create_multipart_upload", Key=destination, Metadata=metadata,
+                                 Tagging=self.get_tagging(destination),
+                                 ChecksumAlgorithm=self.s3_checksum)["UploadId"]
+        try:
+            copied = self.s3_call("upload_part_copy", Key=destination, UploadId=upload_id, PartNumber=1,
+                                  CopySource={"Bucket": self.bucket, "Key": destination},
+                                  CopySourceRange=f"bytes=0-{offset - 1}")["CopyPartResult"]
+            checksum = self.part_checksum(data)
+            appended = self.s3_call("upload_part", Key=destination, UploadId=upload_id, PartNumber=2, Body=data,
+                                    **{checksum_key: checksum})
+            self.s3_call("complete_multipart_upload", Key=destination, UploadId=upload_id,
+                         MultipartUpload={"Parts": [{"PartNumber": 1, "ETag": copied["ETag"],
+                                                     checksum_key: copied[checksum_key]},
+                                                    {"PartNumber": 2, "ETag": appended["ETag"],
+                                                     checksum_key: checksum}]})
+        except OSError:
+            self.s3_call("abort_multipart_upload", Key=destination, UploadId=upload_id)
+            raise
+
+        return TransferStats(source, destination, size, size - offset, offset, time.time() - start_time)
+
+    def multipart_upload(self, copier, source, destination, size, metadata):
+        """
+        :return: Number of bytes that were already uploaded by a previous interrupted upload.
+        """
+        upload_id, part_size, done_parts = self.find_interrupted_upload(source, destination, size)
+        if upload_id is None:
+            part_size = max(self.part_size, -(-size // self.MAX_PARTS))
+            upload_id = self.s3_call("create_multipart_upload", Key=destination, Metadata=metadata,
+                                     Tagging=self.get_tagging(destination),
+                                     ChecksumAlgorithm=self.s3_checksum)["UploadId"]
+
+        n_parts = -(-size // part_size)
+        resumed_from = sum(min(part_size, size - (number - 1) * part_size) for number in done_parts)
+        if done_parts:
+            self.logger.log(f"Resuming upload of {source}: {len(done_parts)}/{n_parts} parts already uploaded",
+                            log_level=3)
+
+        def upload_part(number):
+            offset = (number - 1) * part_size
+            length = min(part_size, size - offset)
+            copier.give_way()
+            if copier.rate_limiter is not None:
+                copier.rate_limiter.consume(length)
+            with open(source, 'rb') as f:
+                data = os.pread(f.fileno(), length, offset)
+            checksum = self.part_checksum(data)
+            response = self.s3_call("upload_part", Key=destination, UploadId=upload_id, PartNumber=number,
+                                    Body=data, **{f"Checksum{self.s3_checksum}": checksum})
+            return {"PartNumber": number, "ETag": response["ETag"], f"Checksum{self.s3_checksum}": checksum}
+
+        parts = dict(done_parts)
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            for part in executor.map(upload_part, [n for n in range(1, n_parts + 1) if n not in done_parts]):
+                parts[part["PartNumber"]] = part
+
+        self.s3_call("complete_multipart_upload", Key=destination, UploadId=upload_id,
+                     MultipartUpload={"Parts": [parts[number] for number in sorted(parts)]})
+        return resumed_from
+
+    def find_interrupted_upload(self, source, destination, size):
+        """
+        Look for a multipart upload of the same key left unfinished on the server.
+
+        :return: Its upload id, part size and the parts whose checksum matches the source
+            (as a dictionary indexed by part number), or (None, None, {}).
+        """
+        try:
+            uploads = self.s3_call("list_multipart_uploads", Prefix=destination).get("Uploads", [])
+        except FileNotFoundError:
+            return None, None, {}
+        uploads = [upload for upload in uploads if upload["Key"] == destination]
+        if not uploads:
+            return None, None, {}
+
+        # Keep the most recent one, and abort the others
+        uploads.sort(key=lambda upload: upload["Initiated"])
+        for upload in uploads[:-1]:
+            self.s3_call("abort_multipart_upload", Key=destination, UploadId=upload["UploadId"])
+        upload_id = uploads[-1]["UploadId"]
+
+        listed_parts = []
+        marker = 0
+        while True:
+            response = self.s3_call("list_parts", Key=destination, UploadId=upload_id, PartNumberMarker=marker)
+            listed_parts += response.get("Parts", [])
+            if not response.get("IsTruncated"):
+                break
+            marker = response["NextPartNumberMarker"]
+
+        part_size = next((part["Size"] for part in listed_parts if part["PartNumber"] == 1), None)
+        if part_size is None or -(-size // part_size) > self.MAX_PARTS:
+            self.s3_call("abort_multipart_upload", Key=destination, UploadId=upload_id)
+            return None, None, {}
+
+        done_parts = {}
+        with open(source, 'rb') as f:
+            for part in listed_parts:
+                number = part["PartNumber"]
+                length = min(part_size, size - (number - 1) * part_size)
+                if part["Size"] != length:
+                    continue
+                checksum = self.part_checksum(os.pread(f.fileno(), length, (number - 1) * part_size))
+                if part.get(f"Checksum{self.s3_checksum}") == checksum:
+                    done_parts[number] = {"PartNumber": number, "ETag": part["ETag"],
+                                          f"Checksum{self.s3_checksum}": checksum}
+        return upload_id, part_size, done_parts
 
 
 class EmptyUploader:
@@ -591,12 +2111,48 @@ class EmptyUploader:
     def get_tree_structure(self, remote_dir, recording_name):
         return remote_dir
 
+    def start_async_compression_and_upload(self, dir_to_compress, format, block=False):
+        return True
+
+    def is_compression_backlogged(self):
+        return False
+
+    def report_capture_delay(self, delay):
+        pass
+
     def wait_for_compression(self):
         return True
 
-    def upload(self, file_to_upload, filename_at_destination="", async_upload=True):
+    def upload(self, file_to_upload, filename_at_destination="", async_upload=True, kind="part"):
+        return True
+
+    def ship_log(self, log_file, filename_at_destination="", async_upload=True):
+        return True
+
+    def set_cpu_placement(self, cpu_placement):
+        pass
+
+    def get_part_size(self, n_frames):
+        return n_frames
+
+    def set_background_priority(self):
+        pass
+
+    def set_storage_budget(self, storage):
+        pass
+
+    def set_timestamps_dir(self, timestamps_dir):
+        pass
+
+    def recover_part(self, path, format, remote_dir):
+        return False
+
+    def start(self):
+        pass
+
+    def upload_remaining_files(self, rec_folder, prefix=""):
         return True
 
-    def upload_remaining_files(self, rec_folder):
+    def close(self):
         return True
 
@@ -0,0 +1,97 @@
+import time
+
+from contextlib import contextmanager
+from multiprocessing import Array, BoundedSemaphore, Value
+
+
+class UploadPriority:
+    """
+    Priority classes of the upload engine.
+
+    - ``realtime``: small files the controller needs to see quickly (logs, status, telemetry,
+      thumbnails, checksum manifests). They are not rate limited and bulk copies pause between
+      two chunks while one of them is running.
+    - ``bulk``: videos, analysis outputs and any other file.
+
+    Each class has its own bound on concurrent uploads, and its own latency statistics (time
+    from the upload request to the end of the copy). All the state is in shared memory so it
+    is common to every upload process forked by the UploadManager.
+
+    :param max_realtime: Maximum number of concurrent realtime uploads.
+    :param max_bulk: Maximum number of concurrent bulk uploads.
+    """
+
+    REALTIME = "realtime"
+    BULK = "bulk"
+    CLASSES = (REALTIME, BULK)
+
+    REALTIME_KINDS = ("log", "status", "telemetry", "thumbnail", "manifest")
+
+    # Indices of the latency statistics of a class
+    COUNT, TOTAL, MAX = range(3)
+
+    def __init__(self, max_realtime=2, max_bulk=1):
+        self.semaphores = {self.REALTIME: BoundedSemaphore(max(1, max_realtime)),
+                           self.BULK: BoundedSemaphore(max(1, max_bulk))}
+        self.realtime_running = Value('i', 0)
+        self.latencies = {upload_class: Array('d', 3) for upload_class in self.CLASSES}
+
+    @classmethod
+    def get_class(cls, kind):
+        return cls.REALTIME if kind in cls.REALTIME_KINDS else cls.BULK
+
+    @classmethod
+    def get_kind_order(cls):
+        """SQL expression sorting the realtime kinds first, for the upload queue."""
+        kinds = ", ".join(f"'{kind}'" for kind in cls.REALTIME_KINDS)
+        return f"(kind IN ({kinds})) DESC"
+
+    @contextmanager
+    def slot(self, upload_class, timeout=600):
+        """
+        Hold one of the concurrent upload slots of the class. If no slot is freed within the timeout
+        (e.g. a process holding one was killed), the upload goes on anyway rather than blocking forever.
+        """
+        semaphore = self.semaphores[upload_class]
+        acquired = semaphore.acquire(timeout=timeout)
+        if upload_class == self.REALTIME:
+            with self.realtime_running.get_lock():
+                self.realtime_running.value += 1
+        try:
+            yield acquired
+        finally:
+            if upload_class == self.REALTIME:
+                with self.realtime_running.get_lock():
+                    self.realtime_running.value -= 1
+            if acquired:
+                semaphore.release()
+
+    def is_realtime_running(self):
+        """Used by bulk copies to give way to realtime uploads."""
+        return self.realtime_running.value > 0
+
+    def record_latency(self, upload_class, request_time):
+        latency = time.time() - request_time
+        stats = self.latencies[upload_class]
+        with stats.get_lock():
+            stats[self.COUNT] += 1
+            stats[self.TOTAL] += latency
+            stats[self.MAX] = max(stats[self.MAX], latency)
+        return latency
+
+    def get_latency_stats(self, upload_class):
+        """
+        :return: Number of uploads, mean and max latency in seconds of the class.
+        """
+        stats = self.latencies[upload_class]
+        with stats.get_lock():
+            count, total, max_latency = stats[self.COUNT], stats[self.TOTAL], stats[self.MAX]
+        mean = total / count if count else 0.0
+        return int(count), mean, max_latency
+
+    def summary(self):
+        lines = []
+        for upload_class in self.CLASSES:
+            count, mean, max_latency = self.get_latency_stats(upload_class)
+            lines.append(f"{upload_class}: {count} upload(s), latency mean {mean:.1f}s, max {max_latency:.1f}s")
+        return "; ".join(lines)
@@ -0,0 +1,130 @@
+import os
+import sqlite3
+import time
+
+from contextlib import contextmanager
+
+from src.upload_priority import UploadPriority
+
+
+class UploadQueue:
+    """
+    Durable queue of the files waiting to be uploaded (parts, logs, analysis outputs...).
+
+    The queue is a SQLite database in the tmp folder, so pending uploads survive restarts of
+    cam.py and reboots. Each entry keeps the remote directory it belongs to, so that files of
+    previous recordings are uploaded to the right tree. Files that are deleted after upload are
+    moved to a spool folder next to the database, out of the recording folder.
+
+    A connection is opened for every operation, so the queue can be used from the compression
+    workers and the upload processes forked by the UploadManager.
+
+    :param path: Path to the SQLite database.
+    :param backoff_base: Delay before the first retry, in seconds. Doubled at each failure.
+    :param backoff_max: Maximum delay between two retries, in seconds.
+    :param logger: Logger instance.
+    """
+
+    def __init__(self, path, backoff_base=30, backoff_max=3600, logger=None):
+        self.path = path
+        self.spool_dir = os.path.join(os.path.dirname(path), "spool")
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.logger = logger
+
+        os.makedirs(self.spool_dir, exist_ok=True)
+        with self.connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS uploads (
+                              id INTEGER PRIMARY KEY AUTOINCREMENT,
+                              local_path TEXT NOT NULL,
+                              remote_dir TEXT NOT NULL,
+                              filename TEXT NOT NULL,
+                              kind TEXT NOT NULL,
+                              delete_after_upload INTEGER NOT NULL,
+                              attempts INTEGER NOT NULL DEFAULT 0,
+                              next_attempt REAL NOT NULL,
+                              created REAL NOT NULL,
+                              last_error TEXT,
+                              UNIQUE (remote_dir, filename))""")
+
+    @contextmanager
+    def connect(self):
+        """Open a connection, commit on success and always close it."""
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def add(self, local_path, remote_dir, filename="", kind="part", delete_after_upload=True):
+        """
+        Add a file to the queue. A file already queued for the same destination is replaced.
+
+        :param local_path: Path to the local file.
+        :param remote_dir: Remote directory, relative to the mount point.
+        :param filename: Name at destination (defaults to the local name).
+        :param kind: Kind of artifact ("part", "analysis", "log"...).
+        :param delete_after_upload: If True, the file is moved to the spool folder and deleted once uploaded.
+        :return: Path of the queued file.
+        """
+        filename = filename if filename else os.path.basename(local_path)
+        local_path = os.path.abspath(local_path)
+
+        if delete_after_upload and os.path.dirname(local_path) != self.spool_dir:
+            spool_path = os.path.join(self.spool_dir, f"{time.time_ns()}_{filename}")
+            try:
+                os.rename(local_path, spool_path)
+                local_path = spool_path
+            except OSError as e:
+                self.logger.log(f"Cannot move {local_path} to the upload spool, queued in place: {e}", log_level=2)
+
+        now = time.time()
+        with self.connect() as db:
+            db.execute("""INSERT INTO uploads (local_path, remote_dir, filename, kind, delete_after_upload,
+                                               next_attempt, created)
+                          VALUES (?, ?, ?, ?, ?, ?, ?)
+                          ON CONFLICT (remote_dir, filename) DO UPDATE SET
+                              local_path = excluded.local_path, kind = excluded.kind,
+                              delete_after_upload = excluded.delete_after_upload,
+                              attempts = 0, next_attempt = excluded.next_attempt""",
+                       (local_path, remote_dir, filename, kind, int(delete_after_upload), now, now))
+
+        self.logger.log(f"Queued {local_path} for upload to {remote_dir}/{filename} ({kind})", log_level=3)
+        return local_path
+
+    def get_due(self, limit=10, now=None):
+        """
+        :return: Entries whose next attempt is due, realtime kinds first then oldest first, as dictionaries.
+        """
+        now = time.time() if now is None else now
+        with self.connect() as db:
+            db.row_factory = sqlite3.Row
+            rows = db.execute(f"SELECT * FROM uploads WHERE next_attempt <= ? "
+                              f"ORDER BY {UploadPriority.get_kind_order()}, created LIMIT ?",
+                              (now, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def mark_done(self, entry_id):
+        with self.connect() as db:
+            db.execute("DELETE FROM uploads WHERE id = ?", (entry_id,))
+
+    def mark_failed(self, entry_id, error=""):
+        """Schedule the next attempt with an exponential backoff."""
+        with self.connect() as db:
+            attempts = db.execute("SELECT attempts FROM uploads WHERE id = ?", (entry_id,)).fetchone()
+            if attempts is None:
+                return
+            attempts = attempts[0] + 1
+            delay = min(self.backoff_base * 2 ** (attempts - 1), self.backoff_max)
+            db.execute("UPDATE uploads SET attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?",
+                       (attempts, time.time() + delay, error, entry_id))
+
+    def retry_now(self):
+        """Make every entry due, e.g. when the remote server is reachable again."""
+        with self.connect() as db:
+            db.execute("UPDATE uploads SET next_attempt = ?", (time.time(),))
+
+    def count(self):
+        with self.connect() as db:
+            return db.execute("SELECT COUNT(*) FROM uploads").fetchone()[0]
@@ -0,0 +1,169 @@
+import hashlib
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+from socket import gethostname
+
+
+class UploadScheduler:
+    """
+    Deterministic upload slotting for a fleet of stations sharing the same NAS.
+
+    Large uploads wait for a token from an UploadCoordinator if one is configured and
+    reachable. Otherwise, they wait for the slot of the station in a fixed cycle: the cycle of
+    ``slot_period`` seconds is divided in ``n_slots`` slots and each station gets the slot
+    given by a hash of its hostname, so that stations compressing on the same boundary do not
+    start their uploads together.
+
+    :param slot_period: Duration of the slot cycle in seconds.
+    :param n_slots: Number of slots in the cycle.
+    :param coordinator: Address of an UploadCoordinator as "host:port", or None.
+    :param logger: Logger instance.
+    """
+
+    def __init__(self, slot_period=60, n_slots=12, coordinator=None, logger=None, hostname=None):
+        self.slot_period = slot_period
+        self.n_slots = max(1, n_slots)
+        self.coordinator = coordinator
+        self.logger = logger
+        self.hostname = hostname if hostname else gethostname()
+        self.slot = self.get_slot(self.hostname, self.n_slots)
+
+    @staticmethod
+    def get_slot(hostname, n_slots):
+        """Slot of a station, stable across restarts (unlike the salted built-in hash)."""
+        digest = hashlib.md5(hostname.encode()).digest()
+        return int.from_bytes(digest[:4], 'big') % n_slots
+
+    def time_to_next_slot(self, now=None):
+        now = time.time() if now is None else now
+        slot_start = self.slot * self.slot_period / self.n_slots
+        return (slot_start - now % self.slot_period) % self.slot_period
+
+    @contextmanager
+    def upload_slot(self, timeout=600):
+        """
+        Context manager wrapping a large upload.
+
+        :param timeout: Maximum time to wait for a coordinator token before uploading anyway.
+        """
+        connection = self.acquire_token(timeout) if self.coordinator else None
+
+        if connection is None:
+            delay = self.time_to_next_slot()
+            self.logger.log(f"Delay upload for {delay:.1f} seconds (slot {self.slot}/{self.n_slots})", log_level=5)
+            time.sleep(delay)
+
+        try:
+            yield
+        finally:
+            if connection is not None:
+                self.release_token(connection)
+
+    def acquire_token(self, timeout):
+        try:
+            host, port = self.coordinator.rsplit(":", 1)
+            connection = socket.create_connection((host, int(port)), timeout=2)
+        except (OSError, ValueError) as e:
+            self.logger.log(f"Upload coordinator {self.coordinator} not reachable ({e}), using hostname slot",
+                            log_level=2)
+            return None
+
+        start_time = time.time()
+        try:
+            connection.settimeout(timeout)
+            connection.sendall(f"ACQUIRE {self.hostname}\n".encode())
+            reply = connection.makefile('r').readline().strip()
+        except OSError as e:
+            self.logger.log(f"No upload token received from {self.coordinator} ({e}), using hostname slot",
+                            log_level=2)
+            connection.close()
+            return None
+
+        if reply != "GRANTED":
+            self.logger.log(f"Unexpected reply from upload coordinator: '{reply}'", log_level=2)
+            connection.close()
+            return None
+
+        self.logger.log(f"Upload token granted after {time.time() - start_time:.1f}s", log_level=5)
+        return connection
+
+    def release_token(self, connection):
+        try:
+            connection.sendall(b"RELEASE\n")
+        except OSError:
+            pass  # The coordinator releases the token when the connection is closed anyway
+        finally:
+            connection.close()
+
+
+class UploadCoordinator(socketserver.ThreadingTCPServer):
+    """
+    Lightweight token server limiting the number of stations uploading at the same time.
+
+    Protocol (one TCP connection per upload): the station sends ``ACQUIRE <hostname>``, the
+    coordinator replies ``GRANTED`` once a token is free, and the token is returned when the
+    station sends ``RELEASE``, closes the connection, or holds it longer than ``lease``.
+
+    Run it on any host reachable by the stations (or locally as a stand-in for tests):
+    ``python3 src/upload_slots.py <port> <max_tokens>``
+
+    :param address: (host, port) to listen on.
+    :param max_tokens: Number of concurrent uploads allowed.
+    :param lease: Maximum duration of an upload token in seconds.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, max_tokens=2, lease=1800, verbose=False):
+        self.tokens = threading.Semaphore(max_tokens)
+        self.lease = lease
+        self.verbose = verbose
+        self.granted = 0
+        self.stats_lock = threading.Lock()
+        super().__init__(address, UploadCoordinatorHandler)
+
+    def log(self, message):
+        if self.verbose:
+            print(f"[UploadCoordinator] {message}", flush=True)
+
+
+class UploadCoordinatorHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline().decode().strip()
+        if not line.startswith("ACQUIRE"):
+            self.wfile.write(b"ERROR\n")
+            return
+
+        station = line[len("ACQUIRE"):].strip()
+        self.server.tokens.acquire()
+        try:
+            with self.server.stats_lock:
+                self.server.granted += 1
+            self.server.log(f"Token granted to {station}")
+            self.wfile.write(b"GRANTED\n")
+
+            # Hold the token until RELEASE, disconnection or end of the lease
+            self.connection.settimeout(self.server.lease)
+            try:
+                self.rfile.readline()
+            except OSError:
+                self.server.log(f"Lease of {station} expired")
+        finally:
+            self.server.tokens.release()
+            self.server.log(f"Token released by {station}")
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5055
+    max_tokens = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+
+    with UploadCoordinator(("0.0.0.0", port), max_tokens=max_tokens, verbose=True) as server:
+        print(f"Upload coordinator listening on port {port} with {max_tokens} token(s)", flush=True)
+        server.serve_forever()
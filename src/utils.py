@@ -40,9 +40,10 @@ def set_affinity(pid, core, logger=None):
     Set CPU affinity for a process.
 
     :param pid: Process ID (use os.getpid() for the current process)
-    :param core: The core number to assign
+    :param core: The core number to assign, or a list of core numbers
     """
-    os.sched_setaffinity(pid, {core})
+    cores = set(core) if isinstance(core, (list, tuple, set)) else {core}
+    os.sched_setaffinity(pid, cores)
     if logger is not None:
         logger.log(f"Process {pid} assigned to core {core}.", log_level=5)
 
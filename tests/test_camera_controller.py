@@ -0,0 +1,75 @@
+import json
+import time
+
+import pytest
+
+# The controller imports the camera module, which needs the libraries of the Raspberry Pi
+pytest.importorskip("picamera2")
+pytest.importorskip("cv2")
+
+from src.camera.camera_controller import CameraController
+
+
+HUNG_CAMERA_SCRIPT = """
+import sys, time
+# Reads the commands and never answers, as a camera script stuck in a capture
+for line in sys.stdin:
+    time.sleep(3600)
+"""
+
+
+class ListLogger:
+    def __init__(self):
+        self.messages = []
+
+    def log(self, message, log_level=3, **kwargs):
+        self.messages.append(message)
+
+
+@pytest.fixture
+def hung_camera(tmp_path, monkeypatch):
+    parameters_path = tmp_path / "parameters.json"
+    parameters_path.write_text(json.dumps({"time_interval": 2,
+                                           "capture_restart_after_misses": 2,
+                                           "capture_min_timeout_s": 0.2,
+                                           "capture_deadline_margin_s": 0.1}))
+    script_path = tmp_path / "hung_camera.py"
+    script_path.write_text(HUNG_CAMERA_SCRIPT)
+
+    monkeypatch.setattr(CameraController, "check_camera", staticmethod(lambda: True))
+    camera = CameraController(parameters_path=str(parameters_path), logger=ListLogger())
+    camera.script_path = str(script_path)
+    camera.start()
+    yield camera
+    camera.stop()
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while time.time() < end:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_hung_camera_script_is_restarted_after_misses(hung_camera, tmp_path):
+    first_process = hung_camera.process
+
+    # The capture is cancelled at its deadline, the command thread stays blocked on the script
+    with pytest.raises(TimeoutError):
+        hung_camera.capture_frame(str(tmp_path / "frame_0.jpg"), deadline=time.time() + 0.5)
+    assert hung_camera.consecutive_misses == 1
+    assert hung_camera.command_thread.is_alive()
+    assert hung_camera.process is first_process
+
+    # The next capture finds the previous request still running: second miss in a row, restart
+    with pytest.raises(RuntimeError):
+        hung_camera.capture_frame(str(tmp_path / "frame_1.jpg"), deadline=time.time() + 0.5)
+    assert hung_camera.missed_deadlines == 2
+    assert hung_camera.consecutive_misses == 0
+    assert first_process.poll() is not None
+
+    assert wait_for(lambda: hung_camera.process is not first_process and hung_camera.camera_available)
+    # The thread left waiting for the first script ends once it is stopped
+    assert wait_for(lambda: not hung_camera.command_thread.is_alive())